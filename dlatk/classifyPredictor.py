@@ -9,17 +9,22 @@ import pickle as pickle
 
 from inspect import ismethod
 import sys
+import os
 import random
 from itertools import combinations, zip_longest, islice
 import csv
 import time
+import io
+import multiprocessing
+import hashlib
+from contextlib import redirect_stdout
 
 from pprint import pprint
 import collections
 
 import pandas as pd 
 
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, ChainMap
 
 #scikit-learn imports
 from sklearn.svm import SVC, LinearSVC 
@@ -56,7 +61,9 @@ import math
 
 #infrastructure
 from .mysqlmethods import mysqlMethods as mm
-from .dlaConstants import DEFAULT_RANDOM_SEED, warn
+from .featureCache import FeatureMatrix
+from . import modelBundle
+from .dlaConstants import DEFAULT_RANDOM_SEED, MODEL_BUNDLE_EXTENSION, DEF_COLLATIONS, warn
 
 #For ROC curves
 try:
@@ -69,7 +76,9 @@ def alignDictsAsXy(X, y, sparse = False, returnKeyList = False, keys = None):
     """turns a list of dicts for x and a dict for y into a matrix X and vector y"""
     if not keys: 
         keys = frozenset(list(y.keys()))
-        if sparse:
+        if isinstance(X, FeatureMatrix):
+            keys = keys.intersection(X.observedGroups() if sparse else X.completeGroups())
+        elif sparse:
             keys = keys.intersection([item for sublist in X for item in sublist]) #union X keys
         else:
             keys = keys.intersection(*[list(x.keys()) for x in X]) #intersect X keys
@@ -84,6 +93,14 @@ def alignDictsAsXy(X, y, sparse = False, returnKeyList = False, keys = None):
         listy = [float(y[k]) for k in keys]
 
     # Keys: list of group_ids in order.
+    if isinstance(X, FeatureMatrix): #rows picked by index from a matrix built once per feature table
+        alignedX = X.alignRows(keys)
+        if not sparse: alignedX = alignedX.toarray()
+        if returnKeyList:
+            return (alignedX, array(listy).astype(int64), keys)
+        else:
+            return (alignedX, array(listy).astype(int64))
+
     if sparse:
         keyToIndex = dict([(keys[i], i) for i in range(len(keys))])
         row = []
@@ -159,6 +176,274 @@ def computeAUC(ytrue, ypredProbs, multiclass=False, negatives=True):
         this_auc = this_auc - 1
     return this_auc
 
+_foldWorkerJob = None #the runFold closure of the worker processes (see mapFolds)
+
+def _initFoldWorker(runFold, predictor):
+    global _foldWorkerJob
+    _foldWorkerJob = runFold
+    predictor.cvJobs = 1 #the folds already use the cores
+
+def _foldWorker(testChunk):
+    """Runs one fold in a worker, returning what it printed along with its result"""
+    out = io.StringIO()
+    with redirect_stdout(out):
+        result = _runFold(_foldWorkerJob, testChunk)
+    return (out.getvalue(), result)
+
+def _runFold(runFold, testChunk):
+    #each fold gets its own seed so that results do not depend on which process ran it
+    random.seed(DEFAULT_RANDOM_SEED + testChunk)
+    np.random.seed(DEFAULT_RANDOM_SEED + testChunk)
+    return runFold(testChunk)
+
+def mapFolds(predictor, runFold, testChunks, cores = 1):
+    """Yields runFold(testChunk) for each of testChunks, in order
+
+    With cores > 1 the folds (or, in train, the outcomes) run in worker processes forked from this
+    one, so the data runFold reads (feature matrices, outcomes, folds) is shared rather than sent.
+    What a fold prints is held back and printed in fold order, and the global random
+    state is seeded per fold, so the results are the same for any number of cores.
+    runFold is a closure and can only reach the workers by fork, so where fork is not
+    available the folds run serially.
+    """
+    testChunks = list(testChunks)
+    if cores > 1 and len(testChunks) > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        warn("Worker processes cannot be forked on this platform; running folds serially")
+        cores = 1
+    if cores <= 1 or len(testChunks) <= 1:
+        for testChunk in testChunks:
+            yield _runFold(runFold, testChunk)
+        return
+    pool = multiprocessing.get_context('fork').Pool(min(cores, len(testChunks)), initializer = _initFoldWorker, initargs = (runFold, predictor))
+    try:
+        for (out, result) in pool.imap(_foldWorker, testChunks):
+            sys.stdout.write(out)
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def foldFitKey(table, outcomeName, testChunk, trainGroupsOrder, ytrain):
+    """Returns the key of a fold's fit to a table in a testControlCombos fit cache
+
+    The training groups and y enter as a digest, so that the key stays small.
+    """
+    digest = hashlib.md5('\x00'.join(str(g) for g in trainGroupsOrder).encode('utf-8'))
+    digest.update(np.ascontiguousarray(ytrain, dtype=float).tobytes())
+    return (id(table), outcomeName, testChunk, digest.hexdigest())
+
+def yieldFeatureChunks(featureGetters, featureNamesList, chunkSize):
+    """Streams the groups of the feature tables as (groupIds, multiX), chunkSize groups at a time
+
+    The first table is read once in group_id order (see FeatureGetter.yieldGroupNormChunks) and
+    the others only for the range of group ids of each chunk. multiX has a csr_matrix per table,
+    with the columns of its training features (featureNamesList). As in predictNoOutcomeGetter,
+    only groups with training features in every table are kept.
+    """
+    for (groupIds, X) in featureGetters[0].yieldGroupNormChunks(featureNamesList[0], chunkSize):
+        multiX = [X] + [fg.getGroupNormRowsInRange(feats, groupIds) for (fg, feats) in zip(featureGetters[1:], featureNamesList[1:])]
+        found = np.ones(len(groupIds), dtype=bool)
+        for X in multiX:
+            found &= np.diff(X.indptr) > 0
+        if not found.all():
+            keep = np.nonzero(found)[0]
+            groupIds = [groupIds[r] for r in keep]
+            multiX = [X[keep] for X in multiX]
+        if groupIds:
+            yield (groupIds, multiX)
+
+def linearInputWeights(transformer, weights):
+    """Maps weights on the output of a fitted linear transformer back onto its input
+
+    For the transformers used as scalers and feature selectors (StandardScaler, univariate
+    selectors, PCA and Pipelines of these), weights . transform(x) == inputWeights . x + constant.
+
+    Parameters
+    ----------
+    transformer : sklearn transformer or None
+    weights : ndarray
+        one weight per output column of the transformer
+
+    Returns
+    -------
+    (inputWeights, constant) : (ndarray, float)
+    """
+    weights = np.asarray(weights, dtype=float).ravel()
+    if transformer is None:
+        return (weights, 0.0)
+    if isinstance(transformer, Pipeline):
+        constant = 0.0
+        for (stepName, step) in reversed(transformer.steps):
+            (weights, stepConstant) = linearInputWeights(step, weights)
+            constant += stepConstant
+        return (weights, constant)
+    if isinstance(transformer, StandardScaler):
+        scales = transformer.scale_ if transformer.scale_ is not None else 1.0
+        inputWeights = weights / scales
+        constant = 0.0
+        if transformer.with_mean and transformer.mean_ is not None:
+            constant = -float(np.dot(transformer.mean_, inputWeights))
+        return (inputWeights, constant)
+    if hasattr(transformer, 'get_support'): #univariate selectors, OccurrenceThreshold, ...
+        support = transformer.get_support()
+        inputWeights = np.zeros(len(support))
+        inputWeights[support] = weights
+        return (inputWeights, 0.0)
+    if isinstance(transformer, PCA) or type(transformer).__name__ == 'RandomizedPCA':
+        if transformer.whiten:
+            weights = weights / np.sqrt(transformer.explained_variance_)
+        inputWeights = np.asarray(transformer.components_).T.dot(weights)
+        constant = 0.0
+        if transformer.mean_ is not None:
+            constant = -float(np.dot(transformer.mean_, inputWeights))
+        return (inputWeights, constant)
+    raise ValueError("%s is not a linear transformation that can be compiled" % type(transformer).__name__)
+
+def compileLinearModel(model, multiScalers, multiFSelectors, nameLists):
+    """Folds the scalers, feature selectors and linear model of one outcome into one weight vector
+
+    Parameters
+    ----------
+    model : sklearn estimator
+        a regressor or binary classifier with coef_ and intercept_
+    multiScalers, multiFSelectors : list
+        the scaler and feature selector of each feature table (or None)
+    nameLists : list
+        the feature names of each feature table, in training order
+
+    Returns
+    -------
+    (intercept, weights) : (float, csr_matrix)
+        weights is (number of features x 1) over the concatenated feature names, so that
+        model's prediction (decision function) is X . weights + intercept
+    """
+    if not hasattr(model, 'coef_') or not hasattr(model, 'intercept_') or np.asarray(model.coef_).ndim > 1 and np.asarray(model.coef_).shape[0] > 1:
+        raise ValueError("%s is not a linear model with one weight vector, so it can't be compiled" % type(model).__name__)
+    coefficients = np.asarray(model.coef_, dtype=float).ravel()
+    intercept = float(np.ravel(model.intercept_)[0])
+    blockWeights = []
+    start = 0
+    for i, names in enumerate(nameLists):
+        (scaler, fSelector) = (multiScalers[i], multiFSelectors[i])
+        width = len(names)
+        if fSelector:
+            #a selector that keeps no features is skipped at prediction time:
+            selectedWidth = fSelector.transform(np.zeros((1, width))).shape[1]
+            if selectedWidth:
+                width = selectedWidth
+            else:
+                fSelector = None
+        (weights, constant) = linearInputWeights(fSelector, coefficients[start:start+width])
+        start += width
+        (weights, scalerConstant) = linearInputWeights(scaler, weights)
+        intercept += constant + scalerConstant
+        blockWeights.append(csr_matrix(weights.reshape(-1, 1)))
+    if start != len(coefficients):
+        raise ValueError("model has %d coefficients but the feature tables give %d columns" % (len(coefficients), start))
+    return (intercept, csr_matrix(vstack(blockWeights)))
+
+def compiledPredict(compiledModel, multiX):
+    """Scores groups with a model from compileLinearModel (the decision function of a classifier)
+
+    Parameters
+    ----------
+    compiledModel : (float, csr_matrix)
+        intercept and weights of one outcome
+    multiX : list
+        groups x features matrices of each feature table, in the order the model was compiled
+
+    Returns
+    -------
+    ypred : ndarray
+    """
+    (intercept, weights) = compiledModel
+    X = hstack([csr_matrix(X) for X in multiX], format='csr')
+    return np.asarray(X.dot(weights).todense()).ravel() + intercept
+
+def insertLinearPredictions(fe, featureTableName, featureTables, nameLists, compiledModels, valueSql = '%(score)s', classes = None, platt = None):
+    """Scores compiled linear models inside MySQL, writing one row per group and outcome to featureTableName
+
+    The nonzero weights of each feature table are uploaded to a working table and every group found in
+    all of the feature tables is scored with
+
+      INSERT INTO featureTableName ... SELECT group_id, outcome, intercept + SUM(group_norm * weight) ... GROUP BY group_id, outcome
+
+    so no feature rows are read into python.
+
+    Parameters
+    ----------
+    fe : FeatureExtractor
+        connection (and encoding) of the database holding the feature tables
+    featureTableName : str
+        existing feat$p_ table to insert into
+    featureTables : list
+        name of each feature table, in the order of nameLists
+    nameLists : list
+        feature names of each feature table (as compiled)
+    compiledModels : dict
+        outcome -> (intercept, weights) from compileLinearModel
+    valueSql : str
+        sql for the written value, in terms of %(score)s and, for classifiers, o.neg_class and o.pos_class
+        (and o.prob_a and o.prob_b with platt)
+    classes : dict
+        outcome -> (negative class, positive class) of binary classifiers
+    platt : dict
+        outcome -> (probA, probB) of classifiers calibrated with Platt scaling
+
+    Returns
+    -------
+    featureTableName : str
+    """
+    (db, charset, use_unicode) = (fe.corpdb, fe.encoding, fe.use_unicode)
+    collation = DEF_COLLATIONS[charset.lower()]
+    outcomes = sorted(compiledModels.keys())
+    (featLength, outcomeLength) = (max([len(str(n)) for names in nameLists for n in names] + [1]), max([len(o) for o in outcomes]))
+    #ordinary tables (MySQL can't reopen a TEMPORARY table within one query), dropped when done:
+    weightTables = ["tmp_weights$%d$%d" % (os.getpid(), i) for i in range(len(featureTables))]
+    outcomeTable = "tmp_outcomes$%d" % os.getpid()
+    try:
+        mm.execute(db, fe.dbCursor, "DROP TABLE IF EXISTS %s" % outcomeTable, charset=charset, use_unicode=use_unicode)
+        mm.execute(db, fe.dbCursor, """CREATE TABLE %s (outcome VARCHAR(%d) CHARACTER SET %s COLLATE %s NOT NULL,
+                 intercept DOUBLE, neg_class DOUBLE, pos_class DOUBLE, prob_a DOUBLE, prob_b DOUBLE, PRIMARY KEY (outcome))""" % (outcomeTable, outcomeLength, charset, collation), charset=charset, use_unicode=use_unicode)
+        rows = [(o, compiledModels[o][0]) + (tuple(classes[o]) if classes else (None, None)) + (tuple(platt[o]) if platt else (None, None)) for o in outcomes]
+        mm.executeWriteMany(db, fe.dbCursor, "INSERT INTO %s (outcome, intercept, neg_class, pos_class, prob_a, prob_b) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % outcomeTable,
+                            rows, writeCursor=fe.dbConn.cursor(), charset=charset, use_unicode=use_unicode)
+        start = 0
+        for (i, names) in enumerate(nameLists):
+            mm.execute(db, fe.dbCursor, "DROP TABLE IF EXISTS %s" % weightTables[i], charset=charset, use_unicode=use_unicode)
+            mm.execute(db, fe.dbCursor, """CREATE TABLE %s (feat VARCHAR(%d) CHARACTER SET %s COLLATE %s NOT NULL,
+                     outcome VARCHAR(%d) CHARACTER SET %s COLLATE %s NOT NULL, weight DOUBLE, KEY (feat))""" % (
+                         weightTables[i], featLength, charset, collation, outcomeLength, charset, collation), charset=charset, use_unicode=use_unicode)
+            rows = []
+            for o in outcomes:
+                weights = compiledModels[o][1][start:start+len(names)].tocoo()
+                rows.extend((names[j], o, float(w)) for (j, w) in zip(weights.row, weights.data))
+            start += len(names)
+            wsql = "INSERT INTO %s (feat, outcome, weight) VALUES (%%s, %%s, %%s)" % weightTables[i]
+            for r in range(0, len(rows), mm.MYSQL_BATCH_INSERT_SIZE):
+                mm.executeWriteMany(db, fe.dbCursor, wsql, rows[r:r+mm.MYSQL_BATCH_INSERT_SIZE], writeCursor=fe.dbConn.cursor(), charset=charset, use_unicode=use_unicode)
+            print("[%d weights for %s]" % (len(rows), featureTables[i]))
+        fe.dbConn.commit()
+
+        #groups found in every feature table:
+        groupsSql = " UNION ALL ".join("SELECT DISTINCT group_id FROM %s" % table for table in featureTables)
+        groupsSql = "SELECT group_id FROM (%s) AS tg GROUP BY group_id HAVING COUNT(*) = %d" % (groupsSql, len(featureTables))
+        #partial scores of each feature table:
+        scoresSql = " UNION ALL ".join("""SELECT f.group_id, w.outcome, SUM(f.group_norm * w.weight) AS score FROM %s AS f
+                 JOIN %s AS w ON w.feat = f.feat GROUP BY f.group_id, w.outcome""" % (table, weightTable) for (table, weightTable) in zip(featureTables, weightTables))
+        score = "(o.intercept + IFNULL(SUM(s.score), 0))"
+        sql = """INSERT INTO %s (group_id, feat, value, group_norm) SELECT group_id, outcome, value, value FROM
+                 (SELECT g.group_id, o.outcome, %s AS value FROM (%s) AS g CROSS JOIN %s AS o
+                 LEFT JOIN (%s) AS s ON s.group_id = g.group_id AND s.outcome = o.outcome
+                 GROUP BY g.group_id, o.outcome, o.intercept, o.neg_class, o.pos_class, o.prob_a, o.prob_b) AS p""" % (
+                     featureTableName, valueSql % {'score': score}, groupsSql, outcomeTable, scoresSql)
+        mm.execute(db, fe.dbCursor, sql, charset=charset, use_unicode=use_unicode)
+        fe.dbConn.commit()
+    finally:
+        for table in weightTables + [outcomeTable]:
+            mm.execute(db, fe.dbCursor, "DROP TABLE IF EXISTS %s" % table, warnQuery=False, charset=charset, use_unicode=use_unicode)
+    return featureTableName
+
 class ClassifyPredictor:
     """Interfaces with scikit-learn to perform prediction of outcomes for lanaguage features.
 
@@ -419,7 +704,7 @@ class ClassifyPredictor:
         """float: Threshold for setting outliers to mean value."""
 
 
-    def train(self, standardize = True, sparse = False, restrictToGroups = None, groupsWhere = ''):
+    def train(self, standardize = True, sparse = False, restrictToGroups = None, groupsWhere = '', cores = 1):
         """Tests classifier, by pulling out random testPerc percentage as a test set"""
         
         ################
@@ -432,8 +717,8 @@ class ClassifyPredictor:
             groups = groups.intersection(rGroups)
             for outcomeName, outcomes in allOutcomes.items():
                 allOutcomes[outcomeName] = dict([(g, outcomes[g]) for g in groups if (g in outcomes)])
-            for controlName, controlValues in controls.items():
-                controls[controlName] = dict([(g, controlValues[g]) for g in groups])
+            for controlName, controlValues in allControls.items():
+                allControls[controlName] = dict([(g, controlValues[g]) for g in groups])
         print("[number of groups: %d]" % (len(groups)))
 
         ####################
@@ -442,8 +727,8 @@ class ClassifyPredictor:
         XGroups = None #holds the set of X groups across all feature spaces and folds (intersect with this to get consistent keys across everything
         UGroups = None
         for fg in self.featureGetters:
-            (groupNorms, featureNames) = fg.getGroupNormsSparseFeatsFirst(groups)
-            groupNormValues = [groupNorms[feat] for feat in featureNames] #list of dictionaries of group_id => group_norm
+            groupNormValues = fg.getGroupNormMatrix(groups) #groups x feats; rows are picked by index for each outcome and fold
+            featureNames = groupNormValues.feats
             groupNormsList.append(groupNormValues)
             #print featureNames[:10]#debug
             featureNamesList.append(featureNames)
@@ -464,13 +749,16 @@ class ClassifyPredictor:
         #2b) setup control data:
         controlValues = list(allControls.values())
         if controlValues:
-            groupNormsList.append(controlValues)
+            groupNormsList.append(FeatureMatrix.fromDicts(controlValues, list(allControls.keys())))
 
         #########################################
-        #3. train for all possible ys:
+        #3. train for all possible ys (in parallel with cores > 1):
         self.multiXOn = True
         (self.classificationModels, self.multiScalers, self.multiFSelectors) = (dict(), dict(), dict())
-        for outcomeName, outcomes in sorted(allOutcomes.items()):
+        outcomeNames = sorted(allOutcomes.keys())
+        def trainOutcome(o):
+            outcomeName = outcomeNames[o]
+            outcomes = allOutcomes[outcomeName]
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
             multiXtrain = list()
             #trainGroupsOrder = list(XGroups & set(outcomes.keys()))
@@ -488,8 +776,11 @@ class ClassifyPredictor:
 
             #############
             #4) fit model
-            (self.classificationModels[outcomeName], self.multiScalers[outcomeName], self.multiFSelectors[outcomeName]) = \
-                self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse)
+            return self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse)
+
+        #4a) each outcome is fit in its own worker, sharing the feature matrices (see mapFolds)
+        for (outcomeName, fitted) in zip(outcomeNames, mapFolds(self, trainOutcome, range(len(outcomeNames)), cores)):
+            (self.classificationModels[outcomeName], self.multiScalers[outcomeName], self.multiFSelectors[outcomeName]) = fitted
 
         print("\n[TRAINING COMPLETE]\n")
         self.featureNamesList = featureNamesList
@@ -520,10 +811,12 @@ class ClassifyPredictor:
         controlValues = list(controls.values()) #list of dictionaries of group=>group_norm
     #     this will return a dictionary of dictionaries
 
+        XMatrix = FeatureMatrix.fromDicts(groupNormValues+controlValues) #built once; rows are picked for each outcome
+
         #3. test classifiers for each possible y:
         for outcomeName, outcomes in sorted(allOutcomes.items()):
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
-            (X, y) = alignDictsAsXy(groupNormValues+controlValues, outcomes, sparse)
+            (X, y) = alignDictsAsXy(XMatrix, outcomes, sparse)
             print("[Initial size: %d]" % len(y))
             Xtrain, Xtest, ytrain, ytest = train_test_split(X, y, test_size=self.testPerc, random_state=self.randomState)
             if len(ytrain) > self.trainingSize:
@@ -554,7 +847,7 @@ class ClassifyPredictor:
     def testControlCombos(self, standardize = True, sparse = False, saveModels = False, blacklist = None, noLang = False, 
                           allControlsOnly = False, comboSizes = None, nFolds = 2, savePredictions = False, 
                           weightedEvalOutcome = None, stratifyFolds = True, adaptTables=None, adaptColumns=None, 
-                          controlCombineProbs = True, groupsWhere = '', testFolds = None):
+                          controlCombineProbs = True, groupsWhere = '', testFolds = None, cores = 1, reuseFits = False):
         """Tests classifier, by pulling out random testPerc percentage as a test set""" # edited by Youngseo
         
         ###################################
@@ -599,8 +892,8 @@ class ClassifyPredictor:
             #(groupNorms, featureNames) = (None, None)
             if blacklist:
                 print("!!!WARNING: USING BLACKLIST WITH SPARSE IS NOT CURRENTLY SUPPORTED!!!")
-            (groupNorms, featureNames) = fg.getGroupNormsSparseFeatsFirst(groups)
-            groupNormValues = list(groupNorms.values()) #list of dictionaries of group_id => group_norm
+            groupNormValues = fg.getGroupNormMatrix(groups) #groups x feats; rows are picked by index for each outcome and fold
+            featureNames = groupNormValues.feats
             groupNormsList.append(groupNormValues)
             featureNamesList.append(featureNames)
             fgGroups = getGroupsFromGroupNormValues(groupNormValues)
@@ -617,7 +910,12 @@ class ClassifyPredictor:
         ################################
         #2b) setup control combinations:
         controlKeys = list(allControls.keys())
+        allControlsMatrix = FeatureMatrix.fromDicts([allControls[k] for k in controlKeys], controlKeys)
         scores = dict() #outcome => control_tuple => [0],[1] => scores= {R2, R, r, r-p, rho, rho-p, MSE, train_size, test_size, num_features,yhats}
+        #scalers and feature selectors fit to the language tables of a fold, reused by every control combination
+        #(with reuseFits; the cache holds one fit per outcome, fold and language table until the end of the run):
+        languageIds = set(id(gnv) for gnv in groupNormsList)
+        fitCache = dict() if reuseFits else None
         if not comboSizes:
             comboSizes = range(len(controlKeys)+1)
             if allControlsOnly:
@@ -636,7 +934,7 @@ class ClassifyPredictor:
                 controlValues = list(controls.values()) #list of dictionaries of group=>group_norm
                 thisGroupNormsList = list(groupNormsList)
                 if controlValues: 
-                    thisGroupNormsList.append(controlValues)
+                    thisGroupNormsList.append(allControlsMatrix.selectFeats(controlKeyCombo))
 
                 #########################################
                 #3. test classifiers for each possible y:
@@ -680,8 +978,8 @@ class ClassifyPredictor:
                         predictionProbs = {}
                         
                         ###############################
-                        #3a) iterate over nfold groups:
-                        for testChunk in [i for i in range(0, len(groupFolds)) if not testFolds or i in testFolds]:
+                        #3) fit and predict one fold:
+                        def runFold(testChunk):
                             trainGroups = set()
                             for chunk in (groupFolds[:testChunk]+groupFolds[(testChunk+1):]):
                                 trainGroups.update(chunk)
@@ -695,6 +993,8 @@ class ClassifyPredictor:
                             ###########################################################################
                             #3b)setup train and test data (different X for each set of groupNormValues)
                             (multiXtrain, multiXtest, ytrain, ytest) = ([], [], None, None) #ytrain, ytest should be same across tables
+                            fitKeys = [] #per X in multiXtrain: identifies its fit in fitCache (None for controls)
+                            newFits = ChainMap(dict(), fitCache) if fitCache is not None else None #what this fold adds to fitCache (it may run in a worker)
                             #get the group order across all
                             gnListIndices = list(range(len(thisGroupNormsList)))
                             num_feats = 0;
@@ -714,23 +1014,35 @@ class ClassifyPredictor:
                                 num_feats += Xtrain.shape[1]
                                 multiXtrain.append(Xtrain)
                                 multiXtest.append(Xtest)
+                                fitKeys.append(foldFitKey(groupNormValues, outcomeName, testChunk, trainGroupsOrder, ytrain) if newFits is not None and id(groupNormValues) in languageIds else None)
                             print("[Train size: %d    Test size: %d]" % (len(ytrain), len(ytest)))
 
                             ################################
-                            #4) fit model and test accuracy:
-                            
-                            mfclass = Counter(ytrain).most_common(1)[0][0]
+                            #4) fit model:
                             classes = list(set(ytrain))
-                            if len(classes) > 2: multiclass = True
                             # Check if the classifier is using controls - Youngseo
                             if len(controls) > 0:
                                 (classifier, multiScalers, multiFSelectors) = self._multiXtrain(multiXtrain, ytrain, standardize = standardize, sparse = sparse, adaptTables=adaptTables, adaptColumns=adaptColumns, classes=classes)
                                 ypredProbs, ypredClasses = self._multiXpredict(classifier, multiXtest, \
                                                                                multiScalers = multiScalers, multiFSelectors = multiFSelectors, sparse = sparse, probs=True, adaptTables=adaptTables, adaptColumns=adaptColumns)
                             else:
-                                (classifier, multiScalers, multiFSelectors) = self._multiXtrain(multiXtrain, ytrain, standardize = standardize, sparse = sparse, adaptTables=None, adaptColumns=None, classes=classes)
+                                (classifier, multiScalers, multiFSelectors) = self._multiXtrain(multiXtrain, ytrain, standardize = standardize, sparse = sparse, adaptTables=None, adaptColumns=None, classes=classes, fitCache=newFits, fitKeys=fitKeys)
                                 ypredProbs, ypredClasses = self._multiXpredict(classifier, multiXtest, \
                                                                                multiScalers = multiScalers, multiFSelectors = multiFSelectors, sparse = sparse, probs=True, adaptTables=None, adaptColumns=None)
+                            modelDesc = str(classifier).replace('\t', "  ").replace('\n', " ").replace('  ', " ")
+                            modelFSDesc = str(multiFSelectors[0]).replace('\t', "  ").replace('\n', " ").replace('  ', " ")
+                            return (testGroupsOrder, ytrain, ytest, ypredProbs, ypredClasses, num_feats, modelDesc, modelFSDesc, newFits.maps[0] if newFits is not None else None)
+
+                        ###############################
+                        #3a) iterate over nfold groups (in parallel with cores > 1):
+                        testChunks = [i for i in range(0, len(groupFolds)) if not testFolds or i in testFolds]
+                        for (testGroupsOrder, ytrain, ytest, ypredProbs, ypredClasses, num_feats, modelDesc, modelFSDesc, foldFits) in mapFolds(self, runFold, testChunks, cores):
+                            if foldFits: fitCache.update(foldFits)
+                            ################################
+                            #4a) test accuracy:
+                            mfclass = Counter(ytrain).most_common(1)[0][0]
+                            classes = list(set(ytrain))
+                            if len(classes) > 2: multiclass = True
 
                             ypred = ypredClasses[ypredProbs.argmax(axis=1)]
                             predictions.update(dict(zip(testGroupsOrder,ypred)))
@@ -759,8 +1071,8 @@ class ClassifyPredictor:
                             testStats['recall'].append(recall_score(ytest, ypred, average='macro'))
                             testStats['mfclass_acc'].append(mfclass_acc)
                             testStats.update({'train_size': len(ytrain), 'test_size': len(ytest), 'num_features' : num_feats, 
-                             '{model_desc}': str(classifier).replace('\t', "  ").replace('\n', " ").replace('  ', " "),
-                             '{modelFS_desc}': str(multiFSelectors[0]).replace('\t', "  ").replace('\n', " ").replace('  ', " "),
+                             '{model_desc}': modelDesc,
+                             '{modelFS_desc}': modelFSDesc,
                              'mfclass' : str(mfclass), 'num_classes' : str(len(list(testCounter.keys())))
                                               })
                             ##4 b) weighted eval
@@ -898,7 +1210,7 @@ class ClassifyPredictor:
         #2b) setup control data:
         controlValues = list(allControls.values())
         if controlValues:
-            groupNormsList.append(controlValues)
+            groupNormsList.append(FeatureMatrix.fromDicts(controlValues, list(allControls.keys())))
 
         #########################################
         #3. predict for all possible outcomes
@@ -1121,7 +1433,7 @@ class ClassifyPredictor:
                 #pprint(preds)#DEBUG
                 print("[Inserting Predictions as Feature values for feature: %s]" % feat)
                 wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values (%s, '"""+feat+"""', %s, %s)"""
-                wCursor = mm.dbConnect(self.corpdb, host=self.mysql_host, charset=self.encoding, use_unicode=self.use_unicode)[1]
+                wCursor = mm.getConnection(self.corpdb, host=self.mysql_host, charset=self.encoding, use_unicode=self.use_unicode)[1]
                 
                 for k, v in preds.items():
                     rows.append((k, v, v))
@@ -1132,7 +1444,7 @@ class ClassifyPredictor:
                         rows = []
             # if there's rows left
             if rows:
-                wCursor = mm.dbConnect(self.corpdb, host=self.mysql_host, charset=self.encoding, use_unicode=self.use_unicode)[1]
+                wCursor = mm.getConnection(self.corpdb, host=self.mysql_host, charset=self.encoding, use_unicode=self.use_unicode)[1]
                 mm.executeWriteMany(fe.corpdb, fe.dbCursor, wsql, rows, writeCursor=wCursor, charset=fe.encoding, use_unicode=fe.use_unicode)
                 written += len(rows)
                 print("   %d feature rows written" % written)
@@ -1291,10 +1603,18 @@ class ClassifyPredictor:
         # 4: use self.outcomeGetter.createOutcomeTable(tableName, dataFrame)
         self.outcomeGetter.createOutcomeTable(name, predDF, 'replace')
 
-    def predictToFeatureTable(self, standardize = True, sparse = False, fe = None, name = None, groupsWhere = '', probs = False):
+    def predictToFeatureTable(self, standardize = True, sparse = False, fe = None, name = None, groupsWhere = '', probs = False, streaming = False, inDatabase = False):
         if not fe:
             print("Must provide a feature extractor object")
             sys.exit(0)
+        if inDatabase:
+            if groupsWhere:
+                raise ValueError("Predictions scored in the database cover every group of the feature tables and can't be restricted with groupsWhere (%s)" % groupsWhere)
+            return self.scorePredictionsInDatabase(fe, name, probs)
+        if streaming:
+            if groupsWhere:
+                raise ValueError("Streamed predictions cover every group of the feature tables and can't be restricted with groupsWhere (%s)" % groupsWhere)
+            return self.streamPredictionsToFeatureTable(sparse, fe, name, probs)
 
         # handle large amount of predictions:
         (groups, allOutcomes, controls) = self.outcomeGetter.getGroupsAndOutcomes(groupsWhere = groupsWhere)
@@ -1373,6 +1693,120 @@ class ClassifyPredictor:
         return
 
 
+    def streamPredictionsToFeatureTable(self, sparse = False, fe = None, name = None, probs = False):
+        """Classifies every group of the feature tables into a feat$p_ table, one chunk of groups at a time
+
+        Outcomes are not read. The feature tables are streamed in chunks of maxPredictAtTime groups
+        (see yieldFeatureChunks), which are transformed with the stored scalers and feature selectors
+        and written before the next chunk is read, so memory does not grow with the number of groups.
+
+        Parameters
+        ----------
+        fe : FeatureExtractor
+            used to create and write the prediction table
+        name : str
+            appended to the table's feature name (p_<model>_<name>)
+        probs : boolean
+            write the probability of the highest class rather than the predicted class
+
+        Returns
+        -------
+        featureTableName : str
+        """
+        if self.controlsOrder:
+            raise ValueError("Models trained with controls (%s) can't be scored from the feature tables alone" % ', '.join(self.controlsOrder))
+        outcomes = sorted(self.classificationModels.keys())
+        featLength = max([len(s) for s in outcomes])
+        featureName = "p_%s" % self.modelName[:4]
+        if name: featureName += '_' + name
+        featureTableName = fe.createFeatureTable(featureName, "VARCHAR(%d)"%featLength, 'DOUBLE')
+        wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values (%s, %s, %s, %s)"""
+
+        totalPred = 0
+        for (groupIds, multiX) in yieldFeatureChunks(self.featureGetters, self.featureNamesList, self.maxPredictAtTime):
+            rows = []
+            for outcomeName in outcomes:
+                if probs:
+                    ypredProbs, ypredClasses = self._multiXpredict(self.classificationModels[outcomeName], list(multiX), multiScalers = self.multiScalers[outcomeName], \
+                                                                   multiFSelectors = self.multiFSelectors[outcomeName], sparse = sparse, probs = probs)
+                    ypred = ypredProbs[:,ypredClasses.argmax()]
+                else:
+                    ypred = self._multiXpredict(self.classificationModels[outcomeName], list(multiX), multiScalers = self.multiScalers[outcomeName], \
+                                                multiFSelectors = self.multiFSelectors[outcomeName], sparse = sparse)
+                rows.extend((gid, outcomeName, float(v), float(v)) for (gid, v) in zip(groupIds, ypred))
+            mm.executeWriteMany(fe.corpdb, fe.dbCursor, wsql, rows, writeCursor=fe.dbConn.cursor(), charset=fe.encoding, use_unicode=fe.use_unicode)
+            totalPred += len(groupIds)
+            print(" Total Predicted: %d" % totalPred)
+        return featureTableName
+
+    def compileLinearModels(self):
+        """Folds each outcome's scalers, feature selectors and binary linear classifier into one weight vector
+
+        Returns
+        -------
+        compiledModels : dict
+            outcome -> (intercept, weights) of the decision function (see compileLinearModel), over the
+            features of featureNamesList, in order
+        classes : dict
+            outcome -> (negative class, positive class)
+        """
+        if self.controlsOrder:
+            raise ValueError("Models trained with controls (%s) can't be compiled over the feature tables alone" % ', '.join(self.controlsOrder))
+        if self.outliersToMean:
+            warn("Outliers to mean (%s) is not applied by compiled models" % str(self.outliersToMean))
+        nameLists = list(self.featureNamesList)
+
+        (compiledModels, classes) = (dict(), dict())
+        for outcomeName, classifier in sorted(self.classificationModels.items()):
+            if len(classifier.classes_) != 2:
+                raise ValueError("%s has %d classes; only binary classifiers can be compiled" % (outcomeName, len(classifier.classes_)))
+            compiledModels[outcomeName] = compileLinearModel(classifier, self.multiScalers[outcomeName], self.multiFSelectors[outcomeName], nameLists)
+            classes[outcomeName] = tuple(classifier.classes_)
+            print("[compiled %s: %d nonzero weights, intercept %f]" % (outcomeName, compiledModels[outcomeName][1].nnz, compiledModels[outcomeName][0]))
+        return (compiledModels, classes)
+
+    def scorePredictionsInDatabase(self, fe = None, name = None, probs = False):
+        """Classifies every group of the feature tables into a feat$p_ table with one query inside MySQL
+
+        The binary linear classifiers are compiled (see compileLinearModels) and their weights uploaded,
+        so that each decision value is intercept + SUM(group_norm * weight) over the group's feature rows
+        (see insertLinearPredictions). Groups found in every feature table are classified.
+
+        Parameters
+        ----------
+        fe : FeatureExtractor
+            used to create and write the prediction table
+        name : str
+            appended to the table's feature name (p_<model>_<name>)
+        probs : boolean
+            write the probability of the higher class rather than the predicted class: the logistic of the
+            decision value for lr, or its Platt scaling (probA_, probB_) for svc trained with probabilities
+
+        Returns
+        -------
+        featureTableName : str
+        """
+        if self.controlsOrder:
+            raise ValueError("Models trained with controls (%s) can't be scored from the feature tables alone" % ', '.join(self.controlsOrder))
+        platt = None
+        if not probs:
+            valueSql = "IF(%(score)s > 0, o.pos_class, o.neg_class)"
+        elif all(isinstance(classifier, LogisticRegression) for classifier in self.classificationModels.values()):
+            valueSql = "1 / (1 + EXP(-%(score)s))"
+        elif all(isinstance(classifier, SVC) and len(getattr(classifier, 'probA_', [])) == 1 for classifier in self.classificationModels.values()):
+            #Platt scaling; libsvm calibrates the negated binary decision value, so P(higher class) = 1 / (1 + exp(probA * decision - probB))
+            valueSql = "1 / (1 + EXP(o.prob_a * %(score)s - o.prob_b))"
+            platt = dict((o, (float(c.probA_[0]), float(c.probB_[0]))) for (o, c) in self.classificationModels.items())
+        else:
+            raise ValueError("Probabilities can only be scored in the database for lr, or svc trained with probability estimates (model: %s)" % self.modelName)
+        (compiledModels, classes) = self.compileLinearModels()
+        featLength = max([len(s) for s in compiledModels])
+        featureName = "p_%s" % self.modelName[:4]
+        if name: featureName += '_' + name
+        featureTableName = fe.createFeatureTable(featureName, "VARCHAR(%d)"%featLength, 'DOUBLE')
+        return insertLinearPredictions(fe, featureTableName, [fg.featureTable for fg in self.featureGetters], self.featureNamesList, \
+                                       compiledModels, valueSql = valueSql, classes = classes, platt = platt)
+
     def getWeightsForFeaturesAsADict(self): 
         """Creates a lexicon from a topic file
 
@@ -1611,12 +2045,14 @@ class ClassifyPredictor:
             return classifier, scaler, fSelector
 
 
-    def _multiXtrain(self, X, y, standardize = True, sparse = False, adaptTables=None, adaptColumns=None, classes=[]):
+    def _multiXtrain(self, X, y, standardize = True, sparse = False, adaptTables=None, adaptColumns=None, classes=[], fitCache=None, fitKeys=None):
         """does the actual classification training, first feature selection: can be used by both train and test
            create multiple scalers and feature selectors
            and just one classification model (of combining the Xes into 1)
            adapt tables: specifies which table (i.e. index of X) to adapt
            adapt cols: specifies which columns of the last table (X) to use for adapting the adaptTables 
+           fitCache: dict of (scaler, fSelector) already fit, reused for the X whose fitKeys entry
+                     (identifying its table, training groups and y) is found in it, and filled otherwise
         """
         
         if not isinstance(X, (list, tuple)):
@@ -1648,6 +2084,29 @@ class ClassifyPredictor:
 
             if not sparse and isinstance(X,csr_matrix): #edited by Youngseo
                 X = X.todense()
+
+            fitKey = None
+            if fitCache is not None and fitKeys and fitKeys[i] is not None and adaptTables is None:
+                fitKey = (fitKeys[i], standardize, sparse, self.outliersToMean, self.featureSelectionString, self.featureSelectPerc)
+            if fitKey is not None and fitKey in fitCache:
+                #same table, training groups and y as before (e.g. in another control combination):
+                (scaler, fSelector) = fitCache[fitKey]
+                print("[Reusing StandardScaler and Feature Selection fit to the same X[%d]: %s]" % (i, str(fSelector)))
+                y = np.array(y)
+                if scaler:
+                    X = scaler.transform(X)
+                    if self.outliersToMean and not sparse:
+                        X[abs(X) > self.outliersToMean] = 0
+                if fSelector:
+                    newX = fSelector.transform(X)
+                    if newX.shape[1]:
+                        X = newX
+                    print((" after feature selection: (N, features): %s" % str(X.shape)))
+                multiX[i] = X
+                multiScalers.append(scaler)
+                multiFSelectors.append(fSelector)
+                i+=1
+                continue
             
             #Standardization:
             scaler = None
@@ -1724,6 +2183,8 @@ class ClassifyPredictor:
             multiX[i] = X
             multiScalers.append(scaler)
             multiFSelectors.append(fSelector)
+            if fitKey is not None:
+                fitCache[fitKey] = (scaler, fSelector)
             i+=1 # added to work with while loop by Youngseo Son
 
         #combine all multiX into one X:
@@ -1811,8 +2272,8 @@ class ClassifyPredictor:
             groups = groups.intersection(rGroups)
             for outcomeName, outcomes in allOutcomes.items():
                 allOutcomes[outcomeName] = dict([(g, outcomes[g]) for g in groups if (g in outcomes)])
-            for controlName, controlValues in controls.items():
-                controls[controlName] = dict([(g, controlValues[g]) for g in groups])
+            for controlName, controlValues in allControls.items():
+                allControls[controlName] = dict([(g, controlValues[g]) for g in groups])
         print("[number of groups: %d]" % (len(groups)))
 
         ####################
@@ -1821,8 +2282,8 @@ class ClassifyPredictor:
         XGroups = None #holds the set of X groups across all feature spaces and folds (intersect with this to get consistent keys across everything
         UGroups = None
         for fg in self.featureGetters:
-            (groupNorms, featureNames) = fg.getGroupNormsSparseFeatsFirst(groups)
-            groupNormValues = [groupNorms[feat] for feat in featureNames] #list of dictionaries of group_id => group_norm
+            groupNormValues = fg.getGroupNormMatrix(groups) #groups x feats; rows are picked by index for each outcome and fold
+            featureNames = groupNormValues.feats
             groupNormsList.append(groupNormValues)
             #print featureNames[:10]#debug
             featureNamesList.append(featureNames)
@@ -1842,7 +2303,7 @@ class ClassifyPredictor:
         #2b) setup control data:
         controlValues = list(allControls.values())
         if controlValues:
-            groupNormsList.append(controlValues)
+            groupNormsList.append(FeatureMatrix.fromDicts(controlValues, list(allControls.keys())))
 
         #########################################
         #3. train for all possible ys:
@@ -2172,15 +2633,18 @@ class ClassifyPredictor:
     ###################
     def load(self, filename, pickle2_7=True):
         print("[Loading %s]" % filename)
-        with open(filename, 'rb') as f:
-            if pickle2_7:
-                from .dlaWorker  import DLAWorker
-                from . import occurrenceSelection, pca_mod
-                sys.modules['FeatureWorker'] = DLAWorker
-                sys.modules['FeatureWorker.occurrenceSelection'] = occurrenceSelection
-                sys.modules['FeatureWorker.pca_mod'] = pca_mod
-            tmp_dict = pickle.load(f, encoding='latin1')
-            f.close()          
+        if os.path.isdir(filename):
+            tmp_dict = modelBundle.loadBundle(filename)
+        else:
+            with open(filename, 'rb') as f:
+                if pickle2_7:
+                    from .dlaWorker  import DLAWorker
+                    from . import occurrenceSelection, pca_mod
+                    sys.modules['FeatureWorker'] = DLAWorker
+                    sys.modules['FeatureWorker.occurrenceSelection'] = occurrenceSelection
+                    sys.modules['FeatureWorker.pca_mod'] = pca_mod
+                tmp_dict = pickle.load(f, encoding='latin1')
+                f.close()          
         try:
             print("Outcomes in loaded model:", list(tmp_dict['classificationModels'].keys()))
         except KeyError:
@@ -2196,7 +2660,6 @@ class ClassifyPredictor:
 
     def save(self, filename):
         print("[Saving %s]" % filename)
-        f = open(filename,'wb')
         toDump = {'modelName': self.modelName, 
                   'classificationModels': self.classificationModels,
                   'multiScalers': self.multiScalers,
@@ -2207,6 +2670,10 @@ class ClassifyPredictor:
                   'featureNamesList' : self.featureNamesList,
                   'multiXOn' : self.multiXOn
                   }
+        if filename.endswith(MODEL_BUNDLE_EXTENSION):
+            modelBundle.saveBundle(filename, toDump)
+            return
+        f = open(filename,'wb')
         pickle.dump(toDump,f,2)
         f.close()
 
@@ -2367,13 +2834,15 @@ class ClassifyPredictor:
     #     this will return a dictionary of dictionaries
 
 
+        XMatrix = FeatureMatrix.fromDicts(groupNormValues+controlValues) #built once; rows are picked for each outcome
+
         #3. Create classifiers for each possible y:
         for outcomeName, outcomes in allOutcomes.items():
             if isinstance(restrictToGroups, dict): #outcome specific restrictions:
                 outcomes = dict([(g, o) for g, o in outcomes.items() if g in restrictToGroups[outcomeName]])
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
             print("[Aligning Dicts to get X and y]")
-            (X, y) = alignDictsAsXy(groupNormValues+controlValues, outcomes, sparse)
+            (X, y) = alignDictsAsXy(XMatrix, outcomes, sparse)
             (self.classificationModels[outcomeName], self.scalers[outcomeName], self.fSelectors[outcomeName]) = self._train(X, y, standardize)
 
         print("[Done Training All Outcomes]")
@@ -2422,13 +2891,15 @@ class ClassifyPredictor:
         controlValues = list(controls.values()) #list of dictionaries of group=>group_norm (TODO: including controls for predict might mess things up)
     #     this will return a dictionary of dictionaries
 
+        XMatrix = FeatureMatrix.fromDicts(groupNormValues+controlValues) #built once; rows are picked for each outcome
+
         #3. Predict ys for each model:
         predictions = dict() #outcome=>group_id=>value
         for outcomeName, outcomes in allOutcomes.items():
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
             if isinstance(restrictToGroups, dict): #outcome specific restrictions:
                 outcomes = dict([(g, o) for g, o in outcomes.items() if g in restrictToGroups[outcomeName]])
-            (X, ytest, keylist) = alignDictsAsXy(groupNormValues+controlValues, outcomes, sparse, returnKeyList = True)
+            (X, ytest, keylist) = alignDictsAsXy(XMatrix, outcomes, sparse, returnKeyList = True)
             leny = len(ytest)
             print("[Groups to predict: %d]" % leny)
             print(self.scalers.keys())
@@ -2538,6 +3009,8 @@ def hasMultValuesPerItem(listOfD):
     return False
 
 def getGroupsFromGroupNormValues(gnvs):
+    if isinstance(gnvs, FeatureMatrix):
+        return gnvs.observedGroups()
     return set([k for gns in gnvs for k in gns.keys()])
 
 def matrixAppendHoriz(A, B):
@@ -12,12 +12,10 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 #math / stats:
 from math import floor, log
 from numpy import sqrt, log2, array, mean, std, isnan, fabs, round
-from numpy.random import permutation
 import numpy as np
-from scipy.stats import zscore, norm, t
+from scipy.stats import zscore, norm, t, rankdata
+from scipy.special import expit
 from scipy.sparse import csr_matrix
-from sklearn.metrics import roc_auc_score
-from sklearn.linear_model import LogisticRegression
 import statsmodels.stats.multitest as mt
 
 #DB INFO:
@@ -26,9 +24,14 @@ USER = getpass.getuser()
 MAX_ATTEMPTS = 5 #max number of times to try a query before exiting
 PROGRESS_AFTER_ROWS = 5000 #the number of rows to process between each progress updated
 FEATURE_TABLE_PREFIX = 'feats_'
+GROUP_COUNTS_TABLE_PREFIX = 'meta$groupcounts$' # materialized total word count per group of a word table (see DLAWorker.getGroupCountsTable)
 MYSQL_ERROR_SLEEP = 4 #number of seconds to wait before trying a query again (incase there was a server restart
+MYSQL_PING_INTERVAL = 60 #seconds a pooled connection can sit idle before it is pinged again on reuse
 MYSQL_BATCH_INSERT_SIZE = 10000 # how many rows are inserted into mysql at a time
+MYSQL_LOAD_DATA_BATCH_SIZE = 1000000 # how many rows are written per LOAD DATA LOCAL INFILE
 MAX_SQL_SELECT = 1000000 # how many rows are selected at a time
+FEATS_PER_QUERY = 2000 # how many features are selected at a time when a feature table is too big to hold in memory
+MAX_GROUPS_IN_LIST = 5000 # group sets larger than this are loaded into an indexed table and joined rather than listed in "group_id in (...)"
 MYSQL_HOST = '127.0.0.1'
 VARCHAR_WORD_LENGTH = 36 #length to allocate var chars per words
 LOWERCASE_ONLY = True #if the db is case insensitive, set to True
@@ -154,6 +157,8 @@ DEF_CP_FEATURE_SELECTION_MAPPING = {
 }
 DEFAULT_MAX_PREDICT_AT_A_TIME = 100000
 DEFAULT_RANDOM_SEED = 42
+MODEL_BUNDLE_EXTENSION = '.bundle' #models saved to a path ending with this are written as a bundle directory (see modelBundle)
+MODEL_BUNDLE_ARRAY_BYTES = 4096 #arrays in a model at least this big are saved to their own memory-mappable .npy
 
 ##Mediation Settings:
 DEF_MEDIATION_BOOTSTRAP = 1000
@@ -236,7 +241,12 @@ DEF_CENSOR_DICT = {"fuck":"f**k",
         "nigga's":"n**ga's",
         "niggaz":"n**gaz"}
 GIGS_OF_MEMORY = 512 #used to determine when to use queries that hold data in memory
+FEATURE_CACHE_GIGS = 0 #memory the in-memory feature table cache may hold (0, the default, turns it off)
+CORREL_BLOCK_CELLS = 8388608 #groups * features densified at a time when correlating features as a matrix
 CORES = 32 #used to determine multi-processing
+GROUPS_PER_WORKER_TASK = 100 #number of groups handed to a worker process at a time
+FEATS_PER_WORKER_TASK = 20 #number of features handed to a worker process at a time when correlating
+PERMUTATIONS_PER_TASK = 250 #number of label permutations scored by a worker process at a time when bootstrapping p-values
 
 POSSIBLE_VALUE_FUNCS = [
     lambda d: 1,
@@ -366,14 +376,81 @@ def meanXperY(x, y):
         means[yKey] = sums[yKey] / float(counts[yKey])
     return means
 
-def fiftyChecks(args):
-    Xc, Xend, y, check = args
-    np.random.seed()
-    lr = LogisticRegression(penalty='l2', C=1000000, fit_intercept=True)
-    if Xc is not None:
-        r = sum([roc_auc_score(y, lr.fit(newX,y).predict_proba(newX)[:,1]) > check for newX in [np.append(Xc, permutation(Xend), 1) for i in range(50)]])
-    else:
-        r = sum([roc_auc_score(y, lr.fit(newX,y).predict_proba(newX)[:,1]) > check for newX in [permutation(Xend).reshape(len(Xend),1) for i in range(50)]])
+def permutedAUCs(Xc, Xend, y, perms, C = 1000000):
+    """Returns the auc of a logistic regression of y on the controls and each permutation of the last column
+
+    Parameters
+    ----------
+    Xc : numpy.array or None
+        n x k controls
+    Xend : numpy.array
+        the n values of the feature
+    y : numpy.array
+        n binary labels
+    perms : numpy.array
+        b x n permutations of range(n)
+    C : :obj:`float`, optional
+        inverse l2 penalty of the coefficients (as sklearn's LogisticRegression)
+
+    Without controls the probabilities of the regression rank groups as the feature
+    (or its negation, when it covaries negatively with y) does, so the aucs are found
+    from the ranks of the permuted feature. A permutation that does not covary with y
+    gets a zero coefficient, so every group has the same probability and the auc is 0.5.
+    With controls the b regressions are fit together with Newton steps, warm-started
+    from the controls alone.
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.asarray(Xend, dtype=float).ravel()
+    (n1, n0) = (y.sum(), len(y) - y.sum())
+    if Xc is None:
+        aucs = (rankdata(x)[perms].dot(y) - n1*(n1+1)/2.0) / (n1*n0)
+        #the coefficient, and so the direction of the probabilities, has the sign of the covariance
+        cov = x[perms].dot(y - y.mean())
+        tied = np.abs(cov) <= 1e-12 * np.abs(x - x.mean()).sum() #zero up to rounding
+        return np.where(tied, 0.5, np.where(cov > 0, aucs, 1 - aucs))
+
+    Z = np.column_stack([np.ones(len(y)), Xc]) #intercept and controls, shared by every regression
+    penalty = np.full(Z.shape[1] + 1, 1.0/C)
+    penalty[0] = 0 #intercept is not penalized
+    wz = np.zeros(Z.shape[1])
+    for i in range(25): #controls alone, to warm-start from
+        mu = expit(Z.dot(wz))
+        H = (Z * (mu*(1-mu))[:, None]).T.dot(Z) + np.diag(penalty[:-1])
+        step = np.linalg.solve(H, Z.T.dot(y - mu) - penalty[:-1]*wz)
+        wz += step
+        if np.abs(step).max() < 1e-10: break
+    xP = x[perms] #b x n permuted feature
+    W = np.tile(np.append(wz, 0.0), (len(perms), 1))
+    for i in range(25):
+        eta = Z.dot(W[:, :-1].T).T + xP * W[:, -1:]
+        mu = expit(eta)
+        v = mu * (1 - mu)
+        r = y - mu
+        #b x (k+2) x (k+2) hessians, the feature being the last column
+        H = np.empty((len(perms), Z.shape[1] + 1, Z.shape[1] + 1))
+        H[:, :-1, :-1] = np.einsum('bn,ni,nj->bij', v, Z, Z)
+        H[:, :-1, -1] = H[:, -1, :-1] = (v * xP).dot(Z)
+        H[:, -1, -1] = (v * xP * xP).sum(axis=1)
+        H += np.diag(penalty)
+        g = np.column_stack([r.dot(Z), (r * xP).sum(axis=1)]) - penalty * W
+        step = np.linalg.solve(H, g[:, :, None])[:, :, 0]
+        W += step
+        if np.abs(step).max() < 1e-8: break
+    eta = Z.dot(W[:, :-1].T).T + xP * W[:, -1:]
+    return (rankdata(eta, axis=1).dot(y) - n1*(n1+1)/2.0) / (n1*n0)
+
+def permutationChecks(args):
+    """Counts the permutations of the last column (Xend) for which the auc of a logistic regression is above check
+
+    args is (Xc, Xend, y, check, numPerms), with Xc the controls (or None)"""
+    Xc, Xend, y, check, numPerms = args
+    rng = np.random.RandomState()
+    numRows = len(y)
+    batchSize = max(1, int(CORREL_BLOCK_CELLS / (numRows * (3 if Xc is None else Xc.shape[1] + 3))))
+    r = 0
+    for done in range(0, numPerms, batchSize):
+        perms = np.argsort(rng.rand(min(batchSize, numPerms - done), numRows), axis=1)
+        r += int((permutedAUCs(Xc, Xend, y, perms) > check).sum())
     return r
 
 def getGroupFreqThresh(correl_field=None):
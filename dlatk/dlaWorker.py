@@ -1,9 +1,17 @@
 import sys
+import os
 import time
+import hashlib
 import MySQLdb
 
 from . import dlaConstants as dlac
 from .mysqlmethods import mysqlMethods as mm 
+from .featureCache import tableVersion, tableTimes
+
+#(host, db, group counts table) => (version of the word table, {group_id: count}), see getGroupWordCounts
+_groupCounts = dict()
+#(host, db, word table) => (group counts table, version, create and update times of the word table), see _materializeGroupCounts
+_groupCountsTables = dict()
 
 class DLAWorker(object):
     """Generic class for functions working with features
@@ -45,7 +53,7 @@ class DLAWorker(object):
         self.messageid_field = messageid_field
         self.encoding = encoding
         self.use_unicode = use_unicode
-        (self.dbConn, self.dbCursor, self.dictCursor) = mm.dbConnect(corpdb, host=mysql_host, charset=encoding)
+        (self.dbConn, self.dbCursor, self.dictCursor) = mm.getConnection(corpdb, host=mysql_host, charset=encoding)
         self.lexicondb = lexicondb
         self.wordTable = wordTable if wordTable else "feat$1gram$%s$%s$16to16"%(self.corptable, self.correl_field)
         self.messageIdUniqueChecked = False
@@ -68,6 +76,26 @@ class DLAWorker(object):
         if not hasPrimary or not hasCorrelIndex:
             dlac.warn(warn_message)
 
+    def groupsCondition(self, groups, column = 'group_id'):
+        """Returns a sql condition restricting column to the given groups
+
+        Small sets are listed inline; large ones are joined against an indexed table of the groups
+        which is loaded once per run (see mm.groupIdCondition).
+
+        Parameters
+        ----------
+        groups : list
+            group ids to keep
+        column : :obj:`str`, optional
+            column holding the group ids
+
+        Returns
+        -------
+        str
+            condition such as " group_id in ('a','b')"
+        """
+        return mm.groupIdCondition(self.corpdb, groups, column = column, charset = self.encoding, use_unicode = self.use_unicode, host = self.mysql_host)
+
     def getMessages(self, messageTable = None, where = None):
         """?????
  
@@ -117,6 +145,54 @@ class DLAWorker(object):
         #return self._executeGetSSCursor(msql, warnMsg, host=self.mysql_host)
         return mm.executeGetList(self.corpdb, self.dbCursor, msql, warnMsg, charset=self.encoding)
 
+    def yieldMessagesByCorrelField(self, messageTable = None, where = None, warnMsg = True):
+        """Streams the message table once (server-side cursor, ordered by correl field) and yields the messages of each group
+
+        Parameters
+        ----------
+        messageTable : :obj:`str`, optional
+            name of message table.
+        where : :obj:`str`, optional
+            Filter messages with sql-style call.
+        warnMsg : :obj:`boolean`, optional
+            print the query.
+
+        Yields
+        ------
+        (cf_id, messageRows) : tuple
+            correl field id and a list of (message_id, message) rows for that id
+        """
+        if not messageTable: messageTable = self.corptable
+        if self.messageIdUniqueChecked == False:
+            self.checkIndices(messageTable, primary=True, correlField=self.messageid_field)
+            if self.correl_field != self.messageid_field:
+                self.checkIndices(messageTable, primary=False, correlField=self.correl_field)
+            self.messageIdUniqueChecked = True
+        msql = """SELECT %s, %s, %s FROM %s WHERE %s IS NOT NULL""" % (
+            self.correl_field, self.messageid_field, self.message_field, messageTable, self.correl_field)
+        if where: msql += " AND " + where
+        msql += """ ORDER BY %s""" % self.correl_field
+        ssCursor = mm.executeGetSSCursor(self.corpdb, msql, warnMsg, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host)
+
+        #flush a group whenever the correl field id changes:
+        cf_id = None
+        messageRows = []
+        for row in ssCursor:
+            if row[0] != cf_id:
+                if messageRows: yield (cf_id, messageRows)
+                cf_id = row[0]
+                messageRows = []
+            messageRows.append(row[1:])
+        if messageRows: yield (cf_id, messageRows)
+        ssCursor.close()
+
+    def countCorrelFieldIds(self, messageTable = None, where = None):
+        """Returns the number of distinct (non-null) correl field ids in the message table"""
+        if not messageTable: messageTable = self.corptable
+        sql = """SELECT COUNT(DISTINCT %s) FROM %s""" % (self.correl_field, messageTable)
+        if where: sql += " WHERE " + where
+        return mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)[0][0]
+
     def getMessagesWithFieldForCorrelField(self, cf_id, extraField, messageTable = None, warnMsg = True):
         """?????
  
@@ -282,15 +358,82 @@ class DLAWorker(object):
         where : :obj:`str`, optional
             Filter groups with sql-style call.
         lexicon_count_table : :obj:`str`, optional
-            ?????
+            word table to count instead of getWordTable()
      
         Returns
         -------
         dict
             {group_id: sum(values)}
+
+        Without a where, the counts are read from the group counts table of the word table
+        (see getGroupCountsTable) and kept in memory until the word table changes.
+        """
+        if where:
+            wordGetter = self.getWordGetter(lexicon_count_table)
+            return dict(wordGetter.getSumValuesByGroup(where))
+
+        if lexicon_count_table: dlac.warn(lexicon_count_table)
+        wordTable = self.getWordTable() if not lexicon_count_table else lexicon_count_table
+        assert mm.tableExists(self.corpdb, self.dbCursor, wordTable), "Need to create word table to use current functionality: %s" % wordTable
+        (countsTable, version) = self._materializeGroupCounts(wordTable)
+        key = (self.mysql_host, self.corpdb, countsTable)
+        if key not in _groupCounts or _groupCounts[key][0] != version:
+            sql = """SELECT group_id, value FROM %s""" % countsTable
+            _groupCounts[key] = (version, dict(mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)))
+        return dict(_groupCounts[key][1])
+
+    def getGroupCountsTable(self, wordTable = None):
+        """Returns the meta$groupcounts$ table holding the total count of each group in a word table
+
+        The table has the columns (group_id, value = sum of the group's values in wordTable). It is
+        built the first time it is needed and rebuilt whenever wordTable changes.
+
+        Parameters
+        ----------
+        wordTable : :obj:`str`, optional
+            word table to count; defaults to getWordTable()
+
+        Returns
+        -------
+        str
+            name of the group counts table
+        """
+        return self._materializeGroupCounts(wordTable or self.getWordTable())[0]
+
+    def _materializeGroupCounts(self, wordTable):
+        """Builds the group counts table of wordTable unless it is up to date; returns (table name, version of wordTable)
+
+        The version of wordTable the counts were taken from (see featureCache.tableVersion) is
+        kept as the comment of the counts table. The version is read once per process; after that
+        only the create and update times of wordTable are checked. The table is built under a name
+        of its own and swapped into place, so that runs building it at the same time do not clash.
         """
-        wordGetter = self.getWordGetter(lexicon_count_table)
-        return dict(wordGetter.getSumValuesByGroup(where))
+        key = (self.mysql_host, self.corpdb, wordTable)
+        times = tableTimes(self.corpdb, wordTable, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host)
+        if key in _groupCountsTables and _groupCountsTables[key][2] == times:
+            return _groupCountsTables[key][:2]
+
+        countsTable = dlac.GROUP_COUNTS_TABLE_PREFIX + (wordTable[len('feat$'):] if wordTable.startswith('feat$') else wordTable)
+        if len(countsTable) > 64: #longest table name mysql allows
+            countsTable = dlac.GROUP_COUNTS_TABLE_PREFIX + hashlib.md5(wordTable.encode('utf-8')).hexdigest()[:16]
+        version = '|'.join(str(v) for v in tableVersion(self.corpdb, wordTable, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host))
+        sql = """SELECT table_comment FROM information_schema.tables WHERE table_schema = '%s' AND table_name = '%s'""" % (self.corpdb, countsTable)
+        comment = mm.executeGetList(self.corpdb, self.dbCursor, sql, False, charset=self.encoding, use_unicode=self.use_unicode)
+        if not comment or comment[0][0] != version:
+            dlac.warn("Materializing group word counts of %s into %s" % (wordTable, countsTable))
+            newTable = countsTable[:64 - 12] + '$new%d' % os.getpid()
+            oldTable = countsTable[:64 - 12] + '$old%d' % os.getpid()
+            mm.execute(self.corpdb, self.dbCursor, "DROP TABLE IF EXISTS %s, %s" % (newTable, oldTable), charset=self.encoding, use_unicode=self.use_unicode)
+            sql = """CREATE TABLE %s (PRIMARY KEY (group_id)) ENGINE=%s COMMENT='%s' SELECT group_id, SUM(value) AS value FROM %s WHERE group_id IS NOT NULL GROUP BY group_id""" % (newTable, dlac.DEF_MYSQL_ENGINE, version, wordTable)
+            mm.execute(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)
+            #an empty, stale table to swap out if there is none yet (another run may make it first, which is fine)
+            sql = """CREATE TABLE IF NOT EXISTS %s ENGINE=%s COMMENT='' SELECT * FROM %s WHERE FALSE""" % (countsTable, dlac.DEF_MYSQL_ENGINE, newTable)
+            mm.execute(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)
+            #one atomic rename, so the counts table always exists and never holds partial counts
+            mm.execute(self.corpdb, self.dbCursor, "RENAME TABLE %s TO %s, %s TO %s" % (countsTable, oldTable, newTable, countsTable), charset=self.encoding, use_unicode=self.use_unicode)
+            mm.execute(self.corpdb, self.dbCursor, "DROP TABLE %s" % oldTable, charset=self.encoding, use_unicode=self.use_unicode)
+        _groupCountsTables[key] = (countsTable, version, times)
+        return (countsTable, version)
 
     def getTables(self, feat_table = False, like = None):
         """Returns a list of available tables.
@@ -454,7 +597,7 @@ class DLAWorker(object):
         else:
             print("making black or white list: [%s] [%s] [%s]" %([feat if isinstance(feat, str) else feat for feat in args_featlist], args_lextable, args_categories))
         if args_lextable:
-            (conn, cur, dcur) = mm.dbConnect(args_lexdb, charset=dlac.DEF_ENCODING, use_unicode=args_use_unicode)
+            (conn, cur, dcur) = mm.getConnection(args_lexdb, charset=dlac.DEF_ENCODING, use_unicode=args_use_unicode)
             sql = 'SELECT term FROM %s' % (args_lextable)
             if (len(args_categories) > 0) and args_categories[0] != '*':
                 sql = 'SELECT term FROM %s WHERE category in (%s)'%(args_lextable, ','.join(['\''+str(x)+'\'' for x in args_categories]))
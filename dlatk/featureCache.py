@@ -0,0 +1,378 @@
+"""
+Process-wide cache of feature tables held as sparse group x feature matrices
+
+A feature table is read once into a FeatureMatrix and then shared by every
+FeatureGetter asking for it. Tables are kept in least-recently-used order and
+evicted once the cache holds more than dlac.FEATURE_CACHE_GIGS gigabytes.
+
+Given a snapshot directory, the matrices are also saved as .npy files and
+memory-mapped by later runs for as long as the table does not change.
+"""
+import os
+import json
+import shutil
+import tempfile
+import numbers
+from collections import OrderedDict
+from collections.abc import Sequence
+from array import array
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from . import dlaConstants as dlac
+from .mysqlmethods import mysqlMethods as mm
+
+#bytes per feature table row while it is read: the four array('l'/'d') load buffers, the remapped
+#feature columns and the csr values and group norms being built (8 byte data, 4 byte indices each)
+LOAD_BYTES_PER_ROW = 4*8 + 8 + 2*(8+4)
+#bytes per row once held: csr and (from byFeat) csc copies of both values and group norms
+HELD_BYTES_PER_ROW = 2*2*(8+4)
+
+class FeatureMatrix(object):
+    """A feature table as sparse groups x feats matrices of values and group norms
+
+    Parameters
+    ----------
+    groups : list
+        group ids in row order
+    feats : list
+        features in column order
+    values : csr_matrix
+        groups x feats values
+    groupNorms : csr_matrix
+        groups x feats group norms
+    version : :obj:`tuple`, optional
+        version of the table the matrices were read from (see tableVersion)
+
+    Every row of the table is a stored entry (zeros included), so the sparsity
+    structure of the matrices is the set of (group_id, feat) rows of the table.
+    """
+
+    def __init__(self, groups, feats, values, groupNorms, version = None):
+        self.groups = groups
+        self.feats = feats
+        self.values = values
+        self.groupNorms = groupNorms
+        self.version = version
+        #group ids are matched as strings, as they are in the sql "group_id in ('...')" filters
+        self.groupIndex = dict((str(g), i) for i, g in enumerate(groups))
+        self.mapped = False #True when the csr arrays are memory-mapped from a snapshot
+        self._byFeat = None
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the matrices once byFeat has converted them (memory-mapped arrays excluded)
+
+        The csc copies are counted before they are made (at the size of the csr matrices they copy),
+        so the cache leaves room for them.
+        """
+        csrBytes = sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in (self.values, self.groupNorms))
+        cscBytes = sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in self._byFeat) if self._byFeat else csrBytes
+        return cscBytes if self.mapped else csrBytes + cscBytes
+
+    def byFeat(self):
+        """Returns (values, groupNorms) as csc matrices, converted once and kept"""
+        if self._byFeat is None:
+            self._byFeat = (self.values.tocsc(), self.groupNorms.tocsc())
+        return self._byFeat
+
+    def groupRows(self, groups):
+        """Returns the row indices of the given groups that are in the matrix"""
+        rows = (self.groupIndex.get(str(g)) for g in groups)
+        return np.array(list(dict.fromkeys(r for r in rows if r is not None)), dtype=int)
+
+    def restrictToGroups(self, groups = None):
+        """Returns (groupIds, values, groupNorms) as csc matrices holding only the given groups (all if groups is empty)"""
+        if not groups:
+            return (self.groups, ) + self.byFeat()
+        rows = self.groupRows(groups)
+        return ([self.groups[r] for r in rows], self.values[rows].tocsc(), self.groupNorms[rows].tocsc())
+
+    def iterFeats(self, groups = None, values = False):
+        """Yields (feat, {group_id: group_norm}) for each feature observed in the groups
+
+        or, if values is True, (feat, {group_id: value}, {group_id: group_norm})
+        """
+        (groupIds, vals, gns) = self.restrictToGroups(groups)
+        for j, feat in enumerate(self.feats):
+            (start, end) = (gns.indptr[j], gns.indptr[j+1])
+            if start == end: continue
+            gids = [groupIds[r] for r in gns.indices[start:end]]
+            gnDict = dict(zip(gids, gns.data[start:end].tolist()))
+            if values:
+                yield (feat, dict(zip(gids, vals.data[start:end].tolist())), gnDict)
+            else:
+                yield (feat, gnDict)
+
+    def alignRows(self, groups):
+        """Returns the group norms of the given groups as a csr matrix with one row per group, in their order
+
+        Groups that are not in the matrix get all-zero rows.
+        """
+        rows = np.fromiter((self.groupIndex.get(str(g), -1) for g in groups), dtype=int, count=len(groups))
+        present = np.nonzero(rows >= 0)[0]
+        select = csr_matrix((np.ones(len(present)), (present, rows[present])), shape=(len(rows), len(self.groups)))
+        return select.dot(self.groupNorms).tocsr()
+
+    def selectFeats(self, feats):
+        """Returns a FeatureMatrix holding only the given features, in their order"""
+        featIndex = dict((f, j) for j, f in enumerate(self.feats))
+        cols = [featIndex[f] for f in feats]
+        (vals, gns) = self.byFeat()
+        return FeatureMatrix(self.groups, list(feats), vals[:, cols].tocsr(), gns[:, cols].tocsr(), self.version)
+
+    def observedGroups(self):
+        """Returns the set of groups with at least one stored entry"""
+        counts = np.diff(self.groupNorms.indptr)
+        return set(self.groups[r] for r in np.nonzero(counts)[0])
+
+    def completeGroups(self):
+        """Returns the set of groups with a stored entry for every feature (as dense dicts are intersected)"""
+        counts = np.diff(self.groupNorms.indptr)
+        return set(self.groups[r] for r in np.nonzero(counts == len(self.feats))[0])
+
+    @classmethod
+    def fromDicts(cls, dicts, feats = None):
+        """Builds a FeatureMatrix from a list of {group_id: value} dicts, one per column
+
+        The values serve as both values and group norms (e.g. for outcome controls).
+        """
+        groupIndex = dict()
+        rows, cols, data = array('l'), array('l'), []
+        for c, column in enumerate(dicts):
+            for gid, value in column.items():
+                r = groupIndex.get(gid)
+                if r is None: r = groupIndex[gid] = len(groupIndex)
+                rows.append(r)
+                cols.append(c)
+                data.append(value)
+        assert all(isinstance(x, numbers.Number) for x in data), "Data is corrupt, there are non float elements in the group norms (some might be NULL?)"
+        rows = np.frombuffer(rows, dtype=rows.typecode) if rows else np.zeros(0, dtype=int)
+        cols = np.frombuffer(cols, dtype=cols.typecode) if cols else np.zeros(0, dtype=int)
+        m = csr_matrix((np.array(data, dtype=float), (rows, cols)), shape=(len(groupIndex), len(dicts)))
+        return cls(list(groupIndex), list(feats) if feats is not None else list(range(len(dicts))), m, m)
+
+    def featureCounts(self, groups = None):
+        """Returns a list of (feat, number of groups with the feat)"""
+        gns = self.restrictToGroups(groups)[2]
+        counts = np.diff(gns.indptr)
+        return [(self.feats[j], int(counts[j])) for j in np.nonzero(counts)[0]]
+
+    def sumValuesByFeat(self):
+        """Returns a list of (feat, sum of its values)"""
+        vals = self.byFeat()[0]
+        counts = np.diff(vals.indptr)
+        sums = np.asarray(vals.sum(axis=0)).ravel()
+        return [(self.feats[j], float(sums[j])) for j in np.nonzero(counts)[0]]
+
+
+def tableVersion(db, table, charset=dlac.DEF_ENCODING, use_unicode=dlac.DEF_UNICODE_SWITCH, host=dlac.MYSQL_HOST):
+    """Returns (row count, create time, update time) of a table, which changes whenever the table is rewritten"""
+    (dbConn, dbCursor, dictCursor) = mm.getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
+    numRows = mm.executeGetList(db, dbCursor, "SELECT COUNT(*) FROM %s" % table, False, charset=charset, use_unicode=use_unicode)[0][0]
+    return (numRows, ) + tableTimes(db, table, charset=charset, use_unicode=use_unicode, host=host)
+
+def tableTimes(db, table, charset=dlac.DEF_ENCODING, use_unicode=dlac.DEF_UNICODE_SWITCH, host=dlac.MYSQL_HOST):
+    """Returns (create time, update time) of a table from information_schema, without reading the table"""
+    (dbConn, dbCursor, dictCursor) = mm.getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
+    sql = """SELECT create_time, update_time FROM information_schema.tables WHERE table_schema = '%s' AND table_name = '%s'""" % (db, table)
+    times = mm.executeGetList(db, dbCursor, sql, False, charset=charset, use_unicode=use_unicode)
+    return tuple(times[0] if times else (None, None))
+
+def loadFeatureMatrix(db, table, charset=dlac.DEF_ENCODING, use_unicode=dlac.DEF_UNICODE_SWITCH, host=dlac.MYSQL_HOST, version = None, where = ''):
+    """Reads a whole feature table (or the rows matching where) into a FeatureMatrix with one server-side cursor"""
+    sql = """SELECT group_id, feat, value, group_norm FROM %s""" % table
+    if where: sql += ' WHERE ' + where
+    ssCursor = mm.executeGetSSCursor(db, sql, charset=charset, use_unicode=use_unicode, host=host)
+    groupIndex, featIndex = dict(), dict()
+    rows, cols, vals, gns = array('l'), array('l'), array('d'), array('d')
+    for (gid, feat, value, gn) in ssCursor:
+        r = groupIndex.get(gid)
+        if r is None: r = groupIndex[gid] = len(groupIndex)
+        c = featIndex.get(feat)
+        if c is None: c = featIndex[feat] = len(featIndex)
+        rows.append(r)
+        cols.append(c)
+        vals.append(value if value is not None else 0)
+        gns.append(gn if gn is not None else 0)
+
+    #features in sorted order, so that matrices do not depend on the order the rows were read in
+    feats = sorted(featIndex, key=lambda f: (f is None, f))
+    newCol = np.empty(len(feats), dtype=int)
+    for j, feat in enumerate(feats):
+        newCol[featIndex[feat]] = j
+    rows = np.frombuffer(rows, dtype=rows.typecode) if rows else np.zeros(0, dtype=int)
+    cols = newCol[np.frombuffer(cols, dtype=cols.typecode)] if cols else np.zeros(0, dtype=int)
+    shape = (len(groupIndex), len(feats))
+    return FeatureMatrix(list(groupIndex), feats,
+                         csr_matrix((np.frombuffer(vals) if vals else np.zeros(0), (rows, cols)), shape=shape),
+                         csr_matrix((np.frombuffer(gns) if gns else np.zeros(0), (rows, cols)), shape=shape),
+                         version)
+
+
+## Snapshots ##
+
+SNAPSHOT_FORMAT = 2
+
+class StringTable(Sequence):
+    """Read-only sequence of strings held as one encoded blob and the offsets of each string
+
+    Strings are decoded when they are accessed, so a memory-mapped vocabulary of millions of
+    features costs nothing to open. With encoding None the items are returned as bytes.
+    """
+
+    def __init__(self, offsets, blob, encoding = 'utf-8'):
+        self.offsets = offsets
+        self.blob = blob
+        self.encoding = encoding
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("string table index out of range")
+        item = self.blob[self.offsets[i]:self.offsets[i+1]].tobytes()
+        return item.decode(self.encoding) if self.encoding else item
+
+def _stringsKind(strings):
+    """Returns 'str' or 'bytes' if all of the strings are of that type, otherwise None"""
+    for (kind, cls) in (('str', str), ('bytes', bytes)):
+        if all(isinstance(x, cls) for x in strings):
+            return kind
+    return None
+
+def _saveStrings(path, name, strings, kind):
+    """Writes strings as name.npy (utf-8 blob, or the raw bytes) and name_offsets.npy"""
+    encoded = [x.encode('utf-8') for x in strings] if kind == 'str' else list(strings)
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    np.save(os.path.join(path, name + '_offsets.npy'), offsets)
+    np.save(os.path.join(path, name + '.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+def _loadStrings(path, name, kind):
+    load = lambda fileName: np.load(os.path.join(path, fileName), mmap_mode='r')
+    return StringTable(load(name + '_offsets.npy'), load(name + '.npy'), 'utf-8' if kind == 'str' else None)
+
+def snapshotPath(snapshotDir, db, table, host=dlac.MYSQL_HOST):
+    """Returns the directory holding the snapshot of a table"""
+    return os.path.join(snapshotDir, host, db, table)
+
+def _versionKey(version):
+    return [str(v) for v in version]
+
+def saveSnapshot(fm, path):
+    """Writes a FeatureMatrix as .npy arrays and a json index into path (replacing any older snapshot)
+
+    Files: indptr.npy, indices.npy, values.npy, group_norms.npy (the csr arrays, the structure being
+    shared by values and group norms), feats.npy and feats_offsets.npy (a string table, see StringTable),
+    groups.npy (int64 group ids, or a string table with groups_offsets.npy) and meta.json (format,
+    table version, shape and the types of the features and group ids).
+    """
+    featsKind = _stringsKind(fm.feats)
+    groupsKind = 'int' if all(isinstance(g, numbers.Integral) for g in fm.groups) else _stringsKind(fm.groups)
+    if featsKind is None or groupsKind is None:
+        dlac.warn("Not saving a snapshot of a feature table with NULL or mixed type features or group ids")
+        return False
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent): os.makedirs(parent)
+    tmpPath = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+    np.save(os.path.join(tmpPath, 'indptr.npy'), fm.values.indptr)
+    np.save(os.path.join(tmpPath, 'indices.npy'), fm.values.indices)
+    np.save(os.path.join(tmpPath, 'values.npy'), fm.values.data)
+    np.save(os.path.join(tmpPath, 'group_norms.npy'), fm.groupNorms.data)
+    _saveStrings(tmpPath, 'feats', fm.feats, featsKind)
+    if groupsKind == 'int':
+        np.save(os.path.join(tmpPath, 'groups.npy'), np.array(fm.groups, dtype=np.int64))
+    else:
+        _saveStrings(tmpPath, 'groups', fm.groups, groupsKind)
+    with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+        json.dump({'format': SNAPSHOT_FORMAT, 'version': _versionKey(fm.version), 'shape': list(fm.values.shape),
+                   'feats': featsKind, 'groups': groupsKind}, f)
+    if os.path.isdir(path): shutil.rmtree(path)
+    os.rename(tmpPath, path)
+    return True
+
+def loadSnapshot(path, version):
+    """Memory-maps the snapshot in path as a FeatureMatrix; returns None if there is none for this version of the table
+
+    Features are left in their memory-mapped string table and decoded as they are used; group ids
+    are read back with the type they were saved with.
+    """
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if meta.get('format') != SNAPSHOT_FORMAT or meta['version'] != _versionKey(version):
+        return None
+    load = lambda name: np.load(os.path.join(path, name), mmap_mode='r')
+    (indptr, indices) = (load('indptr.npy'), load('indices.npy'))
+    shape = tuple(meta['shape'])
+    if meta['groups'] == 'int':
+        groups = load('groups.npy').tolist()
+    else:
+        groups = list(_loadStrings(path, 'groups', meta['groups']))
+    fm = FeatureMatrix(groups, _loadStrings(path, 'feats', meta['feats']),
+                       csr_matrix((load('values.npy'), indices, indptr), shape=shape, copy=False),
+                       csr_matrix((load('group_norms.npy'), indices, indptr), shape=shape, copy=False),
+                       version)
+    fm.mapped = True
+    return fm
+
+
+_cache = OrderedDict()
+
+def getFeatureMatrix(db, table, charset=dlac.DEF_ENCODING, use_unicode=dlac.DEF_UNICODE_SWITCH, host=dlac.MYSQL_HOST, maxGigs = None, snapshotDir = None):
+    """Returns the FeatureMatrix of a table, from the cache when the table has not changed since it was read
+
+    With a snapshotDir, a saved snapshot of the same version of the table is memory-mapped
+    instead of reading the table, and a table that has to be read is saved for later runs.
+
+    Returns None, without reading the table, when it would not fit in maxGigs
+    (default dlac.FEATURE_CACHE_GIGS); callers then fall back to querying the table.
+    Older tables are evicted before reading so that the memory used while reading
+    (LOAD_BYTES_PER_ROW) also stays within maxGigs.
+    """
+    maxBytes = (dlac.FEATURE_CACHE_GIGS if maxGigs is None else maxGigs) * 1024**3
+    key = (host, db, table)
+    version = tableVersion(db, table, charset=charset, use_unicode=use_unicode, host=host)
+    fm = _cache.pop(key, None)
+    if fm is not None and fm.version == version:
+        _cache[key] = fm #most recently used
+        return fm
+
+    path = snapshotPath(snapshotDir, db, table, host) if snapshotDir else None
+    fm = loadSnapshot(path, version) if path else None
+    if fm is not None:
+        dlac.warn("Using snapshot of feature table %s from %s" % (table, path))
+    else:
+        loadBytes = version[0] * max(LOAD_BYTES_PER_ROW, HELD_BYTES_PER_ROW)
+        if loadBytes > maxBytes:
+            return None
+        evict(maxBytes - loadBytes, keepNewest = False)
+        dlac.warn("Caching feature table %s (%d rows) as a sparse matrix" % (table, version[0]))
+        fm = loadFeatureMatrix(db, table, charset=charset, use_unicode=use_unicode, host=host, version=version)
+        if path and saveSnapshot(fm, path):
+            dlac.warn("Saved snapshot of feature table %s to %s" % (table, path))
+            fm = loadSnapshot(path, version) or fm #use the mapped arrays rather than holding a copy
+    _cache[key] = fm
+    evict(maxBytes)
+    return fm
+
+def evict(maxBytes, keepNewest = True):
+    """Drops least recently used tables until the cache holds at most maxBytes (see FeatureMatrix.nbytes)
+
+    The most recently used table is kept unless keepNewest is False.
+    """
+    while len(_cache) > (1 if keepNewest else 0) and sum(fm.nbytes for fm in _cache.values()) > maxBytes:
+        (key, fm) = _cache.popitem(last = False)
+        dlac.warn("Evicting feature table %s from the cache" % key[2])
+
+def clear():
+    """Empties the cache"""
+    _cache.clear()
@@ -4,10 +4,11 @@ import sys
 import csv
 import gzip
 import datetime
-from pprint import pprint
 from dateutil.parser import parse as dtParse
 from collections import Counter
 import traceback
+import multiprocessing
+from itertools import islice
 from xml.dom.minidom import parseString as xmlParseString
 from datetime import timedelta
 
@@ -15,6 +16,7 @@ from datetime import timedelta
 from math import floor, log10
 from numpy import mean, std
 import numpy as np
+from scipy.sparse import csr_matrix, vstack
 #import imp
 
 #nltk
@@ -50,6 +52,75 @@ offsetre = re.compile(r'p(\-?\d+)([a-z])')
 toffsetre = re.compile(r'pt(\-?\d+)([a-z])')
 TimexDateTimeTypes = frozenset(['date', 'time'])
 
+_tokenizers = dict() #use_unicode => Tokenizer, one per (worker) process
+
+def countGroupNGrams(args):
+    """Counts the n-grams in the messages of one group (module level so it can be run by a multiprocessing.Pool)
+
+    Parameters
+    ----------
+    args : tuple
+        (cf_id, messageRows, n, unit, lowercase_only, varcharLength, use_unicode) where messageRows is a
+        list of (message_id, message) and unit is 'word' (tokenize messages), 'char' (character n-grams)
+        or 'tok' (messages are already JSON lists of tokens)
+
+    Returns
+    -------
+    tuple
+        (cf_id, freqs, totalGrams, totalChars, numMsgs)
+    """
+    (cf_id, messageRows, n, unit, lowercase_only, varcharLength, use_unicode) = args
+    if unit == 'word':
+        try:
+            tokenizer = _tokenizers[use_unicode]
+        except KeyError:
+            tokenizer = _tokenizers[use_unicode] = Tokenizer(use_unicode=use_unicode)
+
+    mids = set() #currently seen message ids
+    freqs = dict() #holds frequency of n-grams
+    totalGrams = 0 #total number of (non-distinct) n-grams seen for this user
+    totalChars = 0
+    for messageRow in messageRows:
+        message_id = messageRow[0]
+        message = messageRow[1]
+        if not message_id in mids and message:
+            if unit == 'tok':
+                try:
+                    words = json.loads(message)
+                except ValueError as e:
+                    raise ValueError(str(e)+"Your message table is either not tokenized (use --add_ngrams) or there might be something else wrong.")
+            else:
+                message = tc.treatNewlines(message)
+                message = tc.shrinkSpace(message)
+                if unit == 'char':
+                    words = list(message)
+                else:
+                    words = tokenizer.tokenize(message)
+                if use_unicode:
+                    words = [tc.removeNonUTF8(w) for w in words]
+                else:
+                    words = [tc.removeNonAscii(w) for w in words]
+
+            gram = '' ## MAARTEN
+            for i in range(0,(len(words) - n)+1):
+                totalGrams += 1
+                gram = ' '.join(words[i:i+n])
+                #truncate:
+                gram = gram[:varcharLength]
+                if lowercase_only: gram = gram.lower()
+
+                try:
+                    freqs[gram] += 1
+                except KeyError:
+                    freqs[gram] = 1
+
+                totalChars += len(gram)
+            mids.add(message_id)
+            # why is this in here?
+            totalChars += len(gram)
+
+    return (cf_id, freqs, totalGrams, totalChars, len(mids))
+
 class FeatureExtractor(DLAWorker):
     """Deals with extracting features from text and writing tables of features
 
@@ -65,6 +136,8 @@ class FeatureExtractor(DLAWorker):
     ...     fe.addNGramTable(n=n)
     """
 
+    bulkLoad = False #write feature tables with LOAD DATA LOCAL INFILE rather than batched INSERTs
+
     ##INSTANCE METHODS##
 
     def addTopicLexFromTopicFile(self, topicfile, newtablename, topiclexmethod, threshold):
@@ -99,7 +172,7 @@ class FeatureExtractor(DLAWorker):
 
     ##Feature Tables ##
 
-    def addNGramTable(self, n, lowercase_only=dlac.LOWERCASE_ONLY, min_freq=1, tableName = None, valueFunc = lambda d: d, metaFeatures = True, extension = None):
+    def addNGramTable(self, n, lowercase_only=dlac.LOWERCASE_ONLY, min_freq=1, tableName = None, valueFunc = lambda d: d, metaFeatures = True, extension = None, streaming = False, cores = 1):
         """Creates feature tuples (correl_field, feature, values) table where features are ngrams
 
         Parameters
@@ -116,6 +189,11 @@ class FeatureExtractor(DLAWorker):
             Scales the features by the function given
         metaFeatures : :obj:`boolean`, optional
             ?????
+        streaming : :obj:`boolean`, optional
+            read the message table once with a server-side cursor ordered by correl field,
+            rather than querying the messages of each group separately
+        cores : :obj:`int`, optional
+            number of worker processes used to tokenize and count n-grams (1 = serial)
 
         Returns
         -------
@@ -123,7 +201,6 @@ class FeatureExtractor(DLAWorker):
             Name of n-gram table: feat%ngram%corptable%correl_field%transform
         """
         ##NOTE: correl_field should have an index for this to be quick
-        tokenizer = Tokenizer(use_unicode=self.use_unicode)
 
         #debug:
         #print "valueFunc(30) = %f" % valueFunc(float(30)) #debug
@@ -133,122 +210,18 @@ class FeatureExtractor(DLAWorker):
         varcharLength = min((dlac.VARCHAR_WORD_LENGTH-(n-1))*n, 255)
         featureTableName = self.createFeatureTable(featureName, "VARCHAR(%d)"%varcharLength, 'INTEGER', tableName, valueFunc, extension = extension)
 
+        mfTableName = None
         if metaFeatures:
             # If metafeats is on, make a metafeature table as well
             mfLength = 16
             mfName = "meta_"+featureName
             mfTableName = self.createFeatureTable(mfName, "VARCHAR(%d)" % mfLength, 'INTEGER', tableName, valueFunc, extension = extension)
 
-        #SELECT / LOOP ON CORREL FIELD FIRST:
-        usql = """SELECT %s FROM %s GROUP BY %s""" % (
-            self.correl_field, self.corptable, self.correl_field)
-        msgs = 0 # keeps track of the number of messages read
-        cfRows = FeatureExtractor.noneToNull(mm.executeGetList(self.corpdb, self.dbCursor, usql, charset=self.encoding, use_unicode=self.use_unicode))#SSCursor woudl be better, but it loses connection
-        dlac.warn("finding messages for %d '%s's"%(len(cfRows), self.correl_field))
-        if len(cfRows)*n < dlac.MAX_TO_DISABLE_KEYS: mm.disableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#for faster, when enough space for repair by sorting
-
-        #warnedMaybeForeignLanguage = False
-        for cfRow in cfRows:
-            cf_id = cfRow[0]
-
-            mids = set() #currently seen message ids
-            freqs = dict() #holds frequency of n-grams
-            totalGrams = 0 #total number of (non-distinct) n-grams seen for this user
-            totalChars = 0
-
-            #grab n-grams by messages for that cf:
-
-            for messageRow in self.getMessagesForCorrelField(cf_id, warnMsg = False):
-                message_id = messageRow[0]
-                message = messageRow[1]
-                if not message_id in mids and message:
-                    msgs+=1
-                    if msgs % dlac.PROGRESS_AFTER_ROWS == 0: #progress update
-                        dlac.warn("Messages Read: %dk" % int(msgs/1000))
-                    message = tc.treatNewlines(message)
-                    message = tc.shrinkSpace(message)
-
-                    #words = message.split()
-                    if not self.use_unicode:
-                        words = [tc.removeNonAscii(w) for w in tokenizer.tokenize(message)]
-                    else:
-                        words = [tc.removeNonUTF8(w) for w in tokenizer.tokenize(message)]
-
-                    gram = '' ## MAARTEN
-                    for i in range(0,(len(words) - n)+1):
-                        totalGrams += 1
-                        gram = ' '.join(words[i:i+n])
-                        #truncate:
-                        gram = gram[:varcharLength]
-
-                        if lowercase_only: gram = gram.lower()
-
-                        try:
-                            freqs[gram] += 1
-                        except KeyError:
-                            freqs[gram] = 1
-
-                        if metaFeatures:
-                            totalChars += len(gram)
-                    mids.add(message_id)
-                    if metaFeatures:
-                        # why is this in here?
-                        totalChars += len(gram)
-
-            #write n-grams to database (no need for "REPLACE" because we are creating the table)
-            if totalGrams:
-                insert_idx_start = 0
-                insert_idx_end = dlac.MYSQL_BATCH_INSERT_SIZE
-                wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
-                totalGrams = float(totalGrams) # to avoid casting each time below
-                try:
-                    if self.use_unicode:
-                        rows = [(k, v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                    else:
-                        rows = [(k.encode('utf-8'), v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                except:
-                    print([k for k, v in freqs.items()])
-                    sys.exit()
-                while insert_idx_start < len(rows):
-                    insert_rows = rows[insert_idx_start:min(insert_idx_end, len(rows))]
-                    #_warn("Inserting rows %d to %d... " % (insert_idx_start, insert_idx_end))
-                    mm.executeWriteMany(self.corpdb, self.dbCursor, wsql, insert_rows, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode);
-                    insert_idx_start += dlac.MYSQL_BATCH_INSERT_SIZE
-                    insert_idx_end += dlac.MYSQL_BATCH_INSERT_SIZE
-
-
-
-                wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
-                totalGrams = float(totalGrams) # to avoid casting each time below
-                if self.use_unicode:
-                    rows = [(k, v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                else:
-                    rows = [(k.encode('utf-8'), v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-
-                if metaFeatures:
-                    mfRows = []
-                    mfwsql = """INSERT INTO """+mfTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
-                    avgGramLength = totalChars / totalGrams
-                    lenmids=len(mids)
-                    avgGramsPerMsg = totalGrams / lenmids
-                    mfRows.append( ('_avg'+str(n)+'gramLength', avgGramLength, valueFunc(avgGramLength)) )
-                    mfRows.append( ('_avg'+str(n)+'gramsPerMsg', avgGramsPerMsg, valueFunc(avgGramsPerMsg)) )
-                    mfRows.append( ('_total'+str(n)+'grams', totalGrams, valueFunc(totalGrams)) )
-                    mfRows.append( ('_totalMsgs', lenmids, valueFunc(lenmids)) )
-                    mm.executeWriteMany(self.corpdb, self.dbCursor, mfwsql, mfRows, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode)
-
-                # mm.executeWriteMany(self.corpdb, self.dbCursor, wsql, rows, writeCursor=self.dbConn.cursor(), charset=self.encoding)
-
-        dlac.warn("Done Reading / Inserting.")
-
-        if len(cfRows)*n < dlac.MAX_TO_DISABLE_KEYS:
-            dlac.warn("Adding Keys (if goes to keycache, then decrease MAX_TO_DISABLE_KEYS or run myisamchk -n).")
-            mm.enableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#rebuilds keys
-        dlac.warn("Done\n")
+        self._insertNGramFeats(n, 'word', featureTableName, mfTableName, varcharLength, lowercase_only, min_freq, valueFunc, streaming, cores, totalMsgsFeat = True)
         return featureTableName
 
 
-    def addCharNGramTable(self, n, lowercase_only=dlac.LOWERCASE_ONLY, min_freq=1, tableName = None, valueFunc = lambda d: d, metaFeatures = True):
+    def addCharNGramTable(self, n, lowercase_only=dlac.LOWERCASE_ONLY, min_freq=1, tableName = None, valueFunc = lambda d: d, metaFeatures = True, streaming = False, cores = 1):
         """Extract character ngrams from a message table
 
         Parameters
@@ -265,6 +238,11 @@ class FeatureExtractor(DLAWorker):
             Scales the features by the function given
         metaFeatures : :obj:`boolean`, optional
             ?????
+        streaming : :obj:`boolean`, optional
+            read the message table once with a server-side cursor ordered by correl field,
+            rather than querying the messages of each group separately
+        cores : :obj:`int`, optional
+            number of worker processes used to count n-grams (1 = serial)
 
         Returns
         -------
@@ -272,125 +250,24 @@ class FeatureExtractor(DLAWorker):
             Name of n-gram table: feat%nCgram%corptable%correl_field%transform
         """
         ##NOTE: correl_field should have an index for this to be quick
-        #tokenizer = Tokenizer(use_unicode=self.use_unicode)
-
-        #debug:
-        #print "valueFunc(30) = %f" % valueFunc(float(30)) #debug
 
         #CREATE TABLE:
         featureName = str(n)+'Cgram'
         varcharLength = min((dlac.VARCHAR_WORD_LENGTH-(n-1))*n, 255)
         featureTableName = self.createFeatureTable(featureName, "VARCHAR(%d)"%varcharLength, 'INTEGER', tableName, valueFunc)
 
+        mfTableName = None
         if metaFeatures:
             # If metafeats is on, make a metafeature table as well
             mfLength = 16
             mfName = "meta_"+featureName
             mfTableName = self.createFeatureTable(mfName, "VARCHAR(%d)" % mfLength, 'INTEGER', tableName, valueFunc)
 
-        #SELECT / LOOP ON CORREL FIELD FIRST:
-        usql = """SELECT %s FROM %s GROUP BY %s""" % (
-            self.correl_field, self.corptable, self.correl_field)
-        msgs = 0 # keeps track of the number of messages read
-        cfRows = FeatureExtractor.noneToNull(mm.executeGetList(self.corpdb, self.dbCursor, usql, charset=self.encoding, use_unicode=self.use_unicode))#SSCursor woudl be better, but it loses connection
-        dlac.warn("finding messages for %d '%s's"%(len(cfRows), self.correl_field))
-        if len(cfRows)*n < dlac.MAX_TO_DISABLE_KEYS: mm.disableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#for faster, when enough space for repair by sorting
-
-        #warnedMaybeForeignLanguage = False
-        for cfRow in cfRows:
-            cf_id = cfRow[0]
-
-            mids = set() #currently seen message ids
-            freqs = dict() #holds frequency of n-grams
-            totalGrams = 0 #total number of (non-distinct) n-grams seen for this user
-            totalChars = 0
-
-            #grab n-grams by messages for that cf:
-
-            for messageRow in self.getMessagesForCorrelField(cf_id, warnMsg = False):
-                message_id = messageRow[0]
-                message = messageRow[1]
-                if not message_id in mids and message:
-                    msgs+=1
-                    if msgs % dlac.PROGRESS_AFTER_ROWS == 0: #progress update
-                        dlac.warn("Messages Read: %dk" % int(msgs/1000))
-                    message = tc.treatNewlines(message)
-                    message = tc.shrinkSpace(message)
-
-                    #words = message.split()
-                    if self.use_unicode:
-                        words = [tc.removeNonUTF8(w) for w in list(message)]
-                    else:
-                        words = [tc.removeNonAscii(w) for w in list(message)]
-
-                    gram = '' ## MAARTEN
-                    for i in range(0,(len(words) - n)+1):
-                        totalGrams += 1
-                        gram = ' '.join(words[i:i+n])
-                        #truncate:
-                        gram = gram[:varcharLength]
-                        if lowercase_only: gram = gram.lower()
-
-                        try:
-                            freqs[gram] += 1
-                        except KeyError:
-                            freqs[gram] = 1
-
-                        if metaFeatures:
-                            totalChars += len(gram)
-                    mids.add(message_id)
-                    if metaFeatures:
-                        # why is this in here?
-                        totalChars += len(gram)
-
-            #write n-grams to database (no need for "REPLACE" because we are creating the table)
-            if totalGrams:
-                insert_idx_start = 0
-                insert_idx_end = dlac.MYSQL_BATCH_INSERT_SIZE
-                wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
-                totalGrams = float(totalGrams) # to avoid casting each time below
-                if self.use_unicode:
-                    rows = [(k, v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                else:
-                    rows = [(k.encode('utf-8'), v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-
-                while insert_idx_start < len(rows):
-                    insert_rows = rows[insert_idx_start:min(insert_idx_end, len(rows))]
-                    #_warn("Inserting rows %d to %d... " % (insert_idx_start, insert_idx_end))
-                    mm.executeWriteMany(self.corpdb, self.dbCursor, wsql, insert_rows, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode);
-                    insert_idx_start += dlac.MYSQL_BATCH_INSERT_SIZE
-                    insert_idx_end += dlac.MYSQL_BATCH_INSERT_SIZE
-
-
-
-                wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
-                totalGrams = float(totalGrams) # to avoid casting each time below
-                if self.use_unicode:
-                    rows = [(k, v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                else:
-                    rows = [(k.encode('utf-8'), v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                if metaFeatures:
-                    mfRows = []
-                    mfwsql = """INSERT INTO """+mfTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
-                    avgGramLength = totalChars / totalGrams
-                    avgGramsPerMsg = totalGrams / len(mids)
-                    mfRows.append( ('_avg'+str(n)+'gramLength', avgGramLength, valueFunc(avgGramLength)) )
-                    mfRows.append( ('_avg'+str(n)+'gramsPerMsg', avgGramsPerMsg, valueFunc(avgGramsPerMsg)) )
-                    mfRows.append( ('_total'+str(n)+'grams', totalGrams, valueFunc(totalGrams)) )
-                    mm.executeWriteMany(self.corpdb, self.dbCursor, mfwsql, mfRows, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode)
-
-                # mm.executeWriteMany(self.corpdb, self.dbCursor, wsql, rows, writeCursor=self.dbConn.cursor(), charset=self.encoding)
-
-        dlac.warn("Done Reading / Inserting.")
-
-        if len(cfRows)*n < dlac.MAX_TO_DISABLE_KEYS:
-            dlac.warn("Adding Keys (if goes to keycache, then decrease MAX_TO_DISABLE_KEYS or run myisamchk -n).")
-            mm.enableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#rebuilds keys
-        dlac.warn("Done\n")
+        self._insertNGramFeats(n, 'char', featureTableName, mfTableName, varcharLength, lowercase_only, min_freq, valueFunc, streaming, cores)
         return featureTableName
 
 
-    def addNGramTableFromTok(self, n, lowercase_only=dlac.LOWERCASE_ONLY, min_freq=1, tableName = None, valueFunc = lambda d: d, metaFeatures = True):
+    def addNGramTableFromTok(self, n, lowercase_only=dlac.LOWERCASE_ONLY, min_freq=1, tableName = None, valueFunc = lambda d: d, metaFeatures = True, streaming = False, cores = 1):
         """???
 
         Parameters
@@ -407,6 +284,11 @@ class FeatureExtractor(DLAWorker):
             Scales the features by the function given
         metaFeatures : :obj:`boolean`, optional
             ?????
+        streaming : :obj:`boolean`, optional
+            read the message table once with a server-side cursor ordered by correl field,
+            rather than querying the messages of each group separately
+        cores : :obj:`int`, optional
+            number of worker processes used to count n-grams (1 = serial)
 
         Returns
         -------
@@ -415,102 +297,107 @@ class FeatureExtractor(DLAWorker):
         """
         ##NOTE: correl_field should have an index for this to be quick
 
-        #debug:
-        #print "valueFunc(30) = %f" % valueFunc(float(30)) #debug
-
-
         #CREATE TABLE:
         featureName = str(n)+'gram'
         varcharLength = min((dlac.VARCHAR_WORD_LENGTH-(n-1))*n, 255)
         featureTableName = self.createFeatureTable(featureName, "VARCHAR(%d)"%varcharLength, 'INTEGER', tableName, valueFunc)
 
+        mfTableName = None
         if metaFeatures:
             # If metafeats is on, make a metafeature table as well
             mfLength = 16
             mfName = "meta_"+featureName
             mfTableName = self.createFeatureTable(mfName, "VARCHAR(%d)" % mfLength, 'INTEGER', tableName, valueFunc)
 
-        #SELECT / LOOP ON CORREL FIELD FIRST:
-        usql = """SELECT %s FROM %s GROUP BY %s""" % (
-            self.correl_field, self.corptable, self.correl_field)
-        msgs = 0 # keeps track of the number of messages read
-        cfRows = FeatureExtractor.noneToNull(mm.executeGetList(self.corpdb, self.dbCursor, usql, charset=self.encoding, use_unicode=self.use_unicode))#SSCursor woudl be better, but it loses connection
-        dlac.warn("finding messages for %d '%s's"%(len(cfRows), self.correl_field))
-        if len(cfRows)*n < dlac.MAX_TO_DISABLE_KEYS: mm.disableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#for faster, when enough space for repair by sorting
-
-        for cfRow in cfRows:
-            cf_id = cfRow[0]
-
-            mids = set() #currently seen message ids
-            freqs = dict() #holds frequency of n-grams
-            totalGrams = 0 #total number of (non-distinct) n-grams seen for this user
-            totalChars = 0
+        self._insertNGramFeats(n, 'tok', featureTableName, mfTableName, varcharLength, lowercase_only, min_freq, valueFunc, streaming, cores)
+        return featureTableName
 
-            #grab n-grams by messages for that cf:
-            for messageRow in self.getMessagesForCorrelField(cf_id, warnMsg = False):
-                message_id = messageRow[0]
-                json_tokens = messageRow[1]
-                if not message_id in mids and json_tokens:
-                    msgs+=1
-                    if msgs % dlac.PROGRESS_AFTER_ROWS == 0: #progress update
-                        dlac.warn("Messages Read: %dk" % int(msgs/1000))
+    def _insertNGramFeats(self, n, unit, featureTableName, mfTableName, varcharLength, lowercase_only, min_freq, valueFunc, streaming = False, cores = 1, totalMsgsFeat = False):
+        """Counts the n-grams of every group and writes them (and optionally meta features) to the given tables
 
-                    words = None
-                    try:
-                        words = json.loads(json_tokens)
-                    except ValueError as e:
-                        raise ValueError(str(e)+"Your message table is either not tokenized (use --add_ngrams) or there might be something else wrong.")
-
-                    gram = '' ## MAARTEN
-                    for i in range(0,(len(words) - n)+1):
-                        totalGrams += 1
-                        gram = ' '.join(words[i:i+n])
-                        #truncate:
-                        gram = gram[:varcharLength]
-                        if lowercase_only: gram = gram.lower()
+        Counting runs in `cores` worker processes when cores > 1; this process stays the only
+        reader of the message table and the only writer, and groups are written in the same
+        order as the serial path so the resulting tables are identical.
 
-                        try:
-                            freqs[gram] += 1
-                        except KeyError:
-                            freqs[gram] = 1
+        Parameters
+        ----------
+        n : int
+            n of the n-grams
+        unit : str
+            'word' (tokenize messages), 'char' (characters) or 'tok' (messages are JSON token lists)
+        featureTableName : str
+            table to write n-grams to
+        mfTableName : str
+            table to write meta features to (None to skip)
+        totalMsgsFeat : :obj:`boolean`, optional
+            add the _totalMsgs meta feature
+        """
+        (numGroups, cfMessages) = self._getMessagesByCorrelField(streaming)
+        if numGroups*n < dlac.MAX_TO_DISABLE_KEYS: mm.disableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#for faster, when enough space for repair by sorting
 
-                        if metaFeatures:
-                            totalChars += len(gram)
-                    mids.add(message_id)
-                    if metaFeatures:
-                        # why is this in here?
-                        totalChars += len(gram)
+        featWriter = self.getFeatureWriter(featureTableName)
+        mfWriter = self.getFeatureWriter(mfTableName) if mfTableName else None
+        countArgs = ((cf_id, messageRows, n, unit, lowercase_only, varcharLength, self.use_unicode) for (cf_id, messageRows) in cfMessages)
+        msgs = 0 # keeps track of the number of messages read
+        for (cf_id, freqs, totalGrams, totalChars, numMsgs) in FeatureExtractor._mapGroups(countGroupNGrams, countArgs, cores):
+            if int((msgs + numMsgs)/dlac.PROGRESS_AFTER_ROWS) > int(msgs/dlac.PROGRESS_AFTER_ROWS): #progress update
+                dlac.warn("Messages Read: %dk" % int((msgs + numMsgs)/1000))
+            msgs += numMsgs
 
             #write n-grams to database (no need for "REPLACE" because we are creating the table)
-            #pprint(freqs)
             if totalGrams:
-                wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
+                cf_id = str(cf_id)
                 totalGrams = float(totalGrams) # to avoid casting each time below
                 if self.use_unicode:
-                    rows = [(k, v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
+                    rows = [(cf_id, k, v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
                 else:
-                    rows = [(k.encode('utf-8'), v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
-                if metaFeatures:
+                    rows = [(cf_id, k.encode('utf-8'), v, valueFunc((v / totalGrams))) for k, v in freqs.items() if v >= min_freq] #adds group_norm and applies freq filter
+                featWriter.write(rows)
+
+                if mfWriter:
                     mfRows = []
-                    mfwsql = """INSERT INTO """+mfTableName+""" (group_id, feat, value, group_norm) values ('"""+str(cf_id)+"""', %s, %s, %s)"""
                     avgGramLength = totalChars / totalGrams
-                    avgGramsPerMsg = totalGrams / len(mids)
-                    mfRows.append( ('_avg'+str(n)+'gramLength', avgGramLength, valueFunc(avgGramLength)) )
-                    mfRows.append( ('_avg'+str(n)+'gramsPerMsg', avgGramsPerMsg, valueFunc(avgGramsPerMsg)) )
-                    mfRows.append( ('_total'+str(n)+'grams', totalGrams, valueFunc(totalGrams)) )
-                    mm.executeWriteMany(self.corpdb, self.dbCursor, mfwsql, mfRows, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode)
-                #print "\n\n\nROWS TO ADD!!"
-                #pprint(rows) #DEBUG
-                mm.executeWriteMany(self.corpdb, self.dbCursor, wsql, rows, writeCursor=self.dbConn.cursor(), charset=self.encoding)
-
+                    avgGramsPerMsg = totalGrams / numMsgs
+                    mfRows.append( (cf_id, '_avg'+str(n)+'gramLength', avgGramLength, valueFunc(avgGramLength)) )
+                    mfRows.append( (cf_id, '_avg'+str(n)+'gramsPerMsg', avgGramsPerMsg, valueFunc(avgGramsPerMsg)) )
+                    mfRows.append( (cf_id, '_total'+str(n)+'grams', totalGrams, valueFunc(totalGrams)) )
+                    if totalMsgsFeat:
+                        mfRows.append( (cf_id, '_totalMsgs', numMsgs, valueFunc(numMsgs)) )
+                    mfWriter.write(mfRows)
+
+        featWriter.close()
+        if mfWriter: mfWriter.close()
         dlac.warn("Done Reading / Inserting.")
 
-        if len(cfRows)*n < dlac.MAX_TO_DISABLE_KEYS:
+        if numGroups*n < dlac.MAX_TO_DISABLE_KEYS:
             dlac.warn("Adding Keys (if goes to keycache, then decrease MAX_TO_DISABLE_KEYS or run myisamchk -n).")
             mm.enableTableKeys(self.corpdb, self.dbCursor, featureTableName, charset=self.encoding, use_unicode=self.use_unicode)#rebuilds keys
         dlac.warn("Done\n")
-        return featureTableName
 
+    @staticmethod
+    def _mapGroups(func, argsIter, cores = 1):
+        """Applies func to each item of argsIter, in order, using a pool of worker processes when cores > 1
+
+        Items are handed to the pool in bounded partitions of groups so that the reader never
+        gets more than a few partitions ahead of the writer.
+        """
+        if cores <= 1:
+            for args in argsIter:
+                yield func(args)
+            return
+
+        dlac.warn("Counting with %d worker processes" % cores)
+        partitionSize = dlac.GROUPS_PER_WORKER_TASK
+        pool = multiprocessing.Pool(cores)
+        try:
+            while True:
+                groupBatch = list(islice(argsIter, cores * partitionSize * 4))
+                if not groupBatch: break
+                for result in pool.imap(func, groupBatch, chunksize = partitionSize):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
 
     def _getCollocsFromTable(self, colloc_table, pmi_filter_thresh, colloc_column, pmi_filter_column):
         res = colloc_table.split('.')
@@ -1473,6 +1360,194 @@ class FeatureExtractor(DLAWorker):
 
     ##HELPER METHODS##
 
+    def getFeatureWriter(self, tableName, columns = ('group_id', 'feat', 'value', 'group_norm')):
+        """Returns a mm.BulkWriter for writing rows to a (feature) table
+
+        Parameters
+        ----------
+        tableName : str
+            table to write to, usually from createFeatureTable
+        columns : :obj:`tuple`, optional
+            columns the rows are given in
+
+        Returns
+        -------
+        mm.BulkWriter
+            writes through LOAD DATA LOCAL INFILE when self.bulkLoad is set (falling back to
+            executeWriteMany if the server does not allow it), otherwise through executeWriteMany
+        """
+        return mm.BulkWriter(self.corpdb, tableName, columns, localInfile=self.bulkLoad, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host)
+
+    def _getMessagesByCorrelField(self, streaming = False):
+        """Returns the number of groups and an iterator over (cf_id, messageRows) for the message table
+
+        Parameters
+        ----------
+        streaming : :obj:`boolean`, optional
+            if True, stream all messages in one server-side cursor ordered by correl field;
+            otherwise query the messages of each group one at a time
+        """
+        if streaming:
+            numGroups = self.countCorrelFieldIds()
+            dlac.warn("streaming messages for %d '%s's"%(numGroups, self.correl_field))
+            return (numGroups, self.yieldMessagesByCorrelField(warnMsg = True))
+
+        usql = """SELECT %s FROM %s GROUP BY %s""" % (
+            self.correl_field, self.corptable, self.correl_field)
+        cfRows = FeatureExtractor.noneToNull(mm.executeGetList(self.corpdb, self.dbCursor, usql, charset=self.encoding, use_unicode=self.use_unicode))#SSCursor woudl be better, but it loses connection
+        dlac.warn("finding messages for %d '%s's"%(len(cfRows), self.correl_field))
+        return (len(cfRows), ((cfRow[0], self.getMessagesForCorrelField(cfRow[0], warnMsg = False)) for cfRow in cfRows))
+
+
+    def _loadLexicon(self, lexiconTableName, lowercase_only=dlac.LOWERCASE_ONLY, isWeighted=False):
+        """Reads a lexicon table into a term -> {category: weight} dict
+
+        Parameters
+        ----------
+        lexiconTableName : str
+            Name of lexicon table in self.lexicondb
+        lowercase_only : boolean
+            lowercase the terms if True
+        isWeighted : :obj:`boolean`, optional
+            use the weight column of the lexicon
+
+        Returns
+        -------
+        tuple
+            (feat_cat_weight, sorted list of categories, intercepts by category, lexiconHasWildCard, max_category_string_length)
+        """
+        _intercepts = {}
+        feat_cat_weight = dict()
+        sql = "SELECT * FROM %s.%s"%(self.lexicondb, lexiconTableName)
+        rows = mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)
+        categories = set()
+        lexiconHasWildCard = False
+        warnedAboutWeights = False
+        max_category_string_length = -1
+        for row in rows:
+            #e.g. (2, "bored", "E-")
+            #OR   (2, "bored", "E-", "1")
+            term = row[1].strip()
+            category = row[2].strip()
+            if term and category:
+                weight = 1
+                if isWeighted:
+                    try:
+                        weight = row[3]
+                    except IndexError:
+                        print('\nERROR: The lexicon you specified is probably not weighted, or there is a problem in the lexicon itself (Check DB)')
+                        sys.exit(2)
+                elif len(row) == 4 and not warnedAboutWeights:
+                    dlac.warn("""###################################################################
+  WARNING: The lexicon you specified has weights, but you didn't
+  specify --weighted_lexicon so the weights won't be used
+###################################################################""")
+                    warnedAboutWeights = True
+                if lowercase_only: term = term.lower()
+                if term == '_intercept':
+                    dlac.warn("Intercept detected %f [category: %s]" % (weight,category))
+                    _intercepts[category] = weight
+                if term[-1] == '*':
+                    lexiconHasWildCard = True
+                feat_cat_weight[term] = feat_cat_weight.get(term,{})
+                feat_cat_weight[term][category] = weight
+                categories.add(category)
+                if len(category) > max_category_string_length:
+                    max_category_string_length = len(category)
+
+        return (feat_cat_weight, sorted(categories), _intercepts, lexiconHasWildCard, max_category_string_length)
+
+    @staticmethod
+    def _compileLexicon(feat_cat_weight, categories, vocab, lowercase_only=dlac.LOWERCASE_ONLY, lexiconHasWildCard=False):
+        """Compiles a lexicon into sparse vocab x categories matrices
+
+        Wildcard terms (e.g. "happ*") are expanded against the vocabulary here, once per word, matching
+        prefixes of at least 3 characters and keeping the max weight when several terms match.
+
+        Parameters
+        ----------
+        feat_cat_weight : dict
+            term -> {category: weight}, from _loadLexicon
+        categories : list
+            categories in column order
+        vocab : list
+            features of the word table in row order
+
+        Returns
+        -------
+        tuple
+            (weights, membership): csr_matrix of weights and csr_matrix holding 1 wherever a word is in a category
+        """
+        catIndex = dict((category, j) for j, category in enumerate(categories))
+        rows, cols, weights = [], [], []
+        for i, feat in enumerate(vocab):
+            if not feat: continue
+            if lowercase_only: feat = feat.lower()
+            cat_to_weight = feat_cat_weight.get(feat, dict())
+            if lexiconHasWildCard: #check wildcard matches
+                for endI in range(3, len(feat)+1):
+                    featWild = feat[0:endI]+'*'
+                    if featWild in feat_cat_weight:
+                        cat_to_weight = dlac.unionDictsMaxOnCollision(cat_to_weight, feat_cat_weight[featWild])
+            for category, weight in cat_to_weight.items():
+                rows.append(i)
+                cols.append(catIndex[category])
+                weights.append(float(weight))
+        shape = (len(vocab), len(categories))
+        return (csr_matrix((np.array(weights, dtype=float), (rows, cols)), shape=shape),
+                csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape))
+
+    def _yieldWordTableMatrices(self, wordTable, featValueFunc=lambda d: float(d)):
+        """Streams the word table ordered by group_id and yields it in sparse groups x vocab batches
+
+        Each batch holds whole groups and about dlac.MAX_SQL_SELECT rows. Columns follow the order
+        in which features are first seen, so the vocabulary only grows from one batch to the next.
+
+        Parameters
+        ----------
+        wordTable : str
+            1gram feature table
+        featValueFunc : :obj:`lambda`, optional
+            applied to each group_norm
+
+        Returns
+        -------
+        generator
+            (groupIds, vocab, present, values, group_norms): present holds 1 for every row read
+        """
+        sql = "SELECT group_id, feat, value, group_norm FROM %s ORDER BY group_id" % wordTable
+        ssCursor = mm.executeGetSSCursor(self.corpdb, sql, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host)
+
+        vocab, featIndex = [], dict()
+        def toMatrices(groupIds, rows, cols, values, norms):
+            shape = (len(groupIds), len(vocab))
+            return (groupIds, vocab,
+                    csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape),
+                    csr_matrix((np.array(values, dtype=float), (rows, cols)), shape=shape),
+                    csr_matrix((np.array(norms, dtype=float), (rows, cols)), shape=shape))
+
+        groupIds, groupIndex = [], dict()
+        rows, cols, values, norms = [], [], [], []
+        for (gid, feat, value, group_norm) in ssCursor:
+            if gid is None: continue
+            if gid not in groupIndex:
+                if len(rows) >= dlac.MAX_SQL_SELECT:
+                    yield toMatrices(groupIds, rows, cols, values, norms)
+                    groupIds, groupIndex = [], dict()
+                    rows, cols, values, norms = [], [], [], []
+                groupIndex[gid] = len(groupIds)
+                groupIds.append(gid)
+            if not feat: continue
+            j = featIndex.get(feat)
+            if j is None:
+                j = featIndex[feat] = len(vocab)
+                vocab.append(feat)
+            rows.append(groupIndex[gid])
+            cols.append(j)
+            values.append(value)
+            norms.append(featValueFunc(group_norm))
+        if groupIds:
+            yield toMatrices(groupIds, rows, cols, values, norms)
 
     def getCorrelFieldType(self, correlField):
         """Returns the type of correlField
@@ -1731,169 +1806,106 @@ class FeatureExtractor(DLAWorker):
             Name of created feature table: feat%cat_lexTable%corptable$correl_field
 
         """
-        PR = pprint #debug
-
-        _intercepts = {}
-        #1. word -> set(category) dict
-        #2. Get length for varchar column
-        feat_cat_weight = dict()
-        sql = "SELECT * FROM %s.%s"%(self.lexicondb, lexiconTableName)
-        rows = mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)
-        categories = set()
-        lexiconHasWildCard = False
-        warnedAboutWeights = False
-        max_category_string_length = -1
-        for row in rows:
-            #e.g. (2, "bored", "E-")
-            #OR   (2, "bored", "E-", "1")
-            term = row[1].strip()
-            category = row[2].strip()
-            if term and category:
-                weight = 1
-                if isWeighted:
-                    try:
-                        weight = row[3]
-                    except IndexError:
-                        print('\nERROR: The lexicon you specified is probably not weighted, or there is a problem in the lexicon itself (Check DB)')
-                        sys.exit(2)
-                elif len(row) == 4 and not warnedAboutWeights:
-                    dlac.warn("""###################################################################
-  WARNING: The lexicon you specified has weights, but you didn't
-  specify --weighted_lexicon so the weights won't be used
-###################################################################""")
-                    warnedAboutWeights = True
-                if lowercase_only: term = term.lower()
-                if term == '_intercept':
-                    dlac.warn("Intercept detected %f [category: %s]" % (weight,category))
-                    _intercepts[category] = weight
-                if term[-1] == '*':
-                    lexiconHasWildCard = True
-                feat_cat_weight[term] = feat_cat_weight.get(term,{})
-                feat_cat_weight[term][category] = weight
-                categories.add(category)
-                if len(category) > max_category_string_length:
-                    max_category_string_length = len(category)
-
-        #3. create new Feature Table
-        if isWeighted:
-            lexiconTableName += "_w"
-        if featValueFunc(16) != 16:
-            lexiconTableName += "_16to"+str(int(featValueFunc(16)))
+        return self.addLexiconFeats([lexiconTableName], lowercase_only, [tableName], valueFunc, isWeighted, featValueFunc, extension)[0]
 
+    def addLexiconFeats(self, lexiconTableNames, lowercase_only=dlac.LOWERCASE_ONLY, tableNames=None, valueFunc = lambda x: float(x), isWeighted=False, featValueFunc=lambda d: float(d), extension=None):
+        """Creates one lexicon feature table per lexicon with a single pass over the 1gram feature table
 
-        tableName = self.createFeatureTable("cat_%s"%lexiconTableName, 'VARCHAR(%d)'%max_category_string_length, 'INTEGER', tableName, valueFunc, extension=extension)
+        Parameters
+        ----------
+        lexiconTableNames : list
+            Names of base lexicon tables
+        lowercase_only : boolean
+            use only lowercase charngrams if True
+        tableNames : :obj:`list`, optional
+            Prespecified names of extracted lexicon feature tables (None to generate one), use at own risk
+        valueFunc : :obj:`lambda`, optional
+            Scales the features by the function given
+        isWeighted : :obj:`boolean`, optional
+            Are the lexicons weighted?
+        featValueFunc : :obj:`lambda`, optional
+            ?????
 
+        Returns
+        -------
+        tableNames : list
+            Names of created feature tables: feat%cat_lexTable%corptable$correl_field, in the order of lexiconTableNames
 
-        #4. grab all distinct group ids
+        """
+        if not tableNames: tableNames = [None] * len(lexiconTableNames)
+        lexicons = []
+        for lexiconTableName, tableName in zip(lexiconTableNames, tableNames):
+            #1. word -> set(category) dict
+            #2. Get length for varchar column
+            (feat_cat_weight, categories, _intercepts, lexiconHasWildCard, max_category_string_length) = self._loadLexicon(lexiconTableName, lowercase_only, isWeighted)
+
+            #3. create new Feature Table
+            if isWeighted:
+                lexiconTableName += "_w"
+            if featValueFunc(16) != 16:
+                lexiconTableName += "_16to"+str(int(featValueFunc(16)))
+
+            tableName = self.createFeatureTable("cat_%s"%lexiconTableName, 'VARCHAR(%d)'%max_category_string_length, 'INTEGER', tableName, valueFunc, extension=extension)
+            weights, membership = self._compileLexicon(feat_cat_weight, categories, [], lowercase_only, lexiconHasWildCard)
+            lexicons.append({'tableName': tableName,
+                             'feat_cat_weight': feat_cat_weight,
+                             'categories': categories,
+                             'catNames': categories if self.use_unicode else [k.encode('utf-8') for k in categories],
+                             'intercepts': np.array([_intercepts.get(k,0) for k in categories], dtype=float),
+                             'hasIntercepts': bool(_intercepts),
+                             'lexiconHasWildCard': lexiconHasWildCard,
+                             'weights': weights,
+                             'membership': membership})
+
+        #4. count distinct group ids
         wordTable = self.getWordTable()
         dlac.warn("WORD TABLE %s"%(wordTable,))
 
         assert mm.tableExists(self.corpdb, self.dbCursor, wordTable, charset=self.encoding, use_unicode=self.use_unicode), "Need to create word table to extract the lexicon: %s" % wordTable
-        sql = "SELECT DISTINCT group_id FROM %s" % wordTable
-        groupIdRows = mm.executeGetList(self.corpdb, self.dbCursor, sql, False, charset=self.encoding, use_unicode=self.use_unicode)
+        sql = "SELECT COUNT(DISTINCT group_id) FROM %s" % wordTable
+        numGroups = mm.executeGetList(self.corpdb, self.dbCursor, sql, False, charset=self.encoding, use_unicode=self.use_unicode)[0][0]
 
-        #5. disable keys on that table if we have too many entries
-        #if (len(categories)* len(groupIdRows)) < dlac.MAX_TO_DISABLE_KEYS:
-        mm.disableTableKeys(self.corpdb, self.dbCursor, tableName, charset=self.encoding, use_unicode=self.use_unicode) #for faster, when enough space for repair by sorting
+        #5. disable keys on the new tables
+        for lex in lexicons:
+            mm.disableTableKeys(self.corpdb, self.dbCursor, lex['tableName'], charset=self.encoding, use_unicode=self.use_unicode) #for faster, when enough space for repair by sorting
+            lex['writer'] = self.getFeatureWriter(lex['tableName'])
 
-        #6. iterate through source feature table by group_id (fixed, column name will always be group_id)
-        rowsToInsert = []
-
-        isql = "INSERT IGNORE INTO "+tableName+" (group_id, feat, value, group_norm) values (%s, %s, %s, %s)"
-        reporting_percent = 0.01
-        reporting_int = max(floor(reporting_percent * len(groupIdRows)), 1)
+        #6. stream the source feature table once, in batches of groups as sparse groups x words matrices,
+        #   and multiply each batch by every lexicon's words x categories matrices
+        #   (compiled, with wildcards expanded, for each new word as it is first seen)
         groupIdCounter = 0
-        for groupIdRow in groupIdRows:
-
-            groupId = groupIdRow[0]
-
-            #i. create the group_id category counts & keep track of how many features they have total
-            cat_to_summed_value = dict()
-            cat_to_function_summed_weight = dict()
-            cat_to_function_summed_weight_gn = {}
-            sql = ''
-            if isinstance(groupId, str):
-                sql = "SELECT group_id, feat, value, group_norm FROM %s WHERE group_id LIKE '%s'"%(wordTable, groupId)
-            else:
-                sql = "SELECT group_id, feat, value, group_norm FROM %s WHERE group_id = %d"%(wordTable, groupId)
-
-            try:
-                attributeRows = mm.executeGetList(self.corpdb, self.dbCursor, sql, False, charset=self.encoding, use_unicode=self.use_unicode)
-            except:
-                print(groupId)
-                sys.exit()
-
-            totalFeatCountForThisGroupId = 0
-
-            totalFunctionSumForThisGroupId = float(0.0)
-            totalWordsInLexForThisGroupId = float(0.0)
-            for (gid, feat, value, group_norm) in attributeRows:
-                #e.g. (69L, 8476L, 'spent', 1L, 0.00943396226415094, None),
-                cat_to_weight = dict()#dictionary holding all categories, weights that feat is a part of
-                if not feat: continue
-                if lowercase_only: feat = feat.lower()
-                totalFeatCountForThisGroupId += value
-                totalFunctionSumForThisGroupId += featValueFunc(value)
-
-                if feat in feat_cat_weight:
-                    cat_to_weight.update(feat_cat_weight[feat]) #*value) #???
-                    #totalWordsInLexForThisGroupId += featValueFunc(value)
-                if lexiconHasWildCard: #check wildcard matches
-                    for endI in range(3, len(feat)+1):
-                        featWild = feat[0:endI]+'*'
-                        if featWild in feat_cat_weight:
-                            cat_to_weight = dlac.unionDictsMaxOnCollision(cat_to_weight, feat_cat_weight[featWild])
-                #update all cats:
-                for category in cat_to_weight:
-                    try:
-                        cat_to_summed_value[category] += value
-                        cat_to_function_summed_weight[category] += cat_to_weight[category] * featValueFunc(value)
-                        cat_to_function_summed_weight_gn[category] += cat_to_weight[category] * featValueFunc(group_norm)
-                    except KeyError:
-                        cat_to_summed_value[category] = value
-                        cat_to_function_summed_weight[category] = cat_to_weight[category] * featValueFunc(value)
-                        cat_to_function_summed_weight_gn[category] = cat_to_weight[category] * featValueFunc(group_norm)
-
-            # print gid
-            # pprint(cat_to_function_summed_weight) #debug
-            # ii. Calculate the group norms (the percentage of the gid's words observed in each category transformed by valueFunc (e.g. sqrt))
-            # totalFeatCountForThisGroupId = float(totalFeatCountForThisGroupId) #to avoid casting each time below
-
-            # Using the value and applying the featValueFunction to the value and the UWT separately
-            # rows = [(gid, k.encode('utf-8'), cat_to_summed_value[k], valueFunc(_intercepts.get(k,0)+(v / totalFunctionSumForThisGroupId))) for k, v in cat_to_function_summed_weight.iteritems()]
-
-            # Applying the featValueFunction to the group_norm,
-            if self.use_unicode:
-                rows = [(gid, k, cat_to_summed_value[k], valueFunc(_intercepts.get(k,0)+v)) for k, v in cat_to_function_summed_weight_gn.items()]
-            else:
-                rows = [(gid, k.encode('utf-8'), cat_to_summed_value[k], valueFunc(_intercepts.get(k,0)+v)) for k, v in cat_to_function_summed_weight_gn.items()]
-            
-            # if lex has *no* intercept, add '_intercept' for each group_id
-            if not _intercepts: rows.append((gid, '_intercept', 1, 1.0))
-
-            # iii. Insert data into new feautre table
-            # Add new data to rows to be inserted into the database
-            # Check if size is big enough for a batch insertion (10,000?), if so insert and clear list
-            rowsToInsert.extend(rows)
-            if len(rowsToInsert) > dlac.MYSQL_BATCH_INSERT_SIZE:
-                mm.executeWriteMany(self.corpdb, self.dbCursor, isql, rowsToInsert, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode)
-                rowsToInsert = []
-            groupIdCounter += 1
-            if groupIdCounter % reporting_int == 0:
-                dlac.warn("%d out of %d group Id's processed; %2.2f complete"%(groupIdCounter, len(groupIdRows), float(groupIdCounter)/len(groupIdRows)))
-
-        #7. if any data in the data_to_insert rows, insert the data and clear the list
-        if len(rowsToInsert) > 0:
-            mm.executeWriteMany(self.corpdb, self.dbCursor, isql, rowsToInsert, writeCursor=self.dbConn.cursor(), charset=self.encoding, use_unicode=self.use_unicode)
-            rowsToInsert = []
-            dlac.warn("%d out of %d group Id's processed; %2.2f complete"%(groupIdCounter, len(groupIdRows), float(groupIdCounter)/len(groupIdRows)))
-
-        #8. enable keys on the new feature table
-        #if (len(categories)* len(groupIdRows)) < dlac.MAX_TO_DISABLE_KEYS:
-        mm.enableTableKeys(self.corpdb, self.dbCursor, tableName, charset=self.encoding, use_unicode=self.use_unicode)#rebuilds keys
-
-        #9. exit with success, return the newly created feature table
-        return tableName
+        for (groupIds, vocab, present, values, groupNorms) in self._yieldWordTableMatrices(wordTable, featValueFunc):
+            for lex in lexicons:
+                weights, membership = lex['weights'], lex['membership']
+                if len(vocab) > weights.shape[0]:
+                    newWeights, newMembership = self._compileLexicon(lex['feat_cat_weight'], lex['categories'], vocab[weights.shape[0]:], lowercase_only, lex['lexiconHasWildCard'])
+                    weights = lex['weights'] = vstack([weights, newWeights], format='csr')
+                    membership = lex['membership'] = vstack([membership, newMembership], format='csr')
+
+                #i. a category is output for a group_id when any of its words were observed:
+                #   value is the summed count of those words, group_norm the weighted sum of their featValueFunc(group_norm)s
+                observed = present.dot(membership).tocoo()
+                gIs, cIs = observed.row, observed.col
+                catValues = np.asarray(values.dot(membership)[gIs, cIs]).ravel().tolist()
+                catNorms = (np.asarray(groupNorms.dot(weights)[gIs, cIs]).ravel() + lex['intercepts'][cIs]).tolist()
+                catNames = lex['catNames']
+                rows = [(groupIds[gI], catNames[cI], catValues[k], valueFunc(catNorms[k])) for k, (gI, cI) in enumerate(zip(gIs.tolist(), cIs.tolist()))]
+
+                # if lex has *no* intercept, add '_intercept' for each group_id
+                if not lex['hasIntercepts']: rows.extend([(gid, '_intercept', 1, 1.0) for gid in groupIds])
+
+                # ii. Insert data into new feautre table
+                lex['writer'].write(rows)
+            groupIdCounter += len(groupIds)
+            dlac.warn("%d out of %d group Id's processed; %2.2f complete"%(groupIdCounter, numGroups, float(groupIdCounter)/max(numGroups, 1)))
+
+        #7. write any remaining rows and enable keys on the new feature tables
+        for lex in lexicons:
+            lex['writer'].close()
+            mm.enableTableKeys(self.corpdb, self.dbCursor, lex['tableName'], charset=self.encoding, use_unicode=self.use_unicode)#rebuilds keys
+
+        #8. exit with success, return the newly created feature tables
+        return [lex['tableName'] for lex in lexicons]
 
     def addWNNoPosFeat(self, tableName=None, valueFunc = lambda x: float(x), featValueFunc=lambda d: float(d)):
         """Creates a wordnet concept feature table (based on words without pos tags) given a 1gram feature table name
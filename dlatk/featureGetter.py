@@ -7,9 +7,11 @@ import csv
 from numpy import zeros, sqrt, array, std, mean
 from scipy.stats import t as spt
 import numpy as np
+from scipy.sparse import csr_matrix
 
 #infrastructure
 from . import dlaConstants as dlac
+from . import featureCache
 from .dlaWorker import DLAWorker
 from .mysqlmethods import mysqlMethods as mm
 from .mysqlmethods import mysql_iter_funcs as mif
@@ -40,6 +42,9 @@ class FeatureGetter(DLAWorker):
 
     """
 
+    featureCacheGigs = dlac.FEATURE_CACHE_GIGS #shared in-memory feature matrix cache (0 to always query)
+    featureSnapshotDir = None #directory for on-disk feature matrix snapshots (None for no snapshots)
+
     @classmethod
     def fromFile(cls, initFile):
         """Loads specified features from file
@@ -90,6 +95,20 @@ class FeatureGetter(DLAWorker):
         """Enables the keys, for use after inserting (and with keys disabled)"""
         return mm.enableTableKeys(self.corpdb, self.dbCursor, self.featureTable, charset=self.encoding, use_unicode=self.use_unicode)
 
+    def getFeatureMatrix(self):
+        """Returns the feature table as a featureCache.FeatureMatrix
+
+        The matrix is read once and shared through the process-wide cache until the table changes.
+        If featureSnapshotDir is set it is also saved there and memory-mapped by later runs.
+
+        Returns
+        -------
+        FeatureMatrix or None
+            None if the cache is turned off or the table does not fit in it
+        """
+        if not self.featureCacheGigs: return None
+        return featureCache.getFeatureMatrix(self.corpdb, self.featureTable, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host, maxGigs=self.featureCacheGigs, snapshotDir=self.featureSnapshotDir)
+
     ## Getters ##
 
     def getFeatureCounts(self, groupFreqThresh = 0, where = '', SS = False, groups = set()):
@@ -118,13 +137,17 @@ class FeatureGetter(DLAWorker):
             for group, wordCount in groupCnts.items():
                 if (wordCount >= groupFreqThresh):
                     groups.add(group)
-                    
+
+        if not where:
+            fm = self.getFeatureMatrix()
+            if fm is not None: return fm.featureCounts(groups)
+
         if (where): 
             where += ' WHERE ' + where
             if groups:
-                where += ' AND ' + " group_id in ('%s')" % "','".join(str(g) for g in groups)
+                where += ' AND ' + self.groupsCondition(groups)
         elif groups:
-            where = " WHERE group_id in ('%s')" % "','".join(str(g) for g in groups)
+            where = " WHERE" + self.groupsCondition(groups)
         sql = """select feat, count(*) from %s %s group by feat"""%(self.featureTable, where)
         if SS:
             mm.executeGetSSCursor(self.corpdb, sql, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host)
@@ -185,7 +208,10 @@ class FeatureGetter(DLAWorker):
         return mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)
 
     def getSumValuesByFeat(self, where = ''):
-        """ """
+        """returns a list of (feature, sum of values) tuples"""
+        if not where:
+            fm = self.getFeatureMatrix()
+            if fm is not None: return fm.sumValuesByFeat()
         sql = """SELECT feat, sum(value) FROM %s """ % self.featureTable
         if (where): sql += ' WHERE ' + where  
         sql += """ GROUP BY feat """
@@ -229,6 +255,15 @@ class FeatureGetter(DLAWorker):
         if (where): sql += ' AND ' + where
         return mm.executeGetList(self.corpdb, self.dbCursor, sql, warnMsg, charset=self.encoding, use_unicode=self.use_unicode) 
 
+    def getGroupNormsForFeatsSS(self, feats, where = '', values = False, warnMsg = False):
+        """returns a server-side cursor over (feat, group_id, group_norm) of the given features, in feat order
+        (or (feat, group_id, value, group_norm) if values)"""
+        fCond = " feat in ('%s')" % "','".join(MySQLdb.escape_string(str(f)).decode('utf-8') for f in feats)
+        sql = """SELECT feat, group_id, %sgroup_norm FROM %s WHERE %s"""%('value, ' if values else '', self.featureTable, fCond)
+        if (where): sql += ' AND ' + where
+        sql += ' ORDER BY feat'
+        return mm.executeGetSSCursor(self.corpdb, sql, warnMsg, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host)
+
     def getValuesAndGroupNormsForFeat(self, feat, where = '', warnMsg = False):
         """returns a list of (group_id, feature, group_norm) triples"""
         if self.use_unicode:
@@ -263,7 +298,7 @@ class FeatureGetter(DLAWorker):
         #This functino gets killed on large feature sets
         gnlist = []
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where: gnlist = self.getGroupNorms(where+" AND "+gCond)
             else: gnlist = self.getGroupNorms(gCond)
         else: 
@@ -288,7 +323,7 @@ class FeatureGetter(DLAWorker):
         #This functino gets killed on large feature sets
         gnlist = []
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where: gnlist = self.getGroupNorms(where+" AND "+gCond)
             else: gnlist = self.getGroupNorms(gCond)
         else: 
@@ -319,11 +354,17 @@ class FeatureGetter(DLAWorker):
 
     def getGroupNormsSparseFeatsFirst(self, groups = [], where = ''):
         """returns a dict of (feature => group_id => group_norm)"""
+        if not where:
+            fm = self.getFeatureMatrix()
+            if fm is not None:
+                gns = dict(fm.iterFeats(groups))
+                return gns, list(gns.keys())
+
         #This functino gets killed on large feature sets
         gnlist = []
         allFeats = {}
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where:
                 gnlist = self.getGroupNorms(where+" AND "+gCond)
                 allFeats = self.getDistinctFeatures(where+" AND "+gCond)
@@ -348,13 +389,81 @@ class FeatureGetter(DLAWorker):
 
         return gns, allFeats
 
+    def getGroupNormMatrix(self, groups = [], where = ''):
+        """Returns the rows of the given groups as a featureCache.FeatureMatrix (groups x feats csr matrices)
+
+        The matrix is sliced from the cached feature matrix when there is one, otherwise read
+        straight from the table rows. Its features are those observed in the groups, as
+        returned by getGroupNormsSparseFeatsFirst.
+        """
+        if not where:
+            fm = self.getFeatureMatrix()
+            if fm is not None:
+                (groupIds, vals, gns) = fm.restrictToGroups(groups)
+                observed = np.nonzero(np.diff(gns.indptr))[0]
+                return featureCache.FeatureMatrix(groupIds, [fm.feats[j] for j in observed], vals[:, observed].tocsr(), gns[:, observed].tocsr())
+        conds = [c for c in (where, self.groupsCondition(groups) if groups else '') if c]
+        return featureCache.loadFeatureMatrix(self.corpdb, self.featureTable, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host, where=' AND '.join(conds))
+
+    def yieldGroupNormChunks(self, feats, chunkSize = dlac.DEFAULT_MAX_PREDICT_AT_A_TIME, where = ''):
+        """Streams the group norms of feats in chunks of chunkSize groups, in group_id order
+
+        The table is read once through a server-side cursor, so only one chunk is held in memory.
+        Rows of features not in feats are skipped.
+
+        Yields
+        ------
+        (groupIds, gns)
+            the chunk's group ids in the order read, and a csr_matrix (len(groupIds) x len(feats))
+            of their group norms
+        """
+        featIndex = dict((f, j) for j, f in enumerate(feats))
+        sql = """SELECT group_id, feat, group_norm FROM %s"""%(self.featureTable)
+        if (where): sql += ' WHERE ' + where
+        sql += ' ORDER BY group_id'
+        (rowIndex, rows, cols, gns) = (dict(), [], [], [])
+        for (gid, feat, gn) in mm.executeGetSSCursor(self.corpdb, sql, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host):
+            r = rowIndex.get(gid)
+            if r is None:
+                if len(rowIndex) >= chunkSize:
+                    yield (list(rowIndex), csr_matrix((gns, (rows, cols)), shape=(len(rowIndex), len(feats))))
+                    (rowIndex, rows, cols, gns) = (dict(), [], [], [])
+                r = rowIndex[gid] = len(rowIndex)
+            j = featIndex.get(feat)
+            if j is not None:
+                rows.append(r)
+                cols.append(j)
+                gns.append(gn)
+        if rowIndex:
+            yield (list(rowIndex), csr_matrix((gns, (rows, cols)), shape=(len(rowIndex), len(feats))))
+
+    def getGroupNormRowsInRange(self, feats, groupIds, where = ''):
+        """Returns a csr_matrix (len(groupIds) x len(feats)) of the group norms of feats for groupIds
+
+        groupIds must be in group_id order (e.g. a chunk from yieldGroupNormChunks): only the rows
+        between the first and the last of them are read. Groups without rows are left as zeros.
+        """
+        rowIndex = dict((g, r) for r, g in enumerate(groupIds))
+        featIndex = dict((f, j) for j, f in enumerate(feats))
+        (first, last) = (MySQLdb.escape_string(str(groupIds[0])).decode('utf-8'), MySQLdb.escape_string(str(groupIds[-1])).decode('utf-8'))
+        sql = """SELECT group_id, feat, group_norm FROM %s WHERE group_id BETWEEN '%s' AND '%s'"""%(self.featureTable, first, last)
+        if (where): sql += ' AND ' + where
+        (rows, cols, gns) = ([], [], [])
+        for (gid, feat, gn) in mm.executeGetSSCursor(self.corpdb, sql, False, charset=self.encoding, use_unicode=self.use_unicode, host=self.mysql_host):
+            (r, j) = (rowIndex.get(gid), featIndex.get(feat))
+            if r is not None and j is not None:
+                rows.append(r)
+                cols.append(j)
+                gns.append(gn)
+        return csr_matrix((gns, (rows, cols)), shape=(len(groupIds), len(feats)))
+
     def getGroupNormsSparseGroupsFirst(self, groups = [], where = ''):
         """returns a dict of (feature => group_id => group_norm)"""
         #This functino gets killed on large feature sets
         gnlist = []
         allFeats = {}
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where:
                 gnlist = self.getGroupNorms(where+" AND "+gCond)
                 allFeats = self.getDistinctFeatures(where+" AND "+gCond)
@@ -380,9 +489,17 @@ class FeatureGetter(DLAWorker):
         return gns, allFeats
 
     
-    def yieldGroupNormsWithZerosByFeat(self, groups = [], where = '', values = False, feats = []):
-        """yields (feat, groupnorms, number of features"""
-        """ or if values = True, (feat, values, groupnorms, number of features)"""
+    def _getGroupNormDictsByFeat(self, groups = [], where = '', values = False, feats = []):
+        """Finds how to get the group norms of each feature, from memory when they fit
+
+        Returns
+        -------
+        tuple
+            (allFeats, groups, cached, getFeatValuesAndGNs) where groups are all groups if none were given,
+            cached is (groupIds, values, groupNorms, featIndex) of the cached FeatureMatrix restricted to
+            the groups (or None) and getFeatValuesAndGNs(feat) returns (valDict, gnDict) of the groups
+            with the feature (valDict is None unless values)
+        """
         allFeats = feats
         if not feats: 
             allFeats = self.getDistinctFeatures(where)
@@ -392,7 +509,7 @@ class FeatureGetter(DLAWorker):
         numFeats = len(allFeats)
         gCond = None
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
         else: 
             groups = self.getDistinctGroups(where)
         numGroups = len(groups)
@@ -409,7 +526,13 @@ class FeatureGetter(DLAWorker):
         dlac.warn("Yielding norms with zeros (%d groups * %d feats)." %(len(groups), numFeats))
         gns = dict()
         vals = dict() #only gets field if values is true
-        if (numFeats * numGroups) < 12500000*dlac.GIGS_OF_MEMORY:
+        fm = self.getFeatureMatrix() if not where else None
+        cached = None
+        featPosition = None
+        if fm is not None:
+            #served from the columns of the cached feature matrix
+            cached = fm.restrictToGroups(groups if gCond else None) + (dict((f, j) for j, f in enumerate(fm.feats)), )
+        elif (numFeats * numGroups) < 12500000*dlac.GIGS_OF_MEMORY:
             #statically acquire all gns
             gnlist = []
             if gCond: 
@@ -433,10 +556,41 @@ class FeatureGetter(DLAWorker):
                 if values:
                     vals[feat][gid] = float(tup[2])
         else:
-            dlac.warn("Too big to keep gns in memory, querying for each feature (slower, but less memory intensive)")
+            #query bounded batches of features, in the order they are asked for
+            featsPerQuery = max(1, min(dlac.FEATS_PER_QUERY, int(12500000*dlac.GIGS_OF_MEMORY / max(numGroups, 1))))
+            dlac.warn("Too big to keep gns in memory, querying %d features at a time (slower, but less memory intensive)" % featsPerQuery)
+            featPosition = dict((f, i) for i, f in enumerate(allFeats))
+            batchCond = " AND ".join(c for c in (where, gCond) if c)
+            batch = {'feats': frozenset()}
+
+            def loadFeatBatch(feat):
+                start = featPosition.get(feat)
+                batchFeats = allFeats[start:start+featsPerQuery] if start is not None else [feat]
+                (batch['gns'], batch['vals']) = (dict(), dict())
+                for row in self.getGroupNormsForFeatsSS(batchFeats, batchCond, values):
+                    (f, gid) = row[0:2]
+                    batch['gns'].setdefault(f, dict())[gid] = float(row[-1])
+                    if values:
+                        batch['vals'].setdefault(f, dict())[gid] = float(row[2])
+                batch['feats'] = frozenset(batchFeats)
 
         def getFeatValuesAndGNs(feat):
-            if gns:
+            if cached is not None:
+                (groupIds, valMatrix, gnMatrix, featIndex) = cached
+                j = featIndex.get(feat)
+                (start, end) = (gnMatrix.indptr[j], gnMatrix.indptr[j+1]) if j is not None else (0, 0)
+                if start == end:
+                    dlac.warn("Couldn't find gns for feat: %s (group_freq_thresh may be too high)" % feat)
+                    return (None, dict())
+                gids = [groupIds[r] for r in gnMatrix.indices[start:end]]
+                valDict = dict(zip(gids, valMatrix.data[start:end].tolist())) if values else None
+                return (valDict, dict(zip(gids, gnMatrix.data[start:end].tolist())))
+            elif featPosition is not None:
+                if feat not in batch['feats']:
+                    loadFeatBatch(feat)
+                valDict = batch['vals'].pop(feat, dict()) if values else None
+                return (valDict, batch['gns'].pop(feat, dict()))
+            elif gns:
                 try:
                     if values: 
                         return (vals[feat].copy(), gns[feat].copy())
@@ -460,6 +614,13 @@ class FeatureGetter(DLAWorker):
                     gnDict = dict([(g, float(gn)) for g, gn in gnlist])
                 return (valDict, gnDict)
 
+        return (allFeats, groups, cached, getFeatValuesAndGNs)
+
+    def yieldGroupNormsWithZerosByFeat(self, groups = [], where = '', values = False, feats = []):
+        """yields (feat, groupnorms, number of features"""
+        """ or if values = True, (feat, values, groupnorms, number of features)"""
+        (allFeats, groups, cached, getFeatValuesAndGNs) = self._getGroupNormDictsByFeat(groups, where, values, feats)
+        numFeats = len(allFeats)
 
         #fill in zeros (this can get quite big!)
         for feat in allFeats:
@@ -473,11 +634,54 @@ class FeatureGetter(DLAWorker):
             else:
                 yield (feat, gnDict, numFeats)
 
+    def yieldSparseGroupNormsByFeat(self, groups = [], where = '', values = False, feats = []):
+        """Like yieldGroupNormsWithZerosByFeat, but with the zeros left implied
+
+        Yields
+        ------
+        tuple
+            (feat, group indices, groupnorms, number of groups, number of features), or if values = True,
+            (feat, group indices, values, groupnorms, number of groups, number of features), where the group
+            indices (a numpy int array) index groups (all groups if none were given) and the groupnorms and
+            values are numpy arrays of the groups with the feature
+        """
+        (allFeats, groups, cached, getFeatValuesAndGNs) = self._getGroupNormDictsByFeat(groups, where, values, feats)
+        (numFeats, numGroups) = (len(allFeats), len(groups))
+        #group ids are matched as strings, as they are in the sql "group_id in ('...')" filters
+        groupIndex = dict((str(g), i) for i, g in enumerate(groups))
+
+        if cached is not None:
+            #straight from the columns of the cached matrix
+            (groupIds, valMatrix, gnMatrix, featIndex) = cached
+            rowToIndex = np.array([groupIndex.get(str(g), -1) for g in groupIds], dtype=int)
+            for feat in allFeats:
+                j = featIndex.get(feat)
+                (start, end) = (gnMatrix.indptr[j], gnMatrix.indptr[j+1]) if j is not None else (0, 0)
+                idx = rowToIndex[gnMatrix.indices[start:end]]
+                keep = idx >= 0
+                (idx, gnArray) = (idx[keep], np.asarray(gnMatrix.data[start:end])[keep])
+                if values:
+                    yield (feat, idx, np.asarray(valMatrix.data[start:end])[keep], gnArray, numGroups, numFeats)
+                else:
+                    yield (feat, idx, gnArray, numGroups, numFeats)
+            return
+
+        for feat in allFeats:
+            (valDict, gnDict) = getFeatValuesAndGNs(feat)
+            gids = [g for g in gnDict if str(g) in groupIndex]
+            idx = np.array([groupIndex[str(g)] for g in gids], dtype=int)
+            gnArray = np.array([gnDict[g] for g in gids], dtype=float)
+            if values:
+                valArray = np.array([valDict.get(g, 0) for g in gids], dtype=float) if valDict else np.zeros(len(gids))
+                yield (feat, idx, valArray, gnArray, numGroups, numFeats)
+            else:
+                yield (feat, idx, gnArray, numGroups, numFeats)
+
     def yieldGroupNormsWithZerosByGroup(self, groups = [], where = '', allFeats = None):
         """returns a dict of (group_id, feature_values)"""
         gnlist = []
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where: gnlist = self.getGroupNorms(where+" AND "+gCond)
             else: gnlist = self.getGroupNorms(gCond)
         else: 
@@ -503,7 +707,7 @@ class FeatureGetter(DLAWorker):
         """returns a dict of (group_id, feature_values)"""
         valuelist = []
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where: valuelist = self.getValues(where+" AND "+gCond)
             else: valuelist = self.getValues(gCond)
         else: 
@@ -529,7 +733,7 @@ class FeatureGetter(DLAWorker):
         """returns a dict of (group_id, feature_values)"""
         valuelist = []
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where: valuelist = self.getValues(where+" AND "+gCond)
             else: valuelist = self.getValues(gCond)
         else: 
@@ -574,7 +778,7 @@ class FeatureGetter(DLAWorker):
         """returns a dict of (group_id => feature => feat_norm) """
         fnlist = []
         if groups: 
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if where: gnlist = self.getFeatNorms(where+" AND "+gCond)
             else: fnlist = self.getFeatNorms(gCond)
         else: 
@@ -798,7 +1002,7 @@ class FeatureGetter(DLAWorker):
         db_eng = mif.get_db_engine(self.corpdb)
         sql = """SELECT group_id, feat, group_norm from %s""" % (self.featureTable)
         if groups:
-            gCond = " group_id in ('%s')" % "','".join(str(g) for g in groups)
+            gCond = self.groupsCondition(groups)
             if (where): sql += ' WHERE ' + where + " AND " + gCond
             else: sql += ' WHERE ' + gCond
         elif (where):
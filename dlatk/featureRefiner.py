@@ -37,7 +37,7 @@ class FeatureRefiner(FeatureGetter):
         featlabel_tablename = 'feat_to_label$%s$%d'%(topiclexicon, numtopicwords)
 
         pldb = self.lexicondb
-        (plconn, plcur, plcurD) = mm.dbConnect(pldb, charset=self.encoding, use_unicode=self.use_unicode)
+        (plconn, plcur, plcurD) = mm.getConnection(pldb, charset=self.encoding, use_unicode=self.use_unicode)
         sql = 'DROP TABLE IF EXISTS `%s`'%featlabel_tablename
         mm.execute(pldb, plcur, sql, charset=self.encoding, use_unicode=self.use_unicode)
         sql = 'CREATE TABLE `%s` (`id` int(16) unsigned NOT NULL AUTO_INCREMENT, `term` varchar(128) DEFAULT NULL, `category` varchar(64) DEFAULT NULL, PRIMARY KEY (`id`), KEY `term` (`term`), KEY `category` (`category`) ) CHARACTER SET %s COLLATE %s ENGINE=%s' % (featlabel_tablename, self.encoding, dlac.DEF_COLLATIONS[self.encoding.lower()], dlac.DEF_MYSQL_ENGINE)
@@ -480,16 +480,16 @@ class FeatureRefiner(FeatureGetter):
         else:
             groups = self.getDistinctGroups(where)
         dlac.warn("""  Interpolating for up to %d %s s.""" % (len(groups), self.correl_field))
-        gList = "','".join([str(g) for g in groups])
+        gCond = self.groupsCondition(groups, column = self.correl_field)
 
         ## 2. Get the minimum date:
         dlac.warn("""  [Finding good date range]""" )
-        minIntersectDT, maxIntersectDT, minUnionDT, maxUnionDT  = mm.executeGetList(self.corpdb, self.dbCursor, "SELECT max(min_date), min(max_date), min(min_date), max(max_date) FROM (SELECT %s, MIN(%s) as min_date, MAX(%s) as max_date FROM %s where %s in ('%s') group by %s) as a " % \
-                                         (self.correl_field, dateField, dateField, self.corptable, self.correl_field, gList, self.correl_field))[0]
-        dtClosestToMin = mm.executeGetList(self.corpdb, self.dbCursor, "SELECT min(max_date) FROM (SELECT %s, MAX(%s) as max_date FROM %s where %s in ('%s') AND %s <= '%s' group by %s) as a " % \
-                                         (self.correl_field, dateField, self.corptable, self.correl_field, gList, dateField, minIntersectDT, self.correl_field))[0][0]
-        dtClosestToMax = mm.executeGetList(self.corpdb, self.dbCursor, "SELECT max(min_date) FROM (SELECT %s, MIN(%s) as min_date FROM %s where %s in ('%s') AND %s >= '%s' group by %s) as a " % \
-                                         (self.correl_field, dateField, self.corptable, self.correl_field, gList, dateField, maxIntersectDT, self.correl_field))[0][0]
+        minIntersectDT, maxIntersectDT, minUnionDT, maxUnionDT  = mm.executeGetList(self.corpdb, self.dbCursor, "SELECT max(min_date), min(max_date), min(min_date), max(max_date) FROM (SELECT %s, MIN(%s) as min_date, MAX(%s) as max_date FROM %s where%s group by %s) as a " % \
+                                         (self.correl_field, dateField, dateField, self.corptable, gCond, self.correl_field))[0]
+        dtClosestToMin = mm.executeGetList(self.corpdb, self.dbCursor, "SELECT min(max_date) FROM (SELECT %s, MAX(%s) as max_date FROM %s where%s AND %s <= '%s' group by %s) as a " % \
+                                         (self.correl_field, dateField, self.corptable, gCond, dateField, minIntersectDT, self.correl_field))[0][0]
+        dtClosestToMax = mm.executeGetList(self.corpdb, self.dbCursor, "SELECT max(min_date) FROM (SELECT %s, MIN(%s) as min_date FROM %s where%s AND %s >= '%s' group by %s) as a " % \
+                                         (self.correl_field, dateField, self.corptable, gCond, dateField, maxIntersectDT, self.correl_field))[0][0]
         if not isinstance(minIntersectDT, datetime.datetime):
             minIntersectDT = dtParse(minIntersectDT, ignoretz = True)
             maxIntersectDT = dtParse(maxIntersectDT, ignoretz = True)
@@ -508,7 +508,7 @@ class FeatureRefiner(FeatureGetter):
         ## 3. Get Features x SubIds (in Sparse X form):
         oldFeatures = FeatureGetter(self.corpdb, self.corptable, oldGroupField, self.mysql_host, self.message_field, self.messageid_field, self.encoding, True, self.lexicondb, featureTable)
         dateWhere = "%s >= DATE('%s') AND %s <= DATE('%s')" % (dateField, dtClosestToMin.date(), dateField, dtClosestToMax.date()) #used when querying mids + dates
-        groupsWhere = "group_id in (SELECT %s FROM %s WHERE "%(oldGroupField, self.corptable) +dateWhere+" AND %s in ('%s'))" %(self.correl_field, gList)
+        groupsWhere = "group_id in (SELECT %s FROM %s WHERE "%(oldGroupField, self.corptable) +dateWhere+" AND%s)" % gCond
         #print("groupsWhere", groupsWhere)#debug
         (groupNormsByMid, featureNames) = oldFeatures.getGroupNormsSparseGroupsFirst(where = groupsWhere)
         dlac.warn("""  [done]""")
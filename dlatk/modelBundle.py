@@ -0,0 +1,129 @@
+"""
+Model bundles: a directory format for saved predictors
+
+A bundle holds what RegressionPredictor.save / ClassifyPredictor.save would pickle, split so
+that it loads quickly and can be memory-mapped by several processes at once:
+
+  meta.json              format version, model name, outcomes and the other plain settings
+  featureNames.strings   every feature name as NUL separated utf-8 (sizes of each list in meta.json)
+  arrays/N.npy           every numeric array of at least dlac.MODEL_BUNDLE_ARRAY_BYTES in the
+                         fitted models, scalers and feature selectors (coefficients, means,
+                         scales, PCA components, ...), memory-mapped read-only when loaded
+  objects.pkl            the fitted objects themselves, with those arrays left out
+
+Bundles are written by saving to a path ending with dlac.MODEL_BUNDLE_EXTENSION and are
+recognized by load as directories.
+"""
+import os
+import json
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+from . import dlaConstants as dlac
+
+FORMAT_VERSION = 1
+
+#entries of a saved predictor's dict that are stored in meta.json and featureNames.strings
+META_KEYS = ['modelName', 'multiXOn', 'controlsOrder']
+NAME_KEYS = ['featureNames', 'featureNamesList']
+
+class _ArrayPickler(pickle.Pickler):
+    """Pickles objects, writing their large numeric arrays to .npy files of arrayDir"""
+
+    def __init__(self, f, arrayDir):
+        super(_ArrayPickler, self).__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.arrayDir = arrayDir
+        self.saved = dict() #id(array) -> (file name, array) so shared arrays are saved once
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or obj.nbytes < dlac.MODEL_BUNDLE_ARRAY_BYTES:
+            return None
+        if id(obj) not in self.saved:
+            name = '%d.npy' % len(self.saved)
+            np.save(os.path.join(self.arrayDir, name), obj, allow_pickle=False)
+            self.saved[id(obj)] = (name, obj)
+        return self.saved[id(obj)][0]
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """Unpickles objects written by _ArrayPickler, memory-mapping their arrays"""
+
+    def __init__(self, f, arrayDir, mmapMode):
+        super(_ArrayUnpickler, self).__init__(f)
+        self.arrayDir = arrayDir
+        self.mmapMode = mmapMode
+
+    def persistent_load(self, name):
+        return np.load(os.path.join(self.arrayDir, name), mmap_mode=self.mmapMode, allow_pickle=False)
+
+def _writeNames(path, nameLists):
+    """Writes lists of feature names as one NUL separated utf-8 string table; returns the size of each list"""
+    with open(path, 'wb') as f:
+        for names in nameLists:
+            for name in names:
+                name = str(name)
+                if '\0' in name:
+                    raise ValueError("Feature name %r can't be saved in a model bundle" % name)
+                f.write(name.encode('utf-8') + b'\0')
+    return [len(names) for names in nameLists]
+
+def _readNames(path, sizes):
+    with open(path, 'rb') as f:
+        names = f.read().decode('utf-8').split('\0')
+    (nameLists, start) = ([], 0)
+    for size in sizes:
+        nameLists.append(names[start:start+size])
+        start += size
+    return nameLists
+
+def saveBundle(path, toDump):
+    """Writes the dict a predictor would pickle as a bundle directory at path (replacing any older one)
+
+    Parameters
+    ----------
+    path : str
+        bundle directory
+    toDump : dict
+        modelName, featureNames, featureNamesList and the fitted models, scalers and feature selectors
+        (anything that is not in META_KEYS or NAME_KEYS is pickled to objects.pkl)
+    """
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent): os.makedirs(parent)
+    tmpPath = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+    arrayDir = os.path.join(tmpPath, 'arrays')
+    os.mkdir(arrayDir)
+    nameLists = [toDump.get('featureNames') or []] + list(toDump.get('featureNamesList') or [])
+    meta = dict((k, toDump[k]) for k in META_KEYS if k in toDump)
+    meta['format'] = FORMAT_VERSION
+    meta['featureNameSizes'] = _writeNames(os.path.join(tmpPath, 'featureNames.strings'), nameLists)
+    objects = dict((k, v) for k, v in toDump.items() if k not in META_KEYS and k not in NAME_KEYS)
+    with open(os.path.join(tmpPath, 'objects.pkl'), 'wb') as f:
+        pickler = _ArrayPickler(f, arrayDir)
+        pickler.dump(objects)
+    meta['arrays'] = len(pickler.saved)
+    with open(os.path.join(tmpPath, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.isdir(path): shutil.rmtree(path)
+    os.rename(tmpPath, path)
+
+def loadBundle(path, mmapMode = 'r'):
+    """Reads a bundle directory back into the dict a predictor pickles
+
+    The arrays are memory-mapped (read-only with the default mmapMode), so loading only reads
+    the small pickle of objects and the pages of the arrays that are used, and processes
+    loading the same bundle share those pages.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError("%s is a model bundle of an unknown format (%s)" % (path, meta.get('format')))
+    with open(os.path.join(path, 'objects.pkl'), 'rb') as f:
+        tmp_dict = _ArrayUnpickler(f, os.path.join(path, 'arrays'), mmapMode).load()
+    tmp_dict.update((k, meta[k]) for k in META_KEYS if k in meta)
+    nameLists = _readNames(os.path.join(path, 'featureNames.strings'), meta['featureNameSizes'])
+    tmp_dict['featureNames'] = nameLists[0]
+    tmp_dict['featureNamesList'] = nameLists[1:]
+    return tmp_dict
@@ -5,42 +5,164 @@ import sys, time, datetime, os, getpass
 import MySQLdb
 import re
 import csv
+import tempfile
+import weakref
+import hashlib
+import atexit
+import numbers
 from random import sample
 from math import floor
 
-from dlatk.dlaConstants import USER, MAX_ATTEMPTS, MYSQL_ERROR_SLEEP, MYSQL_HOST, DEF_ENCODING, MAX_SQL_PRINT_CHARS, DEF_UNICODE_SWITCH, DEF_MYSQL_ENGINE, warn
+from dlatk.dlaConstants import USER, MAX_ATTEMPTS, MYSQL_ERROR_SLEEP, MYSQL_PING_INTERVAL, MYSQL_HOST, DEF_ENCODING, MAX_SQL_PRINT_CHARS, DEF_UNICODE_SWITCH, DEF_MYSQL_ENGINE, DEF_COLLATIONS, MYSQL_BATCH_INSERT_SIZE, MYSQL_LOAD_DATA_BATCH_SIZE, MAX_GROUPS_IN_LIST, warn
 
 #DB INFO:
 PASSWD = ''
 
-def executeGetSSCursor(db, sql, warnMsg = True, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH,host=MYSQL_HOST):
-    """Executes a given query (ss cursor is good to iterate over for large returns)"""
-    if warnMsg: 
-        warn("SQL (SSCursor) QUERY: %s"% sql[:MAX_SQL_PRINT_CHARS])
-    ssCursor = dbConnect(db, 
-                         charset=charset, 
-                         use_unicode=use_unicode,
-                         host = host,
-                         )[0].cursor(MySQLdb.cursors.SSCursor)
-    data = []
+#errors meaning LOAD DATA LOCAL INFILE is disabled (server 1148 / 3948, client 2068)
+LOCAL_INFILE_DISABLED_ERRORS = frozenset([1148, 2068, 3948])
+
+## CONNECTION POOL ##
+#process-wide open connections keyed on (db, host, charset, use_unicode):
+#_connectionPool holds one [dbConn, dbCursor, dictCursor, lastUsed] per key,
+#_ssConnectionPool a list of [dbConn, weakref to its last SSCursor, lastUsed] per key
+_connectionPool = dict()
+_ssConnectionPool = dict()
+_poolPid = os.getpid()
+_inheritedConnections = []
+
+def _poolKey(db, host, charset, use_unicode):
+    return (db, host, charset, use_unicode)
+
+def _checkPoolPid():
+    """Empties the pools in a forked child; the parent's sockets are kept referenced, never closed, so it can go on using them"""
+    global _poolPid
+    if _poolPid != os.getpid():
+        _inheritedConnections.extend(_connectionPool.values())
+        _inheritedConnections.extend(_ssConnectionPool.values())
+        _connectionPool.clear()
+        _ssConnectionPool.clear()
+        _poolPid = os.getpid()
+
+def isConnectionAlive(dbConn):
+    """Health check: pings the server over dbConn"""
+    try:
+        dbConn.ping()
+        return True
+    except MySQLdb.Error:
+        return False
+
+def _isHealthy(entry):
+    """Pings a pooled connection when it has sat idle for MYSQL_PING_INTERVAL seconds"""
+    now = time.time()
+    if now - entry[-1] > MYSQL_PING_INTERVAL and not isConnectionAlive(entry[0]):
+        return False
+    entry[-1] = now
+    return True
+
+def getConnection(db, host=MYSQL_HOST, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+    """Returns the pooled (dbConn, dbCursor, dictCursor) for the key (db, host, charset, use_unicode)
+
+    The connection and its cursors are opened on first use and shared by every later caller in the
+    process. A connection that has been idle is health checked before it is handed out and replaced
+    if the server dropped it. Pooled connections must not be closed by the caller.
+    """
+    _checkPoolPid()
+    key = _poolKey(db, host, charset, use_unicode)
+    entry = _connectionPool.get(key)
+    if entry is None or not _isHealthy(entry):
+        entry = list(dbConnect(db, host=host, charset=charset, use_unicode=use_unicode)) + [time.time()]
+        _connectionPool[key] = entry
+    return tuple(entry[:3])
+
+def getSSCursor(db, host=MYSQL_HOST, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+    """Returns a new SSCursor on a pooled connection which has no other SSCursor still open
+
+    An unbuffered result ties up its connection until it is read or the cursor is closed, so a
+    connection is only reused once the cursor last opened on it was closed or garbage collected.
+    """
+    _checkPoolPid()
+    entries = _ssConnectionPool.setdefault(_poolKey(db, host, charset, use_unicode), [])
+    for entry in list(entries):
+        lastCursor = entry[1]() if entry[1] else None
+        if lastCursor is not None and lastCursor.connection is not None:
+            continue #still being read
+        if not _isHealthy(entry):
+            entries.remove(entry)
+            continue
+        ssCursor = entry[0].cursor(MySQLdb.cursors.SSCursor)
+        entry[1] = _weakCursorRef(ssCursor)
+        return ssCursor
+    dbConn = dbConnect(db, host=host, charset=charset, use_unicode=use_unicode)[0]
+    ssCursor = dbConn.cursor(MySQLdb.cursors.SSCursor)
+    entries.append([dbConn, _weakCursorRef(ssCursor), time.time()])
+    return ssCursor
+
+def _weakCursorRef(cursor):
+    try:
+        return weakref.ref(cursor)
+    except TypeError:
+        return lambda: cursor #cursor class without weakref support: never reuse its connection
+
+def _reconnectCursor(db, cursor, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+    """Returns cursor if its connection is still alive, otherwise a cursor of the same class on a fresh connection
+
+    The fresh connection is opened with the arguments of the lost one and takes its place in the pool.
+    """
+    dbConn = cursor.connection
+    if dbConn is not None and isConnectionAlive(dbConn):
+        return cursor
+    connectArgs = dict(db=db, host=MYSQL_HOST, charset=charset, use_unicode=use_unicode)
+    if dbConn is not None:
+        connectArgs.update(getattr(dbConn, 'dlatkConnectArgs', {}))
+    newConn = dbConnect(**connectArgs)[0]
+    _checkPoolPid()
+    key = _poolKey(connectArgs['db'], connectArgs['host'], connectArgs['charset'], connectArgs['use_unicode'])
+    entry = _connectionPool.get(key)
+    if dbConn is not None and entry is not None and entry[0] == dbConn:
+        _connectionPool[key] = [newConn, newConn.cursor(), newConn.cursor(MySQLdb.cursors.DictCursor), time.time()]
+    for entry in _ssConnectionPool.get(key, []):
+        if dbConn is not None and entry[0] == dbConn:
+            entry[0] = newConn
+    return newConn.cursor(type(cursor))
+
+def _executeWithRetries(db, cursor, run, sql, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+    """Calls run(cursor), retrying on MySQL errors
+
+    Between attempts the connection is health checked and, if it was lost, the query is retried on a
+    reconnected cursor (see _reconnectCursor). Exits after MAX_ATTEMPTS failed retries.
+
+    Returns
+    -------
+    tuple
+        (what run returned, the cursor it finally ran on)
+    """
     attempts = 0;
     while (1):
         try:
-            ssCursor.execute(sql)
-            break
+            return run(cursor), cursor
         except MySQLdb.Error as e:
             attempts += 1
             warn(" *MYSQL Corpus DB ERROR on %s:\n%s (%d attempt)"% (sql, e, attempts))
-            time.sleep(MYSQL_ERROR_SLEEP*attempts**2)
-            ssCursor = dbConnect(db, charset=charset, use_unicode=use_unicode)[0].cursor(MySQLdb.cursors.SSCursor)
             if (attempts > MAX_ATTEMPTS):
                 sys.exit(1)
-    return ssCursor
+            time.sleep(MYSQL_ERROR_SLEEP)
+            cursor = _reconnectCursor(db, cursor, charset=charset, use_unicode=use_unicode)
 
-def dbConnect(db, host=MYSQL_HOST, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
-    """ Connects to specified database. Returns tuple of (dbConn, dbCursor, dictCursor) """
+def executeGetSSCursor(db, sql, warnMsg = True, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH,host=MYSQL_HOST):
+    """Executes a given query (ss cursor is good to iterate over for large returns)"""
+    if warnMsg: 
+        warn("SQL (SSCursor) QUERY: %s"% sql[:MAX_SQL_PRINT_CHARS])
+    ssCursor = getSSCursor(db, host=host, charset=charset, use_unicode=use_unicode)
+    return _executeWithRetries(db, ssCursor, lambda c: c.execute(sql), sql, charset=charset, use_unicode=use_unicode)[1]
+
+def dbConnect(db, host=MYSQL_HOST, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, local_infile=False):
+    """ Connects to specified database. Returns tuple of (dbConn, dbCursor, dictCursor) 
+
+    This always opens a new connection; use getConnection for a pooled one.
+    """
     dbConn = None
     attempts = 0;
+    extraArgs = {'local_infile': 1} if local_infile else {}
     while (1):
         try:
             dbConn = MySQLdb.connect (
@@ -49,7 +171,8 @@ def dbConnect(db, host=MYSQL_HOST, charset=DEF_ENCODING, use_unicode=DEF_UNICODE
                 db = db,
                 charset = charset,
                 use_unicode = use_unicode, 
-                read_default_file = "~/.my.cnf"
+                read_default_file = "~/.my.cnf",
+                **extraArgs
             )
             break
         except MySQLdb.Error as e:
@@ -58,6 +181,8 @@ def dbConnect(db, host=MYSQL_HOST, charset=DEF_ENCODING, use_unicode=DEF_UNICODE
             time.sleep(MYSQL_ERROR_SLEEP)
             if (attempts > MAX_ATTEMPTS):
                 sys.exit(1)
+    #remembered so a lost connection can be reopened the same way
+    dbConn.dlatkConnectArgs = dict(db=db, host=host, charset=charset, use_unicode=use_unicode, local_infile=local_infile)
     dbCursor = dbConn.cursor()
     dictCursor = dbConn.cursor(MySQLdb.cursors.DictCursor)
     return dbConn, dbCursor, dictCursor
@@ -69,16 +194,16 @@ def abstractDBConnect(db, host=MYSQL_HOST, user=USER):
     dbCursor = dbConn.cursor()
     return (dbConn, dbCursor)
 
-def getTableColumnNames(db, table, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+def getTableColumnNames(db, table, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
     """Returns a list of column names from a db table"""
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
     sql = "SELECT column_name FROM information_schema.columns WHERE table_schema='%s' AND table_name='%s'"%(db, table)
-    columnNamesOfTable = executeGetList(db, dbCursor, sql)
+    columnNamesOfTable = executeGetList(db, dbCursor, sql, charset=charset, use_unicode=use_unicode)
     return [x[0] for x in columnNamesOfTable]
 
-def getTableColumnNamesTypes(db, table, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+def getTableColumnNamesTypes(db, table, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
     """Returns a list of column names and types from a db table"""
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
     sql = "SELECT column_name, column_type FROM information_schema.columns WHERE table_schema='%s' AND table_name='%s'"%(db, table)
     return executeGetList(db, dbCursor, sql, charset=charset, use_unicode=use_unicode)
 
@@ -100,77 +225,44 @@ def execute( db, dbCursor, sql, warnQuery=True, charset=DEF_ENCODING, use_unicod
     """Executes a given query"""
     if warnQuery:
         warn("SQL QUERY: %s"% sql[:MAX_SQL_PRINT_CHARS])
-    attempts = 0;
-    while (1):
-        try:
-            dbCursor.execute(sql)
-            break
-        except MySQLdb.Error as e:
-            attempts += 1
-            warn(" *MYSQL Corpus DB ERROR on %s:\n%s (%d attempt)"% (sql, e, attempts))
-            time.sleep(MYSQL_ERROR_SLEEP)
-            (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
-            if (attempts > MAX_ATTEMPTS):
-                sys.exit(1)
+    _executeWithRetries(db, dbCursor, lambda c: c.execute(sql), sql, charset=charset, use_unicode=use_unicode)
     return True
 
-def qExecute( db, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
-    """performs the db connect and execute in the same call"""
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)    
+def qExecute( db, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+    """performs the execute on the pooled connection for db"""
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
     return execute( db, dbCursor, sql, warnQuery, charset=charset, use_unicode=use_unicode)
 
+def _fetchAll(sql):
+    def run(cursor):
+        cursor.execute(sql)
+        return cursor.fetchall()
+    return run
+
 def executeGetDict( db, dictCursor, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
     """Executes a given query, returns results as a list of dicts"""
     if warnQuery:
         warn("SQL (DictCursor) QUERY: %s"% sql[:MAX_SQL_PRINT_CHARS])
-    data = []
-    attempts = 0;
-    while (1):
-        try:
-            dictCursor.execute(sql)
-            data = dictCursor.fetchall()
-            break
-        except MySQLdb.Error as e:
-            attempts += 1
-            warn(" *MYSQL Corpus DB ERROR on %s:\n%s (%d attempt)"% (sql, e, attempts))
-            time.sleep(MYSQL_ERROR_SLEEP)
-            (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
-            if (attempts > MAX_ATTEMPTS):
-                sys.exit(1)
-    return data
+    return _executeWithRetries(db, dictCursor, _fetchAll(sql), sql, charset=charset, use_unicode=use_unicode)[0]
 
 def executeGetList( db, dbCursor, sql, warnQuery=True, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
     """Executes a given query, returns results as a list of lists"""
     if warnQuery:
         warn("SQL QUERY: %s"% sql[:MAX_SQL_PRINT_CHARS])
-    data = []
-    attempts = 0;
-    while (1):
-        try:
-            dbCursor.execute(sql)
-            data = dbCursor.fetchall()
-            break
-        except MySQLdb.Error as e:
-            attempts += 1
-            warn(" *MYSQL Corpus DB ERROR on %s:\n%s (%d attempt)"% (sql, e, attempts))
-            time.sleep(MYSQL_ERROR_SLEEP)
-            (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
-            if (attempts > MAX_ATTEMPTS):
-                sys.exit(1)
-    return data
+    return _executeWithRetries(db, dbCursor, _fetchAll(sql), sql, charset=charset, use_unicode=use_unicode)[0]
 
 def executeGetList1( db, dbCursor, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
     """Executes a given query, expecting one resulting column. Returns results as a list"""
     return [x[0] for x in executeGetList( db, dbCursor, sql, warnQuery, charset=charset, use_unicode=use_unicode)]
 
-def qExecuteGetList( db, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
-    """performs the db connect and execute in the same call"""
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)    
+def qExecuteGetList( db, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+    """performs executeGetList on the pooled connection for db"""
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
     return executeGetList( db, dbCursor, sql, warnQuery, charset=charset, use_unicode=use_unicode)
 
-def qExecuteGetList1( db, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
-    """performs the db connect and execute in the same call, equivalent to executeGetList1"""
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)    
+def qExecuteGetList1( db, sql, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+    """performs executeGetList1 on the pooled connection for db"""
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
     return executeGetList1( db, dbCursor, sql, warnQuery, charset=charset, use_unicode=use_unicode)
 
 def executeWrite( db, dbConn, sql, row, writeCursor=None , warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
@@ -179,24 +271,11 @@ def executeWrite( db, dbConn, sql, row, writeCursor=None , warnQuery=False, char
         warn("SQL (write many) QUERY: %s"% sql)                                                 
     if not writeCursor:
         writeCursor = dbConn.cursor()
-    attempts = 0;
-    while (1):
-        try:
-            writeCursor.execute(sql, row)
-            break
-        except MySQLdb.Error as e:
-            attempts += 1
-            warn(" *MYSQL Corpus DB ERROR on %s:\n%s (%d attempt)"% (sql, e, attempts))
-            time.sleep(MYSQL_ERROR_SLEEP)
-            (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
-            writeCursor = dbConn.cursor()
-            if (attempts > MAX_ATTEMPTS):
-                sys.exit(1)
-    return writeCursor
+    return _executeWithRetries(db, writeCursor, lambda c: c.execute(sql, row), sql, charset=charset, use_unicode=use_unicode)[1]
 
-def doesTableExist( db, table, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+def doesTableExist( db, table, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
     sql = 'show tables in %s'%db
-    tables = qExecuteGetList1(db, sql, charset=charset, use_unicode=use_unicode)
+    tables = qExecuteGetList1(db, sql, charset=charset, use_unicode=use_unicode, host=host)
     return table in tables
 
 def executeWriteMany( db, dbConn, sql, rows, writeCursor=None, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
@@ -205,25 +284,178 @@ def executeWriteMany( db, dbConn, sql, rows, writeCursor=None, warnQuery=False,
         warn("SQL (write many) QUERY: %s"% sql)                                                 
     if not writeCursor:
         writeCursor = dbConn.cursor()
-    attempts = 0;
-    while (1):
+    return _executeWithRetries(db, writeCursor, lambda c: c.executemany(sql, rows), sql, charset=charset, use_unicode=use_unicode)[1]
+
+def qExecuteWriteMany(db, sql, rows, writeCursor=None, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+    """Executes a write query on the pooled connection for db"""
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
+    return executeWriteMany(db, dbConn, sql, rows, writeCursor, warnQuery, charset=charset, use_unicode=use_unicode)
+
+## GROUP TABLES ##
+#tables holding large group sets, keyed on (db, host, digest of the groups) => (table, charset, use_unicode);
+#they are ordinary tables (an SSCursor runs on its own connection and would not see a TEMPORARY one),
+#named with the pid of the process that made them and dropped by it at exit
+_groupTables = dict()
+_groupTablesPid = os.getpid()
+
+_MYISAM_MAX_KEY_BYTES = 1000
+_CHARSET_MAX_BYTES = {'utf8mb4': 4, 'utf8': 3}
+
+def _dropGroupTables():
+    if _groupTablesPid != os.getpid():
+        return #a forked child only borrowed the parent's tables
+    for ((db, host, digest), (table, charset, use_unicode)) in list(_groupTables.items()):
         try:
-            writeCursor.executemany(sql, rows)
-            break
+            (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
+            dbCursor.execute("DROP TABLE IF EXISTS %s" % table)
         except MySQLdb.Error as e:
-            attempts += 1
-            warn(" *MYSQL Corpus DB ERROR on %s:\n%s (%d attempt)"% (sql, e, attempts))
-            time.sleep(MYSQL_ERROR_SLEEP)
-            (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
-            writeCursor = dbConn.cursor()
-            if (attempts > MAX_ATTEMPTS):
-                sys.exit(1)
-    return writeCursor
+            warn("Could not drop group table %s: %s" % (table, e))
+    _groupTables.clear()
+
+def getGroupTable(db, groups, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+    """Returns the name of an indexed table holding the given group ids in the column group_id
+
+    The table is written once per process for each distinct group set and reused by later calls.
+    """
+    global _groupTablesPid
+    groups = sorted(set(groups), key=str)
+    digest = hashlib.md5('\x00'.join(str(g) for g in groups).encode('utf-8')).hexdigest()[:16]
+    key = (db, host, digest)
+    if key in _groupTables:
+        return _groupTables[key][0]
+    if not _groupTables:
+        _groupTablesPid = os.getpid()
+    table = "tmp_groups$%d$%s" % (os.getpid(), digest)
+    if all(isinstance(g, numbers.Integral) for g in groups):
+        colType = 'BIGINT'
+    else:
+        #MyISAM keys are limited to 1000 bytes, and the key reserves the charset's widest character for each position
+        colType = 'VARCHAR(%d)' % min(255, _MYISAM_MAX_KEY_BYTES // _CHARSET_MAX_BYTES.get(charset.lower(), 1))
+    (dbConn, dbCursor, dictCursor) = getConnection(db, host=host, charset=charset, use_unicode=use_unicode)
+    execute(db, dbCursor, "DROP TABLE IF EXISTS %s" % table, charset=charset, use_unicode=use_unicode)
+    execute(db, dbCursor, "CREATE TABLE %s (group_id %s NOT NULL, PRIMARY KEY (group_id)) ENGINE=%s CHARACTER SET %s COLLATE %s" % (table, colType, DEF_MYSQL_ENGINE, charset, DEF_COLLATIONS[charset.lower()]), charset=charset, use_unicode=use_unicode)
+    warn("Loading %d groups into %s" % (len(groups), table))
+    #the default collations ignore case, so 'Bob' and 'bob' are one key, just as they match each other in an in list
+    sql = "INSERT IGNORE INTO %s (group_id) VALUES (%%s)" % table
+    for i in range(0, len(groups), MYSQL_BATCH_INSERT_SIZE):
+        executeWriteMany(db, dbConn, sql, [(g, ) for g in groups[i:i+MYSQL_BATCH_INSERT_SIZE]], writeCursor=dbConn.cursor(), charset=charset, use_unicode=use_unicode)
+    dbConn.commit()
+    if not _groupTables:
+        atexit.register(_dropGroupTables)
+    _groupTables[key] = (table, charset, use_unicode)
+    return table
+
+def groupIdCondition(db, groups, column='group_id', charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+    """Returns a where condition restricting column to the given groups
+
+    Up to MAX_GROUPS_IN_LIST groups are listed: " group_id in ('a','b',...)". Larger sets are
+    loaded into an indexed table (see getGroupTable) and matched with a semi-join,
+    " group_id in (SELECT group_id FROM tmp_groups$...)", which keeps the query short and lets
+    MySQL join on the primary key rather than parse and search a huge list.
+    """
+    if len(groups) <= MAX_GROUPS_IN_LIST:
+        return " %s in ('%s')" % (column, "','".join(str(g) for g in groups))
+    table = getGroupTable(db, groups, charset=charset, use_unicode=use_unicode, host=host)
+    return " %s in (SELECT group_id FROM %s)" % (column, table)
+
+def _loadDataField(value, charset=DEF_ENCODING):
+    """Formats a value as a field of a LOAD DATA tab-separated file"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        value = value.decode(_pythonCodec(charset))
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+
+def _pythonCodec(charset):
+    """Maps a MySQL character set to a python codec"""
+    return 'utf-8' if charset.lower().startswith('utf8') else charset
+
+def executeLoadData(db, dbConn, table, columns, rows, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
+    """Bulk writes rows by spooling them to a temporary TSV file and issuing LOAD DATA LOCAL INFILE
+
+    dbConn should be opened with dbConnect(..., local_infile=True). If local infile is disabled on
+    the client or the server the rows are written with executeWriteMany instead.
+
+    Returns
+    -------
+    boolean
+        True if the rows were bulk loaded, False if it fell back to executeWriteMany
+    """
+    tsv = tempfile.NamedTemporaryFile(mode='w', encoding=_pythonCodec(charset), suffix='.tsv', prefix='dlatk_', delete=False)
+    try:
+        for row in rows:
+            tsv.write('\t'.join(_loadDataField(v, charset) for v in row) + '\n')
+        tsv.close()
+        sql = """LOAD DATA LOCAL INFILE '%s' INTO TABLE %s CHARACTER SET %s (%s)""" % (
+            tsv.name, table, charset, ', '.join(columns))
+        if warnQuery:
+            warn("SQL (load data) QUERY: %s"% sql)
+        def load(cursor):
+            try:
+                cursor.execute(sql)
+                return True
+            except MySQLdb.Error as e:
+                if e.args and e.args[0] in LOCAL_INFILE_DISABLED_ERRORS:
+                    warn(" *LOAD DATA LOCAL INFILE is disabled (%s), falling back to executeWriteMany"% e)
+                    return False
+                raise
+        if _executeWithRetries(db, dbConn.cursor(), load, sql, charset=charset, use_unicode=use_unicode)[0]:
+            return True
+    finally:
+        if not tsv.closed: tsv.close()
+        os.remove(tsv.name)
+
+    wsql = """INSERT INTO %s (%s) VALUES (%s)""" % (table, ', '.join(columns), ', '.join(['%s']*len(columns)))
+    for i in range(0, len(rows), MYSQL_BATCH_INSERT_SIZE):
+        executeWriteMany(db, dbConn, wsql, rows[i:i+MYSQL_BATCH_INSERT_SIZE], writeCursor=dbConn.cursor(), charset=charset, use_unicode=use_unicode)
+    return False
+
+class BulkWriter(object):
+    """Buffers rows headed for one table and writes them in large batches
+
+    With localInfile the batches are written by executeLoadData (LOAD DATA LOCAL INFILE), otherwise,
+    or once the server has refused local infile, by executeWriteMany in MYSQL_BATCH_INSERT_SIZE chunks.
+
+    Examples
+    --------
+    >>> writer = BulkWriter(db, 'feat$1gram$msgs$user_id', ['group_id', 'feat', 'value', 'group_norm'], localInfile=True)
+    >>> writer.write(rows)
+    >>> writer.close()
+    """
+
+    def __init__(self, db, table, columns, localInfile=False, batchSize=None, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH, host=MYSQL_HOST):
+        self.db = db
+        self.table = table
+        self.columns = list(columns)
+        self.localInfile = localInfile
+        self.batchSize = batchSize if batchSize else (MYSQL_LOAD_DATA_BATCH_SIZE if localInfile else MYSQL_BATCH_INSERT_SIZE)
+        self.charset = charset
+        self.use_unicode = use_unicode
+        self.host = host
+        (self.dbConn, self.dbCursor, self.dictCursor) = dbConnect(db, host=host, charset=charset, use_unicode=use_unicode, local_infile=localInfile)
+        self.wsql = """INSERT INTO %s (%s) VALUES (%s)""" % (table, ', '.join(self.columns), ', '.join(['%s']*len(self.columns)))
+        self.rows = []
+
+    def write(self, rows):
+        """Adds rows to the buffer, flushing it when it is full"""
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows to the table"""
+        if not self.rows: return
+        if self.localInfile:
+            self.localInfile = executeLoadData(self.db, self.dbConn, self.table, self.columns, self.rows, charset=self.charset, use_unicode=self.use_unicode)
+        else:
+            for i in range(0, len(self.rows), MYSQL_BATCH_INSERT_SIZE):
+                executeWriteMany(self.db, self.dbConn, self.wsql, self.rows[i:i+MYSQL_BATCH_INSERT_SIZE], writeCursor=self.dbConn.cursor(), charset=self.charset, use_unicode=self.use_unicode)
+        self.rows = []
 
-def qExecuteWriteMany(db, sql, rows, writeCursor=None, warnQuery=False, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
-    """Executes a write query"""
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
-    return executeWriteMany(db, dbConn, sql, rows, writeCursor, warnQuery, charset=charset, use_unicode=use_unicode)
+    def close(self):
+        """Flushes remaining rows and closes the connection"""
+        self.flush()
+        self.dbConn.close()
 
 def gen_clone_query(conn, src_tbl, dst_tbl):
     try:
@@ -259,7 +491,7 @@ def cloneExactTable(db, sourceTableName, destinationTableName, charset=DEF_ENCOD
     warn("making TABLE %s, an exact copy of TABLE %s..."%(destinationTableName, sourceTableName))
 
     warn("connecting to DATABASE %s..."%(db))
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
+    (dbConn, dbCursor, dictCursor) = getConnection(db, charset=charset, use_unicode=use_unicode)
 
     warn("cloning structure of table...")
     cloneQuery = gen_clone_query( dbConn, sourceTableName, destinationTableName )
@@ -275,7 +507,7 @@ def randomSubsetTable( db, sourceTableName, destinationTableName, keyField, perc
     warn("making TABLE %s, a %2.2f percent random subset of TABLE %s on unique key %s..."%(destinationTableName, percentToSubset, sourceTableName, keyField))
 
     warn("connecting to DATABASE %s..."%(db))
-    (dbConn, dbCursor, dictCursor) = dbConnect(db, charset=charset, use_unicode=use_unicode)
+    (dbConn, dbCursor, dictCursor) = getConnection(db, charset=charset, use_unicode=use_unicode)
 
     warn("removing destination table if it exists...")
     sql = 'DROP TABLE IF EXISTS %s'%(destinationTableName)
@@ -303,7 +535,7 @@ def randomSubsetTable( db, sourceTableName, destinationTableName, keyField, perc
     
 
 def writeTableToCSV(db, tableName, outputfile, sql_extra=None, charset=DEF_ENCODING, use_unicode=DEF_UNICODE_SWITCH):
-    (cur, conn, dcur) = dbConnect(db, charset=charset, use_unicode=use_unicode)
+    (conn, cur, dcur) = getConnection(db, charset=charset, use_unicode=use_unicode)
     sql = 'SELECT * FROM %s'%tableName
     if sql_extra:
         sql += ' ' + sql_extra
@@ -4,7 +4,7 @@ import re
 import csv
 import gzip
 import multiprocessing
-from itertools import combinations
+from itertools import combinations, islice, chain
 from pprint import pprint
 from configparser import SafeConfigParser
 
@@ -14,7 +14,8 @@ from statistics import mean, stdev
 from numpy import array, tile, sqrt, fabs, multiply, mean, isnan, std
 from numpy import log as nplog, sort as npsort, append as npappend
 import numpy as np
-from scipy.stats import zscore, rankdata, norm
+from scipy.stats import zscore, rankdata, norm, t as tDist
+from scipy.sparse import csc_matrix
 from scipy.stats.stats import pearsonr, spearmanr
 import statsmodels.api as sm
 from sklearn.metrics import roc_auc_score
@@ -28,6 +29,73 @@ from .mysqlmethods import mysqlMethods as mm
 from .lib.wordcloud import freqToColor
 
 
+_featWorkerJob = None #(func, groups, allOutcomes, controls, featFreqs, options) of the forked worker processes
+
+def _initFeatWorker(*job):
+    """Keeps the job shared by all the features a worker process is handed (see OutcomeAnalyzer._mapFeats)"""
+    global _featWorkerJob
+    _featWorkerJob = job
+
+def _featWorker(task):
+    """Runs the worker's job on one (featNum, feat, featData, numFeats) and returns (feat, result)"""
+    (func, groups, allOutcomes, controls, featFreqs, options) = _featWorkerJob
+    (featNum, feat, featData, numFeats) = task
+    return (feat, func(featNum, feat, featData, numFeats, groups, allOutcomes, controls, featFreqs, **options))
+
+_permutationData = None #(x, y) shared arrays of the permutation worker processes
+
+def _initPermutationWorker(x, y):
+    global _permutationData
+    _permutationData = (x, y)
+
+def _permutationWorker(task):
+    """Scores numPerms permutations of the (numRows x numCols) data last written to the shared arrays"""
+    (numRows, numCols, hasControls, check, numPerms) = task
+    X = np.frombuffer(_permutationData[0])[:numRows*numCols].reshape(numRows, numCols)
+    y = np.frombuffer(_permutationData[1])[:numRows]
+    Xc = X[:, :-1] if hasControls else None
+    Xend = X[:, -1:] if hasControls else X[:, -1]
+    return dlac.permutationChecks((Xc, Xend, y, check, numPerms))
+
+class PermutationPool(object):
+    """Worker processes kept for all the permutation tests of an analysis
+
+    The data of each test is written once to shared memory, which the workers read,
+    and the permutations are split into a few tasks per worker.
+
+    Parameters
+    ----------
+    maxRows : int
+        largest number of groups in a test
+    maxCols : int
+        largest number of columns (controls and the feature) in a test
+    processes : :obj:`int`, optional
+        number of worker processes (default CORES/3)
+    """
+
+    def __init__(self, maxRows, maxCols, processes = None):
+        self.processes = processes or max(1, int(dlac.CORES/3))
+        self.x = multiprocessing.RawArray('d', max(1, maxRows * maxCols))
+        self.y = multiprocessing.RawArray('d', max(1, maxRows))
+        self.pool = multiprocessing.Pool(self.processes, initializer = _initPermutationWorker, initargs = (self.x, self.y))
+
+    def countAbove(self, Xc, Xend, y, check, numPerms):
+        """Returns the number of numPerms permutations of Xend with an auc above check (see dlac.permutationChecks)"""
+        X = np.column_stack(([Xc] if Xc is not None else []) + [np.asarray(Xend, dtype=float).reshape(-1, 1)])
+        (numRows, numCols) = X.shape
+        if numRows * numCols > len(self.x) or numRows > len(self.y):
+            return dlac.permutationChecks((Xc, Xend, y, check, numPerms))
+        np.frombuffer(self.x)[:numRows*numCols] = X.ravel()
+        np.frombuffer(self.y)[:numRows] = y
+        permsPerTask = max(1, min(dlac.PERMUTATIONS_PER_TASK, -(-numPerms // self.processes)))
+        tasks = [(numRows, numCols, Xc is not None, check, min(permsPerTask, numPerms - done)) for done in range(0, numPerms, permsPerTask)]
+        return sum(self.pool.map(_permutationWorker, tasks))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
 class OutcomeAnalyzer(OutcomeGetter):
     """
     Deals with Outcome Tables and provides various
@@ -197,7 +265,7 @@ class OutcomeAnalyzer(OutcomeGetter):
         raise NotImplementedError()
 
 
-    def yieldDataForOneFeatAtATime(self, featGetter, blacklist=None, whitelist=None, outcomeWithOutcome=False, includeFreqs = False, groupsWhere = '', outcomeWithOutcomeOnly = False, ):
+    def yieldDataForOneFeatAtATime(self, featGetter, blacklist=None, whitelist=None, outcomeWithOutcome=False, includeFreqs = False, groupsWhere = '', outcomeWithOutcomeOnly = False, sparse = False):
         """
         Finds the correlations between features and outcomes
 
@@ -217,6 +285,10 @@ class OutcomeAnalyzer(OutcomeGetter):
             outcomeWithOutcomeOnly : :obj:`boolean`, optional
                 True - only correlate outcomes with outcomes
                 False - correlate features with outcomes
+            sparse : :obj:`boolean`, optional
+                yield the data of features as (group indices, group norms) of the groups having them
+                (see featGetter.yieldSparseGroupNormsByFeat) instead of dicts with zeros filled in;
+                outcomes yielded as features are still dicts
 
 
         Yields
@@ -246,7 +318,7 @@ class OutcomeAnalyzer(OutcomeGetter):
         assert len(groups) > 0, "Something is wrong, there aren't any groups left. Maybe the group_freq_thresh is too high, maybe your group field columns are different types"
         featFreqs = None
         if includeFreqs:
-            where = """ group_id in ('%s')""" % ("','".join(str(g) for g in groups))
+            where = self.groupsCondition(groups)
             if outcomeWithOutcomeOnly:
                 featFreqs = dict([('outcome_'+k, len(v)) for k, v in allOutcomes.items()])
             else:
@@ -283,7 +355,11 @@ class OutcomeAnalyzer(OutcomeGetter):
         # _warn('these are the features of yield...')
         # _warn(str(featsToYield))
         if not outcomeWithOutcomeOnly:
-            for (feat, dataDict, numFeats) in featGetter.yieldGroupNormsWithZerosByFeat(groups, feats = featsToYield): #switched to iter
+            if sparse:
+                featYielder = ((ft[0], ft[1:3], ft[-1]) for ft in featGetter.yieldSparseGroupNormsByFeat(groups, feats = featsToYield))
+            else:
+                featYielder = featGetter.yieldGroupNormsWithZerosByFeat(groups, feats = featsToYield)
+            for (feat, dataDict, numFeats) in featYielder: #switched to iter
                 #Apply Whitelist, Blacklist
                 if blacklist:
                     bl = False
@@ -377,13 +453,13 @@ class OutcomeAnalyzer(OutcomeGetter):
         freqsDict = {}
         for i, gs in enumerate([groups, sample1, sample2]):
             if i == 0:
-                sql = "select feat, sum(value), sum(group_norm) from %s where group_id in ('%s') group by feat" % (featGetter.featureTable, "', '".join(str(i) for i in gs))
+                sql = "select feat, sum(value), sum(group_norm) from %s where%s group by feat" % (featGetter.featureTable, self.groupsCondition(gs))
                 # fill in dictionary for 1st time
                 res = mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)
                 values = {feat: [float(gn)] for feat, freq, gn in res}
                 freqsDict = {feat: int(freq) for feat, freq, gn in res}
             else:
-                sql = "select feat, sum(group_norm) from %s where group_id in ('%s') group by feat" % (featGetter.featureTable, "', '".join(str(i) for i in gs))
+                sql = "select feat, sum(group_norm) from %s where%s group by feat" % (featGetter.featureTable, self.groupsCondition(gs))
                 new_values = {feat: gn for feat, gn in mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)}
                 for feat, gnList in values.items():
                     gnList.append(new_values.get(feat, 0))
@@ -464,7 +540,7 @@ class OutcomeAnalyzer(OutcomeGetter):
             freqs = {}
             for value in labels:
                 good_groups = [i for i in outcome_groups if allOutcomes[outcome][i]==value]
-                sql = "select feat, sum(value), sum(group_norm) from %s where group_id in ('%s')" % (featGetter.featureTable, "','".join([str(i) for i in good_groups]))
+                sql = "select feat, sum(value), sum(group_norm) from %s where%s" % (featGetter.featureTable, self.groupsCondition(good_groups))
                 sql += " group by feat"
                 value_dict = {feat : {'value': int(value), 'group_norm': group_norm} for feat, value, group_norm in mm.executeGetList(self.corpdb, self.dbCursor, sql, charset=self.encoding, use_unicode=self.use_unicode)}
 
@@ -574,10 +650,349 @@ class OutcomeAnalyzer(OutcomeGetter):
             if numFeatsDone % 200 == 0: print("%6d features z-scored" % numFeatsDone)
         return correls
 
+    def _mapFeats(self, func, featYields, options, cores = 1):
+        """Applies func to every feature from yieldDataForOneFeatAtATime, yielding (feat, result) in order
+
+        func is called as func(featNum, feat, featData, numFeats, groups, allOutcomes, controls, featFreqs, **options)
+        where featNum counts features from 1 and featData is what was yielded as the feature's data. With
+        cores > 1 features are handed out in partitions to worker processes, which are forked with the
+        groups, outcomes, controls and featFreqs so that only the data of each feature is sent to them.
+        func is a bound method, so where fork is not available the features are run here instead.
+        """
+        self._alignedOutcomes = dict() #filled by _alignFeatAsXy
+        featYields = iter(featYields)
+        first = next(featYields, None)
+        if first is None: return
+        (groups, allOutcomes, controls, feat, featData, numFeats, featFreqs) = first
+        #the first feature is always run here (it prints the summaries of the controls)
+        yield (feat, func(1, feat, featData, numFeats, groups, allOutcomes, controls, featFreqs, **options))
+        tasks = ((featNum, y[3], y[4], y[5]) for featNum, y in enumerate(featYields, 2))
+        if cores > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            dlac.warn("Worker processes cannot be forked on this platform; correlating in one process")
+            cores = 1
+        if cores <= 1:
+            for (featNum, feat, featData, numFeats) in tasks:
+                yield (feat, func(featNum, feat, featData, numFeats, groups, allOutcomes, controls, featFreqs, **options))
+            return
+
+        dlac.warn("Correlating with %d worker processes" % cores)
+        partitionSize = dlac.FEATS_PER_WORKER_TASK
+        pool = multiprocessing.get_context('fork').Pool(cores, initializer = _initFeatWorker, initargs = (func, groups, allOutcomes, controls, featFreqs, options))
+        try:
+            while True:
+                featBatch = list(islice(tasks, cores * partitionSize * 4))
+                if not featBatch: break
+                for result in pool.imap(_featWorker, featBatch, chunksize = partitionSize):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def _alignFeatAsXy(self, groups, featData, outcomes, controlValues = ()):
+        """Aligns a feature from yieldDataForOneFeatAtATime(sparse = True) with an outcome and controls
+
+        Returns (X, y) as numpy arrays, as dlac.alignDictsAsXy(controlValues + [dataDict], outcomes) would for
+        the feature with its zeros filled in: the rows are the groups with the outcome and every control, and the
+        last column of X is the feature. The rows, outcome and controls are only aligned once per analysis.
+        """
+        if isinstance(featData, dict): #an outcome yielded as a feature
+            (X, y) = dlac.alignDictsAsXy(list(controlValues) + [featData], outcomes)
+            return (np.array(X, dtype=float).reshape(len(y), len(controlValues) + 1), np.array(y, dtype=float))
+        if not hasattr(self, '_alignedOutcomes'): self._alignedOutcomes = dict()
+        key = (id(groups), id(outcomes)) + tuple(id(c) for c in controlValues)
+        aligned = self._alignedOutcomes.get(key)
+        if aligned is None:
+            rows = [i for i, g in enumerate(groups) if g in outcomes and all(g in c for c in controlValues)]
+            y = np.array([float(outcomes[groups[i]]) for i in rows])
+            Xc = np.array([[float(c[groups[i]]) for c in controlValues] for i in rows]).reshape(len(rows), len(controlValues))
+            #the keyed objects are kept so that their ids are not reused while cached
+            aligned = self._alignedOutcomes[key] = (np.array(rows, dtype=int), y, Xc, (groups, outcomes, controlValues))
+        (rows, y, Xc) = aligned[:3]
+        x = np.zeros(len(groups))
+        x[featData[0]] = featData[1]
+        return (np.column_stack([Xc, x[rows]]), y)
+
+    def correlateFeatsAsMatrix(self, featGetter, spearman = False, blacklist=None, whitelist=None, includeFreqs = False,
+                               zscoreRegression = True, groupsWhere = '', bonferroni = False):
+        """Finds the linear correlations between features and outcomes for all features at once
+
+        Gives the same results as running pearson / spearman correlation (no controls)
+        or OLS (with controls) one feature at a time, but the controls are residualized
+        once per outcome and the coefficients, t and p-values of blocks of features are
+        computed as matrix products (Frisch-Waugh-Lovell).
+
+        Parameters
+        ----------
+        featGetter : featureGetter object
+        spearman : :obj:`boolean`, optional
+        blacklist : :obj:`list`, optional
+            list of feature table fields (str) to ignore
+        whitelist : :obj:`list`, optional
+            list of feature table fields (str) to include
+        includeFreqs : :obj:`boolean`, optional
+            Include the frequency of each feature if True
+        zscoreRegression : :obj:`boolean`, optional
+            standard both variables if True
+        groupsWhere : :obj:`str`, optional
+            string specified with the --where flag containing a sql statement for filtering
+        bonferroni : :obj:`boolean`, optional
+            multiply p-values by the number of features
+
+        Returns
+        --------
+        correls : dict
+            dict of outcome=>feature=>(R, p, numGroups, CI, featFreqs)
+        """
+        #gather the group norms of every feature into a sparse groups x feats matrix
+        (feats, rows, cols, vals) = ([], [], [], [])
+        for (groups, allOutcomes, controls, feat, (idx, gns), numFeats, featFreqs) in self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, False, includeFreqs, groupsWhere, sparse = True):
+            rows.append(idx)
+            cols.append(np.full(len(idx), len(feats), dtype=int))
+            vals.append(gns)
+            feats.append(feat)
+        correls = dict()
+        if not feats:
+            return correls
+        gnMatrix = csc_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(len(groups), len(feats)))
+        del rows, cols, vals
+        dlac.warn("Correlating %d features as a matrix" % len(feats))
+
+        controlKeys = list(controls.keys())
+        nan = float('nan')
+        for outcomeField, outcomes in allOutcomes.items():
+            keep = [i for i, g in enumerate(groups) if g in outcomes and all(g in controls[k] for k in controlKeys)]
+            n = len(keep)
+            y = np.array([float(outcomes[groups[i]]) for i in keep])
+            C = np.array([[float(controls[k][groups[i]]) for k in controlKeys] for i in keep]).reshape(n, len(controlKeys))
+            if spearman:
+                y = rankdata(y)
+                if controlKeys: C = rankdata(C, axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if controlKeys:
+                    if zscoreRegression: (C, y) = (zscore(C, axis=0), zscore(y))
+                    try:
+                        # show the effect of the controls alone
+                        print(sm.OLS(y, C).fit().summary(outcomeField, controlKeys))
+                        (U, s, Vt) = np.linalg.svd(C, full_matrices=False)
+                        Q = U[:, s > s.max() * max(C.shape) * np.finfo(float).eps]
+                        yResid = y - Q.dot(Q.T.dot(y))
+                        df = n - Q.shape[1] - 1
+                    except (ValueError, np.linalg.LinAlgError) as err:
+                        dlac.warn("OLS threw ValueError: [%s]" % str(err))
+                        dlac.warn(" outcome '%s' results not included" % outcomeField)
+                        Q = None
+                else:
+                    yCentered = y - y.mean()
+
+                (rs, ps) = (np.empty(len(feats)), np.empty(len(feats)))
+                blockSize = max(1, int(dlac.CORREL_BLOCK_CELLS / max(n, 1)))
+                X = gnMatrix[keep] if len(keep) < len(groups) else gnMatrix
+                for start in range(0, len(feats), blockSize):
+                    end = min(start + blockSize, len(feats))
+                    Xb = X[:, start:end].toarray()
+                    if spearman: Xb = rankdata(Xb, axis=0)
+                    if controlKeys:
+                        if Q is None:
+                            (rs[start:end], ps[start:end]) = (nan, nan)
+                            continue
+                        if zscoreRegression: Xb = zscore(Xb, axis=0)
+                        #coefficient of each feature given the controls, from the feature and outcome residuals
+                        ssx = (Xb * Xb).sum(axis=0)
+                        XbResid = Xb - Q.dot(Q.T.dot(Xb))
+                        sxx = (XbResid * XbResid).sum(axis=0)
+                        sxy = XbResid.T.dot(yResid)
+                        beta = sxy / sxx
+                        rss = yResid.dot(yResid) - beta * sxy
+                        tVals = beta / np.sqrt(rss / df / sxx)
+                        (rs[start:end], ps[start:end]) = (beta, 2 * tDist.sf(np.abs(tVals), df))
+                        #features explained by the controls: OLS's pseudo-inverse splits the coefficient
+                        #between them and the controls, so they are fit one at a time as without asMatrix
+                        for j in np.nonzero(sxx <= ssx * 1e-12)[0]:
+                            results = sm.OLS(y, np.column_stack([C, Xb[:, j]])).fit()
+                            (rs[start+j], ps[start+j]) = (results.params[-1], results.pvalues[-1])
+                    else:
+                        Xb = Xb - Xb.mean(axis=0)
+                        r = Xb.T.dot(yCentered) / np.sqrt((Xb * Xb).sum(axis=0) * yCentered.dot(yCentered))
+                        r = np.clip(r, -1.0, 1.0)
+                        tVals = r * np.sqrt((n - 2) / ((1.0 - r) * (1.0 + r)))
+                        (rs[start:end], ps[start:end]) = (r, 2 * tDist.sf(np.abs(tVals), n - 2))
+                if bonferroni: ps = ps * numFeats
+                sigma = (1/((n-3)**0.5)) if n > 3 else nan
+                zs = np.arctanh(rs)
+                confs = (np.tanh(zs - sigma * norm.ppf((1+dlac.DEF_CONF_INT)/2)), np.tanh(zs + sigma * norm.ppf((1+dlac.DEF_CONF_INT)/2)))
+
+            featCorrels = correls[outcomeField] = dict()
+            for j, feat in enumerate(feats):
+                if np.isnan(rs[j]) and controlKeys:
+                    dlac.warn("unable to correlate feature '%s' with '%s'" %(feat, outcomeField))
+                    tup = (nan, nan, n, (nan, nan)) + ((0, ) if includeFreqs else ())
+                else:
+                    tup = (rs[j], ps[j], n, (confs[0][j], confs[1][j]) if not np.isnan(rs[j]) else (np.nan, np.nan))
+                    if includeFreqs:
+                        try:
+                            tup = tup + (int(featFreqs[feat]), )
+                        except KeyError:
+                            if not whitelist:
+                                dlac.warn("unable to find total freq for '%s'" % feat)
+                            tup = tup + (nan, )
+                featCorrels[feat] = tup
+            dlac.warn("  %d features correlated with %s" % (len(feats), outcomeField))
+        return correls
+
+    def _correlateFeat(self, featNum, feat, featData, numFeats, groups, allOutcomes, controls, featFreqs, spearman = False, p_correction_method = 'BH',
+                       interaction = None, whitelist = None, includeFreqs = False, zscoreRegression = True, logisticReg = False,
+                       cohensD = False, outputInteraction = False):
+        """Correlates one feature with every outcome (see correlateWithFeatures)
+
+        Returns
+        -------
+        featCorrels : list
+            list of (outcome, (R, p, numGroups, CI, featFreqs)), followed by the interaction terms if outputInteraction
+        """
+        featCorrels = []
+        firstLoop = featNum == 1
+
+        # Looping over outcomes
+        for outcomeField, outcomes in allOutcomes.items() :
+            tup = ()
+            interaction_tuples = {}
+
+            # find correlation or regression coef, p-value, and N (stored in tup)
+            if controls or logisticReg or cohensD: #run OLS or logistic regression
+
+                if firstLoop and controls:
+                    # Do regression showing the effect of the controls only
+                    # i.e. show the coefficients from the controls alone
+
+                    (X, y) = dlac.alignDictsAsXy([controls[k] for k in sorted(controls.keys())], outcomes)
+
+                    if spearman:
+                        X = dlac.switchColumnsAndRows([rankdata(x)
+                                                  for x in dlac.switchColumnsAndRows(X)])
+                        y = rankdata(y)
+                    if zscoreRegression:
+                        try: 
+                            (X, y) = (zscore(X), zscore(y) if not logisticReg else y)
+                        except TypeError:
+                            dlac.warn("zscore got type error -- you probably are trying to use non-numeric data")
+                            sys.exit(1)
+                    results = None
+                    try:
+                        means = None
+                        if logisticReg or cohensD:
+                            results = sm.Logit(y, X).fit(disp=False) #runs regression
+                            #add means for each group
+                            means = dlac.meanXperY(X[:,-1], y)
+                        else:
+                            results = sm.OLS(y, X).fit() #runs regression
+                        if cohensD:
+                            effect_size = dlac.cohensD(X, y)
+                            if controls: 
+                                dlac.warn("  !WARNING: Using cohensD with controls is uninterpretable!")
+                        else:
+                            effect_size = results.params[-1]
+                        conf = dlac.conf_interval(effect_size, len(y))
+                        if means: 
+                            tup = (effect_size, results.pvalues[-1], len(y), conf, means)
+                        else: 
+                            tup = (effect_size, results.pvalues[-1], len(y), conf)
+
+                        print(results.summary(outcomeField, sorted(controls.keys())))#debug
+                    except (ValueError, Exception) as err:
+                        mode = 'Logistic regression' if logisticReg else 'OLS'
+                        dlac.warn("%s threw ValueError: %s" % (mode,str(err)))
+                        dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
+                #t0 = time.time()#debug
+
+                # Interaction: append to X the multiplication of outcome column & the interaction
+
+                controlsValues = [values for control, values in controls.items() if control not in interaction] + [controls[i] for i in interaction]
+                controlsKeys = [control for control, values in controls.items() if control not in interaction] + interaction
+
+                (X, y) = self._alignFeatAsXy(groups, featData, outcomes, controlsValues)
+                
+                if spearman:
+                    if interaction: 
+                        dlac.warn("Interactions with Spearman not implemented.")
+                        sys.exit(1)
+                    X = dlac.switchColumnsAndRows([rankdata(x) for x in dlac.switchColumnsAndRows(X)])
+                    y = rankdata(y)
+
+                if zscoreRegression: (X, y) = (zscore(X), zscore(y) if not logisticReg else y)
+
+                # X is a matrix, y is a column vector
+                # Each row of X is: [control1, control2, ..., interaction1, interaction2, ..., group_norm]
+                #                       0         1           len(controls) len(controls)+1    len(controls)+len(interaction)
+                for i in range(len(controls)-len(interaction), len(controls)):
+                    X = [list(x[:-1])+[float(x[i])*x[-1], x[-1]] for x in X]
+                # X is a matrix, y is a column vector
+                # Each row of X is: [control1, control2, ..., interaction1,       interaction2, ..., interaction1*group_norm, int2*gn, ..., group_norm]
+                #                       0         1        len(ctrls)-len(int)                              len(ctrls)                 len(controls)+len(interaction)
+
+                results = None
+                try:
+                    if logisticReg or cohensD:
+                        results = sm.Logit(y, X, missing='drop').fit(disp=False)
+                    else:
+                        results = sm.OLS(y, X).fit() #runs regression
+                    effect_size = dlac.cohensD(X, y) if cohensD else results.params[-1]
+                    conf = dlac.conf_interval(effect_size, len(y))
+                    tup = (effect_size, results.pvalues[-1], len(y), conf)
+
+                    if outputInteraction:
+                        interaction_tuples = {}
+                        for i, inter in enumerate(interaction):
+                            interaction_tuples["%s with %s" % (inter, outcomeField)] = (results.params[i+len(controls)-len(interaction)], results.pvalues[i+len(controls)-len(interaction)], len(y), dlac.conf_interval(results.params[i+len(controls)-len(interaction)], len(y)))
+                            interaction_tuples["group_norm * %s from %s" % (inter, outcomeField)] = (results.params[i+len(controls)], results.pvalues[i+len(controls)], len(y), dlac.conf_interval(results.params[i+len(controls)], len(y)))
+
+                except (ValueError,Exception) as err:
+                    mode = 'Logistic regression' if logisticReg else 'OLS'
+                    dlac.warn("%s threw ValueError: [%s]" % (mode, str(err)))
+                    dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
+
+            else: #run pearson / spearman correlation (if not logitsic or not controls)
+                (X, outcomeList) = self._alignFeatAsXy(groups, featData, outcomes)
+                dataList = X[:, -1]
+
+                # added because pearsonr messes up when trying to regress between different types: Decimal and float
+                outcomeList = list(map(float, outcomeList))
+
+                if spearman: tup = spearmanr(dataList, outcomeList) + (len(dataList),)
+                else: tup = pearsonr(dataList, outcomeList) + (len(dataList),)
+                conf = dlac.conf_interval(tup[self.r_idx], tup[self.n_idx])
+                tup = tup + (conf,)
+            if not tup or (not tup[self.r_idx] and not isinstance(tup[self.r_idx], (int, float))):
+                dlac.warn("unable to correlate feature '%s' with '%s'" %(feat, outcomeField))
+                if includeFreqs: tup = (float('nan'), float('nan'), len(y), (float('nan'), float('nan')), 0)
+                else: tup = (float('nan'), float('nan'), len(y), (float('nan'), float('nan')))
+            else:
+                if p_correction_method.startswith("bonf"):
+                    tup = dlac.bonfPCorrection(tup, numFeats)
+                    if outputInteraction: interaction_tuples = {k: dlac.bonfPCorrection(v, numFeats) + v[2:] for k, v in interaction_tuples.items()}
+                if includeFreqs:
+                    try:
+                        tup = tup + (int(featFreqs[feat]), )
+                        if outputInteraction:
+                            if self.use_unicode:
+                                interaction_tuples = {k: v + (int(featFreqs[str(feat)]), ) for k, v in interaction_tuples.items()}
+                            else:
+                                interaction_tuples = {k: v + (int(featFreqs[feat]), ) for k, v in interaction_tuples.items()}
+
+                    except KeyError:
+                        if not whitelist:
+                            dlac.warn("unable to find total freq for '%s'" % feat)
+                        tup = tup + (float('nan'), )
+                        if outputInteraction:
+                            interaction_tuples = {k: v + (float('nan'), ) for k, v in interaction_tuples.items()}
+            featCorrels.append((outcomeField, tup))
+            if outputInteraction:
+                featCorrels.extend(interaction_tuples.items())
+        return featCorrels
+
     def correlateWithFeatures(self, featGetter, spearman = False, p_correction_method = 'BH', interaction = None,
                               blacklist=None, whitelist=None, includeFreqs = False, outcomeWithOutcome = False,
                               outcomeWithOutcomeOnly = False, zscoreRegression = True, logisticReg = False,
-                              cohensD = False, outputInteraction = False, groupsWhere = ''):
+                              cohensD = False, outputInteraction = False, groupsWhere = '', asMatrix = True, cores = 1):
         """Finds the correlations between features and outcomes
 
         Parameters
@@ -609,6 +1024,11 @@ class OutcomeAnalyzer(OutcomeGetter):
             True - append output interactions to results
         groupsWhere : :obj:`str`, optional
             string specified with the --where flag containing a sql statement for filtering
+        asMatrix : :obj:`boolean`, optional
+            correlate all features at once with correlateFeatsAsMatrix when the analysis is linear without interactions
+            or outcomes as features; False runs one regression per feature
+        cores : :obj:`int`, optional
+            number of worker processes to correlate features with when they are correlated one at a time
 
         Returns
         --------
@@ -620,155 +1040,25 @@ class OutcomeAnalyzer(OutcomeGetter):
         correls = dict() #dict of outcome=>feature=>(R, p, numGroups, (conf_int), featFreqs)
         numRed = 0
 
-        firstLoop = True
-
-        # Yields data for one feature at a time
-        for (groups, allOutcomes, controls, feat, dataDict, numFeats, featFreqs) in self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, outcomeWithOutcome, includeFreqs, groupsWhere, outcomeWithOutcomeOnly):
-            # Looping over outcomes
-            for outcomeField, outcomes in allOutcomes.items() :
-                tup = ()
-                interaction_tuples = {}
-
-                # find correlation or regression coef, p-value, and N (stored in tup)
-                if controls or logisticReg or cohensD: #run OLS or logistic regression
-
-                    if firstLoop and controls:
-                        # Do regression showing the effect of the controls only
-                        # i.e. show the coefficients from the controls alone
-
-                        (X, y) = dlac.alignDictsAsXy([controls[k] for k in sorted(controls.keys())], outcomes)
-
-                        if spearman:
-                            X = dlac.switchColumnsAndRows([rankdata(x)
-                                                      for x in dlac.switchColumnsAndRows(X)])
-                            y = rankdata(y)
-                        if zscoreRegression:
-                            try: 
-                                (X, y) = (zscore(X), zscore(y) if not logisticReg else y)
-                            except TypeError:
-                                dlac.warn("zscore got type error -- you probably are trying to use non-numeric data")
-                                sys.exit(1)
-                        results = None
-                        try:
-                            means = None
-                            if logisticReg or cohensD:
-                                results = sm.Logit(y, X).fit(disp=False) #runs regression
-                                #add means for each group
-                                means = dlac.meanXperY(X[:,-1], y)
-                            else:
-                                results = sm.OLS(y, X).fit() #runs regression
-                            if cohensD:
-                                effect_size = dlac.cohensD(X, y)
-                                if controls: 
-                                    dlac.warn("  !WARNING: Using cohensD with controls is uninterpretable!")
-                            else:
-                                effect_size = results.params[-1]
-                            conf = dlac.conf_interval(effect_size, len(y))
-                            if means: 
-                                tup = (effect_size, results.pvalues[-1], len(y), conf, means)
-                            else: 
-                                tup = (effect_size, results.pvalues[-1], len(y), conf)
-
-                            print(results.summary(outcomeField, sorted(controls.keys())))#debug
-                        except (ValueError, Exception) as err:
-                            mode = 'Logistic regression' if logisticReg else 'OLS'
-                            dlac.warn("%s threw ValueError: %s" % (mode,str(err)))
-                            dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
-                    #t0 = time.time()#debug
-
-                    # Interaction: append to X the multiplication of outcome column & the interaction
-
-                    controlsValues = [values for control, values in controls.items() if control not in interaction] + [controls[i] for i in interaction]
-                    controlsKeys = [control for control, values in controls.items() if control not in interaction] + interaction
-
-                    (X, y) = dlac.alignDictsAsXy(controlsValues + [dataDict], outcomes)
-                    
-                    if spearman:
-                        if interaction: 
-                            dlac.warn("Interactions with Spearman not implemented.")
-                            sys.exit(1)
-                        X = dlac.switchColumnsAndRows([rankdata(x) for x in dlac.switchColumnsAndRows(X)])
-                        y = rankdata(y)
-
-                    if zscoreRegression: (X, y) = (zscore(X), zscore(y) if not logisticReg else y)
-
-                    # X is a matrix, y is a column vector
-                    # Each row of X is: [control1, control2, ..., interaction1, interaction2, ..., group_norm]
-                    #                       0         1           len(controls) len(controls)+1    len(controls)+len(interaction)
-                    for i in range(len(controls)-len(interaction), len(controls)):
-                        X = [list(x[:-1])+[float(x[i])*x[-1], x[-1]] for x in X]
-                    # X is a matrix, y is a column vector
-                    # Each row of X is: [control1, control2, ..., interaction1,       interaction2, ..., interaction1*group_norm, int2*gn, ..., group_norm]
-                    #                       0         1        len(ctrls)-len(int)                              len(ctrls)                 len(controls)+len(interaction)
-
-                    results = None
-                    try:
-                        if logisticReg or cohensD:
-                            results = sm.Logit(y, X, missing='drop').fit(disp=False)
-                        else:
-                            results = sm.OLS(y, X).fit() #runs regression
-                        effect_size = dlac.cohensD(X, y) if cohensD else results.params[-1]
-                        conf = dlac.conf_interval(effect_size, len(y))
-                        tup = (effect_size, results.pvalues[-1], len(y), conf)
-
-                        if outputInteraction:
-                            interaction_tuples = {}
-                            for i, inter in enumerate(interaction):
-                                interaction_tuples["%s with %s" % (inter, outcomeField)] = (results.params[i+len(controls)-len(interaction)], results.pvalues[i+len(controls)-len(interaction)], len(y), dlac.conf_interval(results.params[i+len(controls)-len(interaction)], len(y)))
-                                interaction_tuples["group_norm * %s from %s" % (inter, outcomeField)] = (results.params[i+len(controls)], results.pvalues[i+len(controls)], len(y), dlac.conf_interval(results.params[i+len(controls)], len(y)))
-
-                    except (ValueError,Exception) as err:
-                        mode = 'Logistic regression' if logisticReg else 'OLS'
-                        dlac.warn("%s threw ValueError: [%s]" % (mode, str(err)))
-                        dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
-
-                else: #run pearson / spearman correlation (if not logitsic or not controls)
-                    (dataList, outcomeList) = dlac.alignDictsAsLists(dataDict, outcomes)
-
-                    # added because pearsonr messes up when trying to regress between different types: Decimal and float
-                    outcomeList = list(map(float, outcomeList))
-
-                    if spearman: tup = spearmanr(dataList, outcomeList) + (len(dataList),)
-                    else: tup = pearsonr(dataList, outcomeList) + (len(dataList),)
-                    conf = dlac.conf_interval(tup[self.r_idx], tup[self.n_idx])
-                    tup = tup + (conf,)
-                if not tup or (not tup[self.r_idx] and not isinstance(tup[self.r_idx], (int, float))):
-                    dlac.warn("unable to correlate feature '%s' with '%s'" %(feat, outcomeField))
-                    if includeFreqs: tup = (float('nan'), float('nan'), len(y), (float('nan'), float('nan')), 0)
-                    else: tup = (float('nan'), float('nan'), len(y), (float('nan'), float('nan')))
-                else:
-                    if p_correction_method.startswith("bonf"):
-                        tup = dlac.bonfPCorrection(tup, numFeats)
-                        if outputInteraction: interaction_tuples = {k: dlac.bonfPCorrection(v, numFeats) + v[2:] for k, v in interaction_tuples.items()}
-                    if includeFreqs:
-                        try:
-                            tup = tup + (int(featFreqs[feat]), )
-                            if outputInteraction:
-                                if self.use_unicode:
-                                    interaction_tuples = {k: v + (int(featFreqs[str(feat)]), ) for k, v in interaction_tuples.items()}
-                                else:
-                                    interaction_tuples = {k: v + (int(featFreqs[feat]), ) for k, v in interaction_tuples.items()}
-
-                        except KeyError:
-                            if not whitelist:
-                                dlac.warn("unable to find total freq for '%s'" % feat)
-                            tup = tup + (float('nan'), )
-                            if outputInteraction:
-                                interaction_tuples = {k: v + (float('nan'), ) for k, v in interaction_tuples.items()}
+        asMatrix = asMatrix and not (interaction or logisticReg or cohensD or outputInteraction or outcomeWithOutcome or outcomeWithOutcomeOnly)
+        if asMatrix:
+            correls = self.correlateFeatsAsMatrix(featGetter, spearman, blacklist, whitelist, includeFreqs, zscoreRegression,
+                                                  groupsWhere, bonferroni = bool(p_correction_method) and p_correction_method.startswith("bonf"))
+
+        # Yields data for one feature at a time, correlated by cores worker processes
+        featYields = [] if asMatrix else self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, outcomeWithOutcome, includeFreqs, groupsWhere, outcomeWithOutcomeOnly, sparse = True)
+        options = dict(spearman = spearman, p_correction_method = p_correction_method, interaction = interaction, whitelist = whitelist,
+                       includeFreqs = includeFreqs, zscoreRegression = zscoreRegression, logisticReg = logisticReg, cohensD = cohensD,
+                       outputInteraction = outputInteraction)
+        for (feat, featCorrels) in self._mapFeats(self._correlateFeat, featYields, options, cores):
+            for (outcomeField, tup) in featCorrels:
                 try:
                     correls[outcomeField][feat] = tup
                 except KeyError:
                     correls[outcomeField] = {feat: tup}
-                if outputInteraction:
-                    for inter, tup in interaction_tuples.items():
-                        try:
-                            correls[inter][feat] = tup
-                        except KeyError:
-                            correls[inter] = {feat: tup}
 
             numRed += 1
             if numRed % 200 == 0: dlac.warn("  %d features correlated"%(numRed))
-            firstLoop = False
 
         if p_correction_method and not p_correction_method.startswith("bonf"):
             ##change correls here.
@@ -789,8 +1079,136 @@ class OutcomeAnalyzer(OutcomeGetter):
 
         return correls
 
+    def _controlsAUC(self, outcomeField, outcomes, controls, groups, featData, zscoreRegression = True):
+        """Prints the AUC of each control and returns the AUC of all controls together for an outcome"""
+        (X, y) = self._alignFeatAsXy(groups, featData, outcomes, [controls[k] for k in sorted(controls.keys())])
+        if zscoreRegression:
+            X = zscore(X)
+
+        print("\n= %11s == AUC WITH CONTROLS =\n=================================" % outcomeField)
+        auc = None
+        try:
+            for cntrl, i in zip(sorted(controls.keys()), list(range(len(list(controls.keys()))))):
+                auc = roc_auc_score(y, X[:,i])
+                if auc < 0.5:
+                    auc -= 1
+                print("  %11s: %.4f" %(cntrl, auc))
+        except (ValueError, Exception) as err:
+            dlac.warn("threw ValueError: %s" % str(err))
+            dlac.warn(" controls with outcome '%s' results not included" % outcomeField)
+        #all controls alone:
+        lr = LogisticRegression(penalty='l2', C=10000000, fit_intercept=True)
+        Xc = X[:,:-1]
+        probs = lr.fit(Xc,y).predict_proba(Xc)
+        cauc = roc_auc_score(y, probs[:,1])
+        print(" ALL CONTROLS: %.4f" % cauc)
+        print("===================================\n")
+        return cauc
+
+    @staticmethod
+    def _bootstrapCount(Xc, Xend, y, check, bootstrapP, permutationPool = None):
+        """Returns the number of bootstrapP permutations scoring an auc above check, run by permutationPool if given"""
+        if permutationPool is None:
+            return dlac.permutationChecks((Xc, Xend, y, check, int(bootstrapP)))
+        return permutationPool.countAbove(Xc, Xend, y, check, int(bootstrapP))
+
+    def _aucFeat(self, featNum, feat, featData, numFeats, groups, allOutcomes, controls, featFreqs, caucs = None, p_correction_method = 'BH',
+                 bootstrapP = None, whitelist = None, includeFreqs = False, zscoreRegression = True, permutationPool = None):
+        """Finds the auc of one feature with every outcome (see aucWithFeatures)
+
+        Returns
+        -------
+        featAucs : list
+            list of (outcome, (auc, p, numGroups, ci, featFreqs))
+        """
+        featAucs = []
+        conf = (np.nan, np.nan) #placeholder for confidence interval
+        for outcomeField, outcomes in allOutcomes.items() :
+            tup = ()
+
+            # find correlation or regression coef, p-value, and N (stored in tup)
+            if controls: #consider controls
+
+                (X, y) = self._alignFeatAsXy(groups, featData, outcomes, [controls[k] for k in sorted(controls.keys())])
+                if zscoreRegression:
+                    X = zscore(X)
+                cauc = caucs[outcomeField]
+
+                lr = LogisticRegression(penalty='l2', C=10000000, fit_intercept=True)
+                probs = lr.fit(X,y).predict_proba(X)
+                auc = roc_auc_score(y, probs[:,1])
+                if lr.coef_[0,-1] < 0: #mark the auc negative if the relationship with the feature is neg
+                    auc = -1 * auc
+                if bootstrapP:
+                    check = abs(auc)
+                    if check > (abs(cauc) + .01):
+                        print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); YES bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
+                        Xc = X[:,:-1]
+                        Xend = X[:,-1][...,None]
+                        fCount = self._bootstrapCount(Xc, Xend, y, check, bootstrapP, permutationPool)
+                        tup = (auc, fCount/float(bootstrapP), len(y), conf)
+                    else:
+                        print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); NO bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
+
+                        tup = (auc, 1.0, len(y), conf)
+                else:
+                    tup = (auc, 0.0, len(y), conf)
+
+
+            else: #no controls
+                cauc = 0.50
+                (X, y) = self._alignFeatAsXy(groups, featData, outcomes)
+                X = X[:, -1]
+                y = list(map(float, y))
+                if zscoreRegression:
+                    X = zscore(X)
+                try:
+                    auc = roc_auc_score(y, X)
+                    if auc < 0.5:
+                        auc -= 1
+                except (ValueError, Exception) as err:
+                    dlac.warn("threw ValueError: %s" % str(err))
+                    dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
+
+                #Bootstrap without controls:
+                if bootstrapP:
+                    check = abs(auc)
+                    if check > (abs(cauc) + .01):
+                        print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); YES bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
+                        fCount = self._bootstrapCount(None, X, y, check, bootstrapP, permutationPool)
+                        tup = (auc, fCount/float(bootstrapP), len(y), conf)
+                    else:
+                        print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); NO bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
+
+                        tup = (auc, 1.0, len(y), conf)
+                else:
+                    tup = (auc, 0.0, len(y), conf)
+
+            #adjust or add to tup...
+            if not tup or not tup[0]:
+                dlac.warn("unable to AUC feature '%s' with '%s'" %(feat, outcomeField))
+                if includeFreqs: tup = (float('nan'), float('nan'), len(y), conf, 0)
+                else: tup = (float('nan'), float('nan'), len(y), conf)
+            else:
+                if p_correction_method.startswith("bonf"):
+                    tup = dlac.bonfPCorrection(tup, numFeats)
+                if includeFreqs:
+                    try:
+                        if self.use_unicode:
+                            tup = tup + (int(featFreqs[str(feat)]), )
+                        else:
+                            tup = tup + (int(featFreqs[feat]), )
+
+                    except KeyError:
+                        if not whitelist:
+                            dlac.warn("unable to find total freq for '%s'" % feat)
+                        tup = tup + (float('nan'), )
+                featAucs.append((outcomeField, tup))
+        return featAucs
+
     def aucWithFeatures(self, featGetter, p_correction_method = 'BH', interaction = None, bootstrapP = None, blacklist=None,
-                        whitelist=None, includeFreqs = False, outcomeWithOutcome = False, zscoreRegression = True, outputInteraction = False, groupsWhere = ''):
+                        whitelist=None, includeFreqs = False, outcomeWithOutcome = False, zscoreRegression = True, outputInteraction = False, groupsWhere = '',
+                        cores = 1):
         """
 
         Finds the auc between features and dichotamous outcomes
@@ -818,6 +1236,8 @@ class OutcomeAnalyzer(OutcomeGetter):
             True - append output interactions to results
         groupsWhere : :obj:`str`, optional
             string specified with the --where flag containing a sql statement for filtering
+        cores : :obj:`int`, optional
+            number of worker processes to find the aucs of features with
 
         Returns
         -------
@@ -830,132 +1250,25 @@ class OutcomeAnalyzer(OutcomeGetter):
         aucs = dict() #dict of outcome=>feature=>(auc, p, numGroups, featFreqs)
         numRed = 0
 
-        firstLoop = True
-        featNum = 0
-        #print "WHITELIST: %s" % str(whitelist) #debug
-
-        conf = (np.nan, np.nan) #placeholder for confidence interval
         # Yields data for one feature at a time
-        for (groups, allOutcomes, controls, feat, dataDict, numFeats, featFreqs) in self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, outcomeWithOutcome, includeFreqs, groupsWhere):
-            # Looping over outcomes
-            featNum += 1
-            for outcomeField, outcomes in allOutcomes.items() :
-                tup = ()
-
-                # find correlation or regression coef, p-value, and N (stored in tup)
-                if controls: #consider controls
-
-                    (X, y) = dlac.alignDictsAsXy([controls[k] for k in sorted(controls.keys())] + [dataDict], outcomes)
-                    if zscoreRegression:
-                        X = zscore(X)
-
-                    if firstLoop and controls:
-                        # Do regression showing the effect of the controls only
-                        # i.e. show the coefficients from the controls alone
-
-                        print("\n= %11s == AUC WITH CONTROLS =\n=================================" % outcomeField)
-                        auc = None
-                        try:
-                            #print "  RANDOM TEST: %.4f" % mean([roc_auc_score(y , [randint(0,500)/100.0 for i in range(655)]) for i in xrange(100)])
-                            for cntrl, i in zip(sorted(controls.keys()), list(range(len(list(controls.keys()))))):
-                                auc = roc_auc_score(y, X[:,i])
-                                if auc < 0.5:
-                                    auc -= 1
-                                print("  %11s: %.4f" %(cntrl, auc))
-                        except (ValueError, Exception) as err:
-                            dlac.warn("threw ValueError: %s" % str(err))
-                            dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
-                            #TODO: add line of error
-                        #all controls alone:
-                        lr = LogisticRegression(penalty='l2', C=10000000, fit_intercept=True)
-                        Xc = X[:,:-1]
-                        probs = lr.fit(Xc,y).predict_proba(Xc)
-                        cauc = roc_auc_score(y, probs[:,1])
-                        print(" ALL CONTROLS: %.4f" % cauc)
-                        print("===================================\n")
-
-                    #do the rest:
-                    lr = LogisticRegression(penalty='l2', C=10000000, fit_intercept=True)
-                    probs = lr.fit(X,y).predict_proba(X)
-                    auc = roc_auc_score(y, probs[:,1])
-                    if lr.coef_[0,-1] < 0: #mark the auc negative if the relationship with the feature is neg
-                        auc = -1 * auc
-                    if bootstrapP:
-                        check = abs(auc)
-                        if check > (abs(cauc) + .01):
-                            print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); YES bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
-                            Xc = X[:,:-1]
-                            Xend = X[:,-1][...,None]
-                            pool = multiprocessing.Pool(int(dlac.CORES/3))
-                            fCount = sum(pool.map(dlac.fiftyChecks, [(Xc, Xend, y, check)]*int(bootstrapP/50) ) )
-
-                            tup = (auc, fCount/float(bootstrapP), len(y), conf)
-                            pool.close()
-                        else:
-                            print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); NO bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
-
-                            tup = (auc, 1.0, len(y), conf)
-                    else:
-                        tup = (auc, 0.0, len(y), conf)
-
-
-                else: #no controls
-                    cauc = 0.50
-                    (X, y) = dlac.alignDictsAsLists(dataDict, outcomes)
-                    y = list(map(float, y))
-                    if zscoreRegression:
-                        X = zscore(X)
-                    try:
-                        auc = roc_auc_score(y, X)
-                        if auc < 0.5:
-                            auc -= 1
-                    except (ValueError, Exception) as err:
-                        dlac.warn("threw ValueError: %s" % str(err))
-                        dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
-
-                    #Bootstrap without controls:
-                    if bootstrapP:
-                        check = abs(auc)
-                        if check > (abs(cauc) + .01):
-                            print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); YES bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
-                            #print X
-                            Xc = None
-                            #Xend = X[:,-1][...,None]
-                            pool = multiprocessing.Pool(int(dlac.CORES/3))
-                            fCount = sum(pool.map(dlac.fiftyChecks, [(Xc, X, y, check)]*int(bootstrapP/50) ) )
-                            # print fCount
-                            # test = fiftyChecks((Xc, X, y, check))
-                            # print test
-                            # sys.exit()
-
-                            tup = (auc, fCount/float(bootstrapP), len(y), conf)
-                            pool.close()
-                        else:
-                            print("%d/%d: %.3f cauc vs %.3f c+tpc (%.3f difference); NO bootstrapping" % (featNum,numFeats,abs(cauc),check,check-abs(cauc)))
-
-                            tup = (auc, 1.0, len(y), conf)
-                    else:
-                        tup = (auc, 0.0, len(y), conf)
-
-                #adjust or add to tup...
-                if not tup or not tup[0]:
-                    dlac.warn("unable to AUC feature '%s' with '%s'" %(feat, outcomeField))
-                    if includeFreqs: tup = (float('nan'), float('nan'), len(y), conf, 0)
-                    else: tup = (float('nan'), float('nan'), len(y), conf)
-                else:
-                    if p_correction_method.startswith("bonf"):
-                        tup = dlac.bonfPCorrection(tup, numFeats)
-                    if includeFreqs:
-                        try:
-                            if self.use_unicode:
-                                tup = tup + (int(featFreqs[str(feat)]), )
-                            else:
-                                tup = tup + (int(featFreqs[feat]), )
-
-                        except KeyError:
-                            if not whitelist:
-                                dlac.warn("unable to find total freq for '%s'" % feat)
-                            tup = tup + (float('nan'), )
+        featYields = self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, outcomeWithOutcome, includeFreqs, groupsWhere, sparse = True)
+        first = next(featYields, None)
+        caucs = dict() #outcome => auc of the controls alone
+        permutationPool = None
+        if first is not None:
+            (groups, allOutcomes, controls, feat, featData) = first[:5]
+            if controls:
+                for outcomeField, outcomes in allOutcomes.items():
+                    caucs[outcomeField] = self._controlsAUC(outcomeField, outcomes, controls, groups, featData, zscoreRegression)
+            if bootstrapP and cores <= 1:
+                #one pool for every bootstrapped feature (with several cores, each feature's worker permutes it alone)
+                permutationPool = PermutationPool(len(groups), len(controls) + 1)
+            featYields = chain([first], featYields)
+        options = dict(caucs = caucs, p_correction_method = p_correction_method, bootstrapP = bootstrapP, whitelist = whitelist,
+                       includeFreqs = includeFreqs, zscoreRegression = zscoreRegression, permutationPool = permutationPool)
+        try:
+            for (feat, featAucs) in self._mapFeats(self._aucFeat, featYields, options, cores):
+                for (outcomeField, tup) in featAucs:
                     try:
                         aucs[outcomeField][feat] = tup
                     except KeyError:
@@ -963,7 +1276,8 @@ class OutcomeAnalyzer(OutcomeGetter):
 
                 numRed += 1
                 if numRed % 200 == 0: dlac.warn("  %d features correlated"%(numRed))
-                firstLoop = False
+        finally:
+            if permutationPool: permutationPool.close()
 
         if p_correction_method and not p_correction_method.startswith("bonf"):
             newAucs = dict()
@@ -988,8 +1302,104 @@ class OutcomeAnalyzer(OutcomeGetter):
         return aucs
 
 
+    def _correlateControlCombosFeat(self, featNum, feat, featData, numFeats, groups, allOutcomes, allControls, featFreqs, spearman = False,
+                                    p_correction_method = 'BH', includeFreqs = False, zscoreRegression = True):
+        """Correlates one feature with every outcome, adjusting for every combination of controls (see correlateControlCombosWithFeatures)
+
+        Returns
+        -------
+        featCorrels : list
+            list of (outcome, controlCombo, feature, (R, p, numGroups, featFreqs)), where the first feature
+            also gets the coefficients of the controls alone as features '__CONTROL_<control>'
+        """
+        featCorrels = []
+        firstLoop = featNum == 1
+        controlKeys = list(allControls.keys())
+        for r in range(len(controlKeys)+1):
+            for controlKeyCombo in combinations(controlKeys, r):
+                controls = dict()
+                if len(controlKeyCombo) > 0:
+                    controls = dict([(k, allControls[k]) for k in controlKeyCombo])
+                controlKeyCombo = tuple(controlKeyCombo)
+                for outcomeField, outcomes in allOutcomes.items():
+                    tup = ()
+
+                    #find correlation or regression coef, p-value, and N (stored in tup)
+                    if controls:
+                        # If controls: run OLS regression
+
+                        if firstLoop:
+                            # show the coefficients from the controls alone
+                            thisControlKeys = sorted(controls.keys())
+                            (X, y) = dlac.alignDictsAsXy([controls[k] for k in thisControlKeys], outcomes)
+
+                            # print "alignDict time: %f"% float(time.time() - t0)#debug
+
+                            if spearman:
+                                X = dlac.switchColumnsAndRows([rankdata(x) for x in dlac.switchColumnsAndRows(X)])
+                                y = rankdata(y)
+                            if zscoreRegression: (X, y) = (zscore(X), zscore(y))
+
+                            results = None
+                            try:
+
+                                # run regression
+                                results = sm.OLS(y, X).fit()
+
+                                for c in range(len(results.params)):
+                                    tup = (results.params[c], results.pvalues[c], len(y))
+                                    featCorrels.append((outcomeField, controlKeyCombo, '__CONTROL_'+thisControlKeys[c], tup))
+                                print(results.summary(outcomeField, sorted(controls.keys())))#debug
+                            except ValueError as err:
+                                dlac.warn("OLS threw ValueError: %s" % str(err))
+                                dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
+
+                        #t0 = time.time()#debug
+
+                        (X, y) = self._alignFeatAsXy(groups, featData, outcomes, list(controls.values()))
+
+                        # print "alignDict time: %f"% float(time.time() - t0)#debug
+
+                        if spearman:
+                            X = dlac.switchColumnsAndRows([rankdata(x) for x in dlac.switchColumnsAndRows(X)])
+                            y = rankdata(y)
+                        if zscoreRegression: (X, y) = (zscore(X), zscore(y))
+                        results = None
+                        try:
+                            results = sm.OLS(y, X).fit() #runs regression
+                            tup = (results.params[-1], results.pvalues[-1], len(y))
+                            #print results.summary(outcomeField, controls.keys()+[feat])#debug
+                        except ValueError as err:
+                            dlac.warn("OLS threw ValueError: %s" % str(err))
+                            dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
+
+                    else:
+                        # If not controls : run pearson / spearman correlation
+                        (X, outcomeList) = self._alignFeatAsXy(groups, featData, outcomes)
+                        dataList = X[:, -1]
+                        if spearman: tup = spearmanr(dataList, outcomeList) + (len(dataList),)
+                        else: tup = pearsonr(dataList, outcomeList) + (len(dataList),)
+
+                    if not tup or not tup[0]:
+                        dlac.warn("unable to correlate feature '%s' with '%s'" %(feat, outcomeField))
+                        if includeFreqs: tup = (float('nan'), float('nan'), float('nan'), float('nan'))
+                        else: tup = (float('nan'), float('nan'), float('nan'))
+                    else:
+                        if p_correction_method.startswith("bonf"):
+                            tup = dlac.bonfPCorrection(tup, numFeats)
+                        if includeFreqs:
+
+                            try:
+                                tup = tup + (int(featFreqs[str(feat)]), )
+                            except KeyError:
+                                dlac.warn("unable to find total freq for '%s'" % feat)
+                                tup = tup + (float('nan'), )
+                    featCorrels.append((outcomeField, controlKeyCombo, feat, tup))
+        return featCorrels
+
     def correlateControlCombosWithFeatures(self, featGetter, spearman = False, p_correction_method = 'BH',
-                              blacklist=None, whitelist=None, includeFreqs = False, outcomeWithOutcome = False, zscoreRegression = True):
+                              blacklist=None, whitelist=None, includeFreqs = False, outcomeWithOutcome = False, zscoreRegression = True,
+                              cores = 1):
         """
         Finds the correlations between features and all combinations of outcomes
 
@@ -1009,6 +1419,8 @@ class OutcomeAnalyzer(OutcomeGetter):
             Adds the outcomes themselves to the list of variables to correlate with the outcomes if True
         zscoreRegression : :obj:`boolean`, optional
             standard both variables if True
+        cores : :obj:`int`, optional
+            number of worker processes to correlate features with
 
         Returns
         -------
@@ -1019,106 +1431,18 @@ class OutcomeAnalyzer(OutcomeGetter):
 
         comboCorrels = dict() #dict of outcome=>feature=>(R, p)
         numRed = 0
-        firstLoop = True
-
-        for (groups, allOutcomes, controls, feat, dataDict, numFeats, featFreqs) in self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, outcomeWithOutcome, includeFreqs):
-
-            controlKeys = list(allControls.keys())
-            for r in range(len(controlKeys)+1):
-                for controlKeyCombo in combinations(controlKeys, r):
-                    controls = dict()
-                    if len(controlKeyCombo) > 0:
-                        controls = dict([(k, allControls[k]) for k in controlKeyCombo])
-                    controlKeyCombo = tuple(controlKeyCombo)
-                    for outcomeField, outcomes in allOutcomes.items():
-                        tup = ()
-
-                        #find correlation or regression coef, p-value, and N (stored in tup)
-                        if controls:
-                            # If controls: run OLS regression
-
-                            if firstLoop:
-                                # show the coefficients from the controls alone
-                                thisControlKeys = sorted(controls.keys())
-                                (X, y) = dlac.alignDictsAsXy([controls[k] for k in thisControlKeys], outcomes)
-
-                                # print "alignDict time: %f"% float(time.time() - t0)#debug
-
-                                if spearman:
-                                    X = dlac.switchColumnsAndRows([rankdata(x) for x in dlac.switchColumnsAndRows(X)])
-                                    y = rankdata(y)
-                                if zscoreRegression: (X, y) = (zscore(X), zscore(y))
-
-                                results = None
-                                try:
-
-                                    # run regression
-                                    results = sm.OLS(y, X).fit()
-
-                                    try:
-                                        comboCorrels[outcomeField][controlKeyCombo] = dict()
-                                    except KeyError:
-                                        comboCorrels[outcomeField] = {controlKeyCombo : dict()}
-                                    for c in range(len(results.params)):
-                                        tup = (results.params[c], results.pvalues[c], len(y))
-                                        comboCorrels[outcomeField][controlKeyCombo]['__CONTROL_'+thisControlKeys[c]] = tup
-                                    print(results.summary(outcomeField, sorted(controls.keys())))#debug
-                                except ValueError as err:
-                                    dlac.warn("OLS threw ValueError: %s" % str(err))
-                                    dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
-
-                            #t0 = time.time()#debug
-
-                            (X, y) = dlac.alignDictsAsXy(list(controls.values()) + [dataDict], outcomes)
 
-                            # print "alignDict time: %f"% float(time.time() - t0)#debug
-
-                            if spearman:
-                                X = dlac.switchColumnsAndRows([rankdata(x) for x in dlac.switchColumnsAndRows(X)])
-                                y = rankdata(y)
-                            if zscoreRegression: (X, y) = (zscore(X), zscore(y))
-                            results = None
-                            try:
-                                results = sm.OLS(y, X).fit() #runs regression
-                                tup = (results.params[-1], results.pvalues[-1], len(y))
-                                #print results.summary(outcomeField, controls.keys()+[feat])#debug
-                            except ValueError as err:
-                                dlac.warn("OLS threw ValueError: %s" % str(err))
-                                dlac.warn(" feature '%s' with outcome '%s' results not included" % (feat, outcomeField))
-
-                        else:
-                            # If not controls : run pearson / spearman correlation
-                            (dataList, outcomeList) = dlac.alignDictsAsLists(dataDict, outcomes)
-                            if spearman: tup = spearmanr(dataList, outcomeList) + (len(dataList),)
-                            else: tup = pearsonr(dataList, outcomeList) + (len(dataList),)
-
-                        if not tup or not tup[0]:
-                            dlac.warn("unable to correlate feature '%s' with '%s'" %(feat, outcomeField))
-                            if includeFreqs: tup = (float('nan'), float('nan'), float('nan'), float('nan'))
-                            else: tup = (float('nan'), float('nan'), float('nan'))
-                        else:
-                            if p_correction_method.startswith("bonf"):
-                                tup = dlac.bonfPCorrection(tup, numFeats)
-                            if includeFreqs:
-
-                                try:
-                                    tup = tup + (int(featFreqs[str(feat)]), )
-                                except KeyError:
-                                    dlac.warn("unable to find total freq for '%s'" % feat)
-                                    tup = tup + (float('nan'), )
-                        try:
-                            comboCorrels[outcomeField][controlKeyCombo][feat] = tup
-                        except KeyError:
-                            try:
-                                comboCorrels[outcomeField][controlKeyCombo] = dict()
-                                comboCorrels[outcomeField][controlKeyCombo][feat] = tup
-                            except KeyError:
-                                comboCorrels[outcomeField] = {controlKeyCombo: dict()}
-                                comboCorrels[outcomeField][controlKeyCombo][feat] = tup
+        featYields = self.yieldDataForOneFeatAtATime(featGetter, blacklist, whitelist, outcomeWithOutcome, includeFreqs, sparse = True)
+        options = dict(spearman = spearman, p_correction_method = p_correction_method, includeFreqs = includeFreqs, zscoreRegression = zscoreRegression)
+        for (feat, featCorrels) in self._mapFeats(self._correlateControlCombosFeat, featYields, options, cores):
+            for (outcomeField, controlKeyCombo, featKey, tup) in featCorrels:
+                try:
+                    comboCorrels[outcomeField][controlKeyCombo][featKey] = tup
+                except KeyError:
+                    comboCorrels.setdefault(outcomeField, dict())[controlKeyCombo] = {featKey: tup}
 
             numRed += 1
             if numRed % 200 == 0: dlac.warn("  %d features correlated"%(numRed))
-            firstLoop = False
 
 
 
@@ -1129,8 +1453,8 @@ class OutcomeAnalyzer(OutcomeGetter):
                     pDict = dict( [(k, tup[1]) for k, tup in featCorrels.items()] )
                     rDict = dict( [(k, tup[0]) for k, tup in featCorrels.items()] )
                     pDict = dlac.pCorrection(pDict, p_correction_method, [0.05, 0.01, 0.001], rDict = rDict)
-                    for k, tup in featComboCorrels.items():
-                        featComboCorrels[k][controlCombo] = (tup[0], pDict[k]) + tup[2:]
+                    for k, tup in featCorrels.items():
+                        featCorrels[k] = (tup[0], pDict[k]) + tup[2:]
 
         if self.featureMapping:
             #pickle.dump((comboCorrels, self.featureMapping), open("comboCorrels-featmapping.p", "wb"))
@@ -1606,7 +1930,7 @@ class OutcomeAnalyzer(OutcomeGetter):
             a label map based on a lexicon. labelmap is {feat:concatenated_categories}
 
         """
-        (conn, cur, curD) = mm.dbConnect(self.lexicondb, charset=self.encoding, use_unicode=self.use_unicode)
+        (conn, cur, curD) = mm.getConnection(self.lexicondb, charset=self.encoding, use_unicode=self.use_unicode)
         sql = 'SELECT * FROM %s'%(lexicon_table)
         rows = mm.executeGetList(self.lexicondb, cur, sql, True, charset=self.encoding, use_unicode=self.use_unicode) #returns list of [id, feat, cat, ...] entries
 
@@ -1645,7 +1969,7 @@ class OutcomeAnalyzer(OutcomeGetter):
         elif not labelmap_table:
             raise Exception("must specify labelmap_table or lda_id")
 
-        (conn, cur, curD) = mm.dbConnect(self.lexicondb, charset=self.encoding, use_unicode=self.use_unicode)
+        (conn, cur, curD) = mm.getConnection(self.lexicondb, charset=self.encoding, use_unicode=self.use_unicode)
         sql = 'SELECT * FROM %s'%(labelmap_table)
         rows = mm.executeGetList(self.lexicondb, cur, sql, True, charset=self.encoding, use_unicode=self.use_unicode) #returns list of [feat, label, ...] entries
 
@@ -2096,7 +2420,7 @@ class OutcomeAnalyzer(OutcomeGetter):
             output file name
 
         """
-        (conn, cur, curD) = mm.dbConnect(corpdb, charset=self.encoding, use_unicode=self.use_unicode)
+        (conn, cur, curD) = mm.getConnection(corpdb, charset=self.encoding, use_unicode=self.use_unicode)
         outputfile = '/tmp/flexiplot.csv'
         if topicList:
             from collections import OrderedDict
@@ -2132,8 +2456,8 @@ class OutcomeAnalyzer(OutcomeGetter):
 
 
         """
-        (conn, cur, curD) = mm.dbConnect(corpdb, charset=self.encoding, use_unicode=self.use_unicode)
-        (pconn, pcur, pcurD) = mm.dbConnect(self.lexicondb, charset=self.encoding, use_unicode=self.use_unicode)
+        (conn, cur, curD) = mm.getConnection(corpdb, charset=self.encoding, use_unicode=self.use_unicode)
+        (pconn, pcur, pcurD) = mm.getConnection(self.lexicondb, charset=self.encoding, use_unicode=self.use_unicode)
         if not feat_to_label:
             sql = 'SELECT DISTINCT(feat) FROM %s'%flexiTable
             feats = mm.executeGetList(corpdb, cur, sql, charset=self.encoding, use_unicode=self.use_unicode)[0]
@@ -139,6 +139,8 @@ class OutcomeGetter(DLAWorker):
         self.one_group_set_for_all_outcomes = False # whether to use groups in common for all outcomes
         self.fold_column = fold_column
         self.low_variance_thresh = low_variance_thresh
+        self._outcomeFrames = dict() #(outcome table, fields, where) => DataFrame, see _getOutcomeFrame
+        self._groupsAndOutcomes = dict() #see getGroupsAndOutcomes
 
     def hasOutcomes(self):
         if len(self.outcome_value_fields) > 0:
@@ -298,7 +300,84 @@ class OutcomeGetter(DLAWorker):
         """buckets is a list of tuples"""
         raise NotImplementedError
 
+    def _getOutcomeFrame(self, fields, where = ''):
+        """Returns a DataFrame of the given outcome table columns indexed by group, read with one query
+
+        Columns hold the values as MySQL returned them (None for NULL). Frames are kept per
+        (outcome table, fields, where) for the life of the object.
+        """
+        fields = list(fields)
+        key = (self.outcome_table, tuple(fields), where)
+        frame = self._outcomeFrames.get(key)
+        if frame is None:
+            columns = [self.correl_field] + fields
+            sql = "select %s from `%s`" % (', '.join(columns), self.outcome_table)
+            if (where): sql += ' WHERE ' + where
+            rows = mm.executeGetList(self.corpdb, self.dbCursor, sql, False, charset=self.encoding, use_unicode=self.use_unicode)
+            frame = pd.DataFrame(list(rows), columns = columns, dtype = object).set_index(self.correl_field)
+            self._outcomeFrames[key] = frame
+        return frame
+
+    def _groupsAndOutcomesKey(self, lexicon_count_table, groupsWhere):
+        """Everything the result of getGroupsAndOutcomes depends on"""
+        return (self.outcome_table, tuple(self.outcome_value_fields), tuple(self.outcome_controls), tuple(self.outcome_interaction),
+                tuple(self.outcome_categories or ()), tuple(sorted(self.multiclass_outcome or ())), self.group_freq_thresh,
+                self.low_variance_thresh, self.wordTable, lexicon_count_table, groupsWhere, self.one_group_set_for_all_outcomes)
+
     def getGroupsAndOutcomes(self, lexicon_count_table=None, groupsWhere = '', includeFoldLabels=False):
+        """Returns the groups to analyze and their outcome and control values
+
+        The outcome table is read once into a frame keyed by group (see _getOutcomeFrame) and the
+        result is kept: later calls with the same groupsWhere, thresholds and outcome fields get
+        copies of it without querying again.
+
+        Parameters
+        ----------
+        lexicon_count_table : :obj:`str`, optional
+            word table used for the group frequency threshold
+        groupsWhere : :obj:`str`, optional
+            sql condition on the outcome table restricting the groups
+        includeFoldLabels : :obj:`boolean`, optional
+            also return the values of the fold column
+
+        Returns
+        -------
+        tuple
+            (groups, outcomes, controls) or, with includeFoldLabels, (groups, outcomes, controls, folds)
+            where outcomes and controls are dicts of field => {group_id: value}
+        """
+        key = self._groupsAndOutcomesKey(lexicon_count_table, groupsWhere)
+        result = self._groupsAndOutcomes.get(key)
+        if result is None:
+            result = self._loadGroupsAndOutcomes(lexicon_count_table, groupsWhere)
+            #fields may have been dropped or recoded, which is the state later calls arrive with
+            self._groupsAndOutcomes[self._groupsAndOutcomesKey(lexicon_count_table, groupsWhere)] = result
+        (groups, ocs, controls) = result
+        groups = set(groups)
+        ocs = dict((k, dict(v)) for k, v in ocs.items())
+        controls = dict((k, dict(v)) for k, v in controls.items())
+
+        if includeFoldLabels:
+            folds = None
+            if self.fold_column:
+                foldValues = self._getOutcomeFrame([self.fold_column])[self.fold_column]
+                folds = self._seriesToDict(foldValues[foldValues.notna()])
+            return (groups, ocs, controls, folds)
+        else:
+            return (groups, ocs, controls)
+
+    @staticmethod
+    def _seriesToDict(series):
+        return dict(zip(series.index, series.tolist()))
+
+    @staticmethod
+    def _outcomeVariance(values):
+        """Variance of a Series of outcome values; raises TypeError for non-numeric values"""
+        if values.map(lambda v: isinstance(v, (str, bytes))).any():
+            raise TypeError("non-numeric outcome values")
+        return np.var(values.to_numpy(dtype=float))
+
+    def _loadGroupsAndOutcomes(self, lexicon_count_table=None, groupsWhere = ''):
         if self.group_freq_thresh and self.wordTable != self.get1gramTable():
             dlac.warn("""You specified a --word_table and --group_freq_thresh is
 enabled, so the total word count for your groups might be off
@@ -308,7 +387,7 @@ enabled, so the total word count for your groups might be off
             self.checkIndices(self.outcome_table, primary=True, correlField=self.correl_field)
 
         groups = set()
-        outcomes = dict()
+        outcomes = dict() #field => Series of non-null values indexed by group
         outcomeFieldList = set(self.outcome_value_fields).union(set(self.outcome_controls)).union(set(self.outcome_interaction))
         ocs = dict()
         controls = dict()
@@ -316,18 +395,15 @@ enabled, so the total word count for your groups might be off
         #get outcome values:
         dlac.warn("Loading Outcomes and Getting Groups for: %s" % str(outcomeFieldList)) #debug
         if outcomeFieldList:
+            frame = self._getOutcomeFrame(sorted(outcomeFieldList), where=groupsWhere)
             to_remove = []
-            for outcomeField in outcomeFieldList:
-                outcomes[outcomeField] = dict(self.getGroupAndOutcomeValues(outcomeField, where=groupsWhere))
+            for outcomeField in sorted(outcomeFieldList):
+                values = frame[outcomeField]
+                outcomes[outcomeField] = values[values.notna()]
                 if self.low_variance_thresh is not None and self.low_variance_thresh is not False:
                     try:
-                        outcomeVariance = np.var(list(outcomes[outcomeField].values()))
-                        if isclose(outcomeVariance, 0.0) or outcomeVariance < self.low_variance_thresh:
-                            del outcomes[outcomeField]
-                            dlac.warn("Removing %s from analysis: variance %s less than threshold %s. To keep use --keep_low_variance" % (outcomeField, outcomeVariance, self.low_variance_thresh))
-                            to_remove.append(outcomeField)
-                            continue
-                    except TypeError:
+                        outcomeVariance = self._outcomeVariance(outcomes[outcomeField])
+                    except (TypeError, ValueError):
                         dlac.warn("TypeError during variance check for %s, skipping step." % (outcomeField))
                         outcomeVariance = 1
                     if isclose(outcomeVariance, 0.0) or outcomeVariance < self.low_variance_thresh:
@@ -336,9 +412,8 @@ enabled, so the total word count for your groups might be off
                         to_remove.append(outcomeField)
                         continue
 
-
                 if outcomeField in self.outcome_value_fields:
-                    groups.update(list(outcomes[outcomeField].keys()))
+                    groups.update(outcomes[outcomeField].index)
             for outcome in to_remove: 
                 outcomeFieldList.remove(outcome)
                 if outcome in self.outcome_value_fields: self.outcome_value_fields.remove(outcome)
@@ -349,23 +424,26 @@ enabled, so the total word count for your groups might be off
                 sys.exit(1)
 
             # create one hot representation of outcome
+            allCatLabels = []
             if self.outcome_categories:
                 for cat in self.outcome_categories:
                     cat_label_list = []
                     try:
-                        if not all(isinstance(lbl, (int, str)) for lbl in outcomes[cat].values()):
+                        if not outcomes[cat].map(lambda lbl: isinstance(lbl, (int, str))).all():
                             dlac.warn("Arguments of --categories_to_binary must contain string or integer values")
                             sys.exit(1)
-                        cat_labels = set([str(lbl) for lbl in outcomes[cat].values()])
+                        labels = outcomes[cat].map(str)
+                        cat_labels = set(labels)
                         if len(cat_labels) == 2: cat_labels.pop()
                         for lbl in cat_labels:
                             cat_label_str = "__".join([cat, lbl]).replace(" ", "_").lower()
-                            outcomes[cat_label_str] = {gid:1 if str(l) == lbl else 0 for gid, l in outcomes[cat].items() }
+                            outcomes[cat_label_str] = (labels == lbl).astype(int).astype(object)
                             cat_label_list.append(cat_label_str)
-                    except:
+                    except KeyError:
                         dlac.warn("Arguments of --categories_to_binary do not match --outcomes or --controls")
                         sys.exit(1)
                     del outcomes[cat]
+                    allCatLabels += cat_label_list
                     if cat in self.outcome_value_fields:
                         self.outcome_value_fields.remove(cat)
                         self.outcome_value_fields += cat_label_list
@@ -382,15 +460,15 @@ enabled, so the total word count for your groups might be off
                 for moutcome in self.multiclass_outcome:
                     cat_label_list = []
                     try:
-                        if not all(isinstance(lbl, (str)) for lbl in outcomes[moutcome].values()):
+                        if not outcomes[moutcome].map(lambda lbl: isinstance(lbl, str)).all():
                             dlac.warn("Arguments of --multiclass must contain only string values")
                             sys.exit(1)
-                        cat_labels = set([str(lbl).lower() for lbl in outcomes[moutcome].values()])
+                        labels = outcomes[moutcome].str.lower()
                         cat_label_str = "_".join([moutcome, "_multiclass"]).lower()
-                        cat_labels_dict[cat_label_str] = {i[1]:i[0] for i in enumerate(sorted(cat_labels))}
-                        outcomes[cat_label_str] = {gid: cat_labels_dict[cat_label_str][l.lower()] for gid, l in outcomes[moutcome].items() }
+                        cat_labels_dict[cat_label_str] = {i[1]:i[0] for i in enumerate(sorted(set(labels)))}
+                        outcomes[cat_label_str] = labels.map(cat_labels_dict[cat_label_str]).astype(object)
                         cat_label_list.append(cat_label_str)
-                    except:
+                    except KeyError:
                         dlac.warn("Arguments of --multiclass do not match --outcomes or --controls")
                         sys.exit(1)
                     del outcomes[moutcome]
@@ -406,34 +484,27 @@ enabled, so the total word count for your groups might be off
                 self.multiclass_outcome = cat_labels_dict
 
             if self.group_freq_thresh:
-                where = """ group_id in ('%s')""" % ("','".join(str(g) for g in groups))
-                groupCnts = self.getGroupWordCounts(where, lexicon_count_table = lexicon_count_table)
+                groupCnts = pd.Series(self.getGroupWordCounts(lexicon_count_table = lexicon_count_table), dtype=float)
+                keep = set(groupCnts.index[groupCnts.to_numpy() >= self.group_freq_thresh])
                 groups = set()
                 for outcomeField, outcomeValues in outcomes.items():
-                    newOutcomes = dict()
-                    for gId in outcomeValues.keys():
-                        if (gId in groupCnts) and (groupCnts[gId] >= self.group_freq_thresh):
-                            #keep
-                            # newOutcomes[gId] = float(outcomeValues[gId])
-                            newOutcomes[gId] = outcomeValues[gId]
-                    outcomes[outcomeField] = newOutcomes
+                    outcomes[outcomeField] = outcomeValues[outcomeValues.index.isin(keep)]
                     if outcomeField in self.outcome_value_fields:
-                        groups.update(list(newOutcomes.keys()))
+                        groups.update(outcomes[outcomeField].index)
 
             #set groups:
             for k in self.outcome_controls + self.outcome_interaction:
-                groups = groups & set(outcomes[k].keys()) #always intersect with controls
-            if self.outcome_categories:
-                for cat in cat_label_list:
-                    if all(outcomes[cat][group] == 0 for group in groups):
-                        del outcomes[cat]
-                        dlac.warn("Removing %s, no non-zero instances" % cat)
-                        if cat in self.outcome_value_fields:
-                            self.outcome_value_fields.remove(cat)
-                        elif cat in self.outcome_controls:
-                            self.outcome_controls.remove(cat)
-                        else:
-                            self.outcome_interaction.remove(cat)
+                groups = groups & set(outcomes[k].index) #always intersect with controls
+            for cat in allCatLabels:
+                if (outcomes[cat][outcomes[cat].index.isin(groups)] == 0).all():
+                    del outcomes[cat]
+                    dlac.warn("Removing %s, no non-zero instances" % cat)
+                    if cat in self.outcome_value_fields:
+                        self.outcome_value_fields.remove(cat)
+                    elif cat in self.outcome_controls:
+                        self.outcome_controls.remove(cat)
+                    else:
+                        self.outcome_interaction.remove(cat)
 
             if groupsWhere:
                 outcm = groupsWhere.split()[0].strip()
@@ -442,19 +513,15 @@ enabled, so the total word count for your groups might be off
 
             if self.one_group_set_for_all_outcomes:
                 for k in self.outcome_value_fields:
-                    groups = groups & set(outcomes[k].keys()) # only intersect if wanting all the same groups
+                    groups = groups & set(outcomes[k].index) # only intersect if wanting all the same groups
             
             #split into outcomes and controls:
             ocs = dict()
             controls = dict()
             for k in self.outcome_controls + self.outcome_interaction:
-                outcomeDict = outcomes[k]
-                outcomeDict = dict([(g, v) for g, v in outcomeDict.items() if g in groups])
-                controls[k] = outcomeDict
+                controls[k] = self._seriesToDict(outcomes[k][outcomes[k].index.isin(groups)])
             for k in self.outcome_value_fields:
-                outcomeDict = outcomes[k]
-                outcomeDict = dict([(g, v) for g, v in outcomeDict.items() if g in groups])
-                ocs[k] = outcomeDict
+                ocs[k] = self._seriesToDict(outcomes[k][outcomes[k].index.isin(groups)])
         elif self.group_freq_thresh:
             groupCnts = self.getGroupWordCounts(where = None, lexicon_count_table = lexicon_count_table)
             groups = set()
@@ -467,15 +534,7 @@ enabled, so the total word count for your groups might be off
                 whereusers = set([i[0] for i in self.getGroupAndOutcomeValues(outcm) if str(i[1]) == val])
                 groups = groups & whereusers
 
-        if self.fold_column:
-            folds = dict(self.getGroupAndOutcomeValues(self.fold_column))
-        else:
-            folds = None
-
-        if includeFoldLabels:
-            return (groups, ocs, controls, folds)
-        else:
-            return (groups, ocs, controls)
+        return (groups, ocs, controls)
 
     def getGroupAndOutcomeValuesAsDF(self, outcomeField = None, where=''):
         """returns a dataframe of (group_id, outcome_value)"""
@@ -10,6 +10,7 @@ import pickle as pickle
 
 from inspect import ismethod
 import sys
+import os
 import random
 from itertools import combinations, zip_longest, islice
 import csv
@@ -20,7 +21,7 @@ import operator
 from pprint import pprint
 import numbers
 
-from collections import defaultdict, Iterable
+from collections import defaultdict, Iterable, ChainMap
 
 #scikit-learn imports
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
@@ -56,16 +57,20 @@ from numpy.linalg.linalg import LinAlgError
 import math
 
 #infrastructure
-from .classifyPredictor import ClassifyPredictor
+from .classifyPredictor import ClassifyPredictor, mapFolds, foldFitKey, yieldFeatureChunks, compileLinearModel, compiledPredict, insertLinearPredictions
 from .mysqlmethods import mysqlMethods as mm
-from .dlaConstants import DEFAULT_MAX_PREDICT_AT_A_TIME, DEFAULT_RANDOM_SEED, warn
+from .featureCache import FeatureMatrix
+from . import modelBundle
+from .dlaConstants import DEFAULT_MAX_PREDICT_AT_A_TIME, DEFAULT_RANDOM_SEED, MODEL_BUNDLE_EXTENSION, warn
 
 
 def alignDictsAsXy(X, y, sparse = False, returnKeyList = False, keys = None):
     """turns a list of dicts for x and a dict for y into a matrix X and vector y"""
     if not keys: 
         keys = frozenset(list(y.keys()))
-        if sparse:
+        if isinstance(X, FeatureMatrix):
+            keys = keys.intersection(X.observedGroups() if sparse else X.completeGroups())
+        elif sparse:
             keys = keys.intersection([item for sublist in X for item in sublist]) #union X keys
         else:
             keys = keys.intersection(*[list(x.keys()) for x in X]) #intersect X keys
@@ -80,6 +85,14 @@ def alignDictsAsXy(X, y, sparse = False, returnKeyList = False, keys = None):
         listy = [float(y[k]) for k in keys]
 
 
+    if isinstance(X, FeatureMatrix): #rows picked by index from a matrix built once per feature table
+        alignedX = X.alignRows(keys)
+        if not sparse: alignedX = alignedX.toarray()
+        if returnKeyList:
+            return (alignedX, array(listy), keys)
+        else:
+            return (alignedX, array(listy))
+
     if sparse:
         keyToIndex = dict([(keys[i], i) for i in range(len(keys))])
         row = []
@@ -112,7 +125,9 @@ def alignDictsAsXyz(X, y, z, sparse = False, returnKeyList = False, keys = None)
     """turns a list of dicts for x and a dict for y and z into a matrix X and vectors y and z"""
     if not keys: 
         keys = frozenset(list(set(y.keys()).union(z.keys())))
-        if sparse:
+        if isinstance(X, FeatureMatrix):
+            keys = keys.intersection(X.observedGroups() if sparse else X.completeGroups())
+        elif sparse:
             keys = keys.intersection([item for sublist in X for item in sublist]) #union X keys
         else:
             keys = keys.intersection(*[list(x.keys()) for x in X]) #intersect X keys
@@ -135,6 +150,14 @@ def alignDictsAsXyz(X, y, z, sparse = False, returnKeyList = False, keys = None)
         keys = [k for k in keys if k in zkeys]
         listz = [float(z[k]) for k in keys]
 
+    if isinstance(X, FeatureMatrix): #rows picked by index from a matrix built once per feature table
+        alignedX = X.alignRows(keys)
+        if not sparse: alignedX = alignedX.toarray()
+        if returnKeyList:
+            return (alignedX, array(listy), array(listz), keys)
+        else:
+            return (alignedX, array(listy), array(listz))
+
     if sparse:
         keyToIndex = dict([(keys[i], i) for i in range(len(keys))])
         row = []
@@ -512,7 +535,7 @@ class RegressionPredictor:
         self.controlsOrder = []
         """list: Holds the ordered control names"""
 
-    def train(self, standardize = True, sparse = False, restrictToGroups = None, groupsWhere = '', weightedSample = '', outputName = '', saveFeatures = False):
+    def train(self, standardize = True, sparse = False, restrictToGroups = None, groupsWhere = '', weightedSample = '', outputName = '', saveFeatures = False, cores = 1):
         """Train Regressors"""
 
         ################
@@ -544,8 +567,8 @@ class RegressionPredictor:
         (groupNormsList, featureNamesList, featureLengthList) = ([], [], [])
         XGroups = None #holds the set of X groups across all feature spaces and folds (intersect with this to get consistent keys across everything
         for fg in self.featureGetters:
-            (groupNorms, featureNames) = fg.getGroupNormsSparseFeatsFirst(groups)
-            groupNormValues = [groupNorms[feat] for feat in featureNames] #list of dictionaries of group_id => group_norm
+            groupNormValues = fg.getGroupNormMatrix(groups) #groups x feats; rows are picked by index for each outcome and fold
+            featureNames = groupNormValues.feats
             groupNormsList.append(groupNormValues)
             # print featureNames[:10]#debug
             featureNamesList.append(featureNames)
@@ -567,10 +590,13 @@ class RegressionPredictor:
             groupNormsList.append(controlValues)
 
         #########################################
-        #3. train for all possible ys:
+        #3. train for all possible ys (in parallel with cores > 1):
         self.multiXOn = True
         (self.regressionModels, self.multiScalers, self.multiFSelectors) = (dict(), dict(), dict())
-        for outcomeName, outcomes in sorted(allOutcomes.items()):
+        outcomeNames = sorted(allOutcomes.keys())
+        def trainOutcome(o):
+            outcomeName = outcomeNames[o]
+            outcomes = allOutcomes[outcomeName]
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
             multiXtrain = list()
             trainGroupsOrder = list(XGroups & set(outcomes.keys()))
@@ -593,18 +619,22 @@ class RegressionPredictor:
             #############
             #4) fit model
             if saveFeatures: 
-                (self.regressionModels[outcomeName], self.multiScalers[outcomeName], self.multiFSelectors[outcomeName], featureX) = \
-                                                                                                                          self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample = sampleWeights, returnX=True)#DEBUG
+                (regressionModel, multiScalers, multiFSelectors, featureX) = \
+                                                                      self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample = sampleWeights, returnX=True)#DEBUG
                 ##DEBUG
                 csvFeatureFile = outputName+'.'+outcomeName+'.train.features.csv'
                 featureXwithGroups =  np.hstack((np.array([trainGroupsOrder]).T, featureX))
                 print(" saving features to: %s (shape: %s; %s)" % (csvFeatureFile, str(featureXwithGroups.shape), str(featureX.shape)))
                 np.savetxt(csvFeatureFile, featureXwithGroups, delimiter=",") #TO EXPORT FEATURE SELECTED FEATURES
                 featureX = None #allow to clear memory, just in case
+                return (regressionModel, multiScalers, multiFSelectors)
 
             else: 
-                (self.regressionModels[outcomeName], self.multiScalers[outcomeName], self.multiFSelectors[outcomeName]) = \
-                                                                                                                          self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample = sampleWeights)
+                return self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample = sampleWeights)
+
+        #4a) each outcome is fit in its own worker, sharing the feature matrices (see mapFolds)
+        for (outcomeName, fitted) in zip(outcomeNames, mapFolds(self, trainOutcome, range(len(outcomeNames)), cores)):
+            (self.regressionModels[outcomeName], self.multiScalers[outcomeName], self.multiFSelectors[outcomeName]) = fitted
 
         print("\n[TRAINING COMPLETE]\n")
         self.featureNamesList = featureNamesList
@@ -636,10 +666,12 @@ class RegressionPredictor:
         controlValues = list(controls.values()) #list of dictionaries of group=>group_norm
     #     this will return a dictionary of dictionaries
 
+        XMatrix = FeatureMatrix.fromDicts(groupNormValues+controlValues) #built once; rows are picked for each outcome
+
         #3. test classifiers for each possible y:
         for outcomeName, outcomes in sorted(allOutcomes.items()):
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
-            (X, y) = alignDictsAsXy(groupNormValues+controlValues, outcomes, sparse)
+            (X, y) = alignDictsAsXy(XMatrix, outcomes, sparse)
             print(" [Initial size: %d]" % len(y))
             Xtrain, Xtest, ytrain, ytest = train_test_split(X, y, test_size=self.testPerc, random_state=self.randomState)
             if len(ytrain) > self.trainingSize:
@@ -728,7 +760,7 @@ class RegressionPredictor:
                           weightedEvalOutcome = None, residualizedControls = False, groupsWhere = '',\
                           weightedSample = '', adaptationFactorsName=[], featureSelectionParameters=None,\
                           numOfFactors = [] , factorSelectionType='rfe' , pairedFactors=False, outputName='',\
-                          report=True, integrationMethod=''):
+                          report=True, integrationMethod='', cores=1, reuseFits=False):
         """Tests regressors, by cross-validating over folds with different combinations of controls"""
         
         ###################################
@@ -796,8 +828,8 @@ class RegressionPredictor:
             #(groupNorms, featureNames) = (None, None)
             if blacklist:
                 print("!!!WARNING: USING BLACKLIST WITH SPARSE IS NOT CURRENTLY SUPPORTED!!!")
-            (groupNorms, featureNames) = fg.getGroupNormsSparseFeatsFirst(groups)
-            groupNormValues = list(groupNorms.values()) #list of dictionaries of group_id => group_norm
+            groupNormValues = fg.getGroupNormMatrix(groups) #groups x feats; rows are picked by index for each outcome and fold
+            featureNames = groupNormValues.feats
             groupNormsList.append(groupNormValues)
             featureNamesList.append(featureNames)
             if not XGroups:
@@ -810,10 +842,15 @@ class RegressionPredictor:
         ################################
         #2b) setup control combinations:
         controlKeys = list(allControls.keys())
+        allControlsMatrix = FeatureMatrix.fromDicts([allControls[k] for k in controlKeys], controlKeys)
         scores = dict() #outcome => control_tuple => [0],[1] => scores= {R2, R, r, r-p, rho, rho-p, MSE, train_size, test_size, num_features,yhats}
         savedTrues = set()#stores outcomeNames that have already been saved
         if savePredictions: 
             scores['controls'] = allControls
+        #scalers and feature selectors fit to the language tables of a fold, reused by every control combination
+        #(with reuseFits; the cache holds one fit per outcome, fold and language table until the end of the run):
+        languageIds = set(id(gnv) for gnv in groupNormsList)
+        fitCache = dict() if reuseFits else None
 
         if not comboSizes:
             if numOfFactors is not None and len(numOfFactors)>0:
@@ -843,7 +880,7 @@ class RegressionPredictor:
                     controlValues = list(controls.values()) #list of dictionaries of group=>group_norm
                     thisGroupNormsList = list(groupNormsList)
                     if controlValues:
-                        thisGroupNormsList.append(controlValues)
+                        thisGroupNormsList.append(allControlsMatrix.selectFeats(controlKeyCombo))
 
                     #########################################
                     #3. test classifiers for each possible y:
@@ -967,9 +1004,8 @@ class RegressionPredictor:
                                 print("DONE CREATING RESIDUALS for %s %s\n" % (outcomeName, str(controlKeyCombo)))
                             
                             ###############################
-                            #3a) iterate over nfold groups:
-                          
-                            for testChunk in range(0, len(groupFolds)):
+                            #3) fit and predict one fold:
+                            def runFold(testChunk):
                                 trainGroups = set()
                                 for chunk in (groupFolds[:testChunk]+groupFolds[(testChunk+1):]):
                                     for c in chunk:
@@ -984,6 +1020,8 @@ class RegressionPredictor:
                                 ###########################################################################
                                 #3b)setup train and test data (different X for each set of groupNormValues)
                                 (multiXtrain, multiXtest, ytrain, ytest) = ([], [], None, None) #ytrain, ytest should be same across tables
+                                fitKeys = [] #per X in multiXtrain: identifies its fit in fitCache (None for controls)
+                                newFits = ChainMap(dict(), fitCache) if fitCache is not None else None #what this fold adds to fitCache (it may run in a worker)
                                 num_feats = 0;
                                 #get the group order across all
                                 #### setting factor_addition & factor_adaptation for this round of run
@@ -1024,17 +1062,27 @@ class RegressionPredictor:
                                         num_feats += Xtrain.shape[1]
                                         multiXtrain.append(Xtrain)
                                         multiXtest.append(Xtest)
+                                        fitKeys.append(foldFitKey(groupNormValues, outcomeName, testChunk, trainGroupsOrder, ytrain) if newFits is not None and id(groupNormValues) in languageIds and not (residualizedControls and controlValues and withLanguage) else None)
                                 print(" [Train size: %d    Test size: %d]" % (len(ytrain), len(ytest)))
 
                                 ################################
-                                #4) fit model and test accuracy:
+                                #4) fit model:
                                 ypred = None
                                 if factor_adaptation:
                                     (regressor, multiScalers, multiFSelectors, factorScalers) = self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample=sampleWeights, factorAdaptation = factor_adaptation, featureSelectionParameters = featureSelectionParameters, factorAddition = factor_addition, factors = factorTrain)
                                     ypred = self._multiXpredict(regressor, multiXtest, multiScalers = multiScalers, multiFSelectors = multiFSelectors, sparse = sparse, factorScalers = factorScalers, factorAddition = factor_addition, factorAdaptation = factor_adaptation, factors = factorTest)
                                 else:
-                                    (regressor, multiScalers, multiFSelectors) = self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample=sampleWeights)
+                                    (regressor, multiScalers, multiFSelectors) = self._multiXtrain(multiXtrain, ytrain, standardize, sparse = sparse, weightedSample=sampleWeights, fitCache = newFits, fitKeys = fitKeys)
                                     ypred = self._multiXpredict(regressor, multiXtest, multiScalers = multiScalers, multiFSelectors = multiFSelectors, sparse = sparse)
+                                modelDesc = str(regressor).replace('\t', "  ").replace('\n', " ").replace('  ', " ")
+                                modelFSDesc = str(multiFSelectors[0]).replace('\t', "  ").replace('\n', " ").replace('  ', " ")
+                                return (testGroupsOrder, ytrain, ytest, ypred, num_feats, modelDesc, modelFSDesc, newFits.maps[0] if newFits is not None else None)
+
+                            ###############################
+                            #3a) iterate over nfold groups (in parallel with cores > 1):
+                            foldResults = mapFolds(self, runFold, range(0, len(groupFolds)), cores)
+                            for (testChunk, (testGroupsOrder, ytrain, ytest, ypred, num_feats, modelDesc, modelFSDesc, foldFits)) in enumerate(foldResults):
+                                if foldFits: fitCache.update(foldFits)
                                 predictions.update(dict(zip(testGroupsOrder,ypred)))
                                 #pprint(ypred[:10])
                                     
@@ -1056,8 +1104,8 @@ class RegressionPredictor:
                                 testStats['mse_folds'].append(mse)
                                 testStats['mae_folds'].append(mae)
                                 testStats.update({'train_size': len(ytrain), 'test_size': len(ytest), 'num_features' : num_feats, 
-                                 '{model_desc}': str(regressor).replace('\t', "  ").replace('\n', " ").replace('  ', " "),
-                                 '{modelFS_desc}': str(multiFSelectors[0]).replace('\t', "  ").replace('\n', " ").replace('  ', " "),
+                                 '{model_desc}': modelDesc,
+                                 '{modelFS_desc}': modelFSDesc,
                                                   })
                                 ##4 b) weighted eval
                                 if wOutcome:
@@ -1179,6 +1227,7 @@ class RegressionPredictor:
         ################################
         #2b) setup control combinations:
         controlKeys = list(allControls.keys())
+        allControlsMatrix = FeatureMatrix.fromDicts([allControls[k] for k in controlKeys], controlKeys)
         scores = dict() #outcome => control_tuple => [0],[1] => scores= {R2, R, r, r-p, rho, rho-p, MSE, train_size, test_size, num_features,yhats}
         if not comboSizes:
             comboSizes = range(1, len(controlKeys)+1)
@@ -1186,13 +1235,10 @@ class RegressionPredictor:
                 comboSizes = [len(controlKeys)]
         for r in comboSizes:
             for controlKeyCombo in combinations(controlKeys, r):
-                controls = dict()
-                if len(controlKeyCombo) > 0:
-                    controls = dict([(k, allControls[k]) for k in controlKeyCombo])
                 controlKeyCombo = tuple(controlKeyCombo)
                 print("\n\n|COMBO: %s|" % str(controlKeyCombo))
                 print('='*(len(str(controlKeyCombo))+9))
-                controlValues = list(controls.values()) #list of dictionaries of group=>group_norm
+                controlValues = allControlsMatrix.selectFeats(controlKeyCombo) #groups x controls
 
                 #########################################
                 #3. train / test models for each possible y:
@@ -1363,7 +1409,7 @@ class RegressionPredictor:
         #2b) setup control data:
         controlValues = list(allControls.values())
         if controlValues:
-            groupNormsList.append(controlValues)
+            groupNormsList.append(FeatureMatrix.fromDicts(controlValues, list(allControls.keys())))
 
         #########################################
         #3. predict for all possible outcomes
@@ -1602,10 +1648,18 @@ class RegressionPredictor:
             rows = [(k, v, v) for k, v in preds.items()] #adds group_norm and applies freq filter
             mm.executeWriteMany(fe.corpdb, fe.dbCursor, wsql, rows, writeCursor=fe.dbConn.cursor(), charset=fe.encoding, use_unicode=fe.use_unicode)
 
-    def predictToFeatureTable(self, standardize = True, sparse = False, fe = None, name = None, groupsWhere = ''):
+    def predictToFeatureTable(self, standardize = True, sparse = False, fe = None, name = None, groupsWhere = '', streaming = False, compiled = False, inDatabase = False):
         if not fe:
             print("Must provide a feature extractor object")
             sys.exit(0)
+        if inDatabase:
+            if groupsWhere:
+                raise ValueError("Predictions scored in the database cover every group of the feature tables and can't be restricted with groupsWhere (%s)" % groupsWhere)
+            return self.scorePredictionsInDatabase(fe, name)
+        if streaming or compiled:
+            if groupsWhere:
+                raise ValueError("Streamed predictions cover every group of the feature tables and can't be restricted with groupsWhere (%s)" % groupsWhere)
+            return self.streamPredictionsToFeatureTable(sparse, fe, name, compiled)
 
         # handle large amount of predictions:
         (groups, allOutcomes, controls) = self.outcomeGetter.getGroupsAndOutcomes(groupsWhere = groupsWhere)
@@ -1706,6 +1760,104 @@ class RegressionPredictor:
            #     print "   %d feature rows written" % written
            #     rows = []
 
+    def streamPredictionsToFeatureTable(self, sparse = False, fe = None, name = None, compiled = False):
+        """Predicts every group of the feature tables into a feat$p_ table, one chunk of groups at a time
+
+        Outcomes are not read. The feature tables are streamed in chunks of maxPredictAtTime groups
+        (see yieldFeatureChunks), which are transformed with the stored scalers and feature selectors
+        and written before the next chunk is read, so memory does not grow with the number of groups.
+
+        Parameters
+        ----------
+        fe : FeatureExtractor
+            used to create and write the prediction table
+        name : str
+            appended to the table's feature name (p_<model>_<name>)
+        compiled : boolean
+            score with the models folded into one weight vector per outcome (see compileLinearModels)
+
+        Returns
+        -------
+        featureTableName : str
+        """
+        if self.controlsOrder:
+            raise ValueError("Models trained with controls (%s) can't be scored from the feature tables alone" % ', '.join(self.controlsOrder))
+        outcomes = sorted(self.regressionModels.keys())
+        featLength = max([len(s) for s in outcomes])
+        featureName = "p_%s" % self.modelName[:4]
+        if name: featureName += '_' + name
+        featureTableName = fe.createFeatureTable(featureName, "VARCHAR(%d)"%featLength, 'DOUBLE')
+        wsql = """INSERT INTO """+featureTableName+""" (group_id, feat, value, group_norm) values (%s, %s, %s, %s)"""
+
+        compiledModels = self.compileLinearModels() if compiled else None
+
+        totalPred = 0
+        for (groupIds, multiX) in yieldFeatureChunks(self.featureGetters, self.featureNamesList, self.maxPredictAtTime):
+            rows = []
+            for outcomeName in outcomes:
+                if compiled:
+                    ypred = compiledPredict(compiledModels[outcomeName], multiX)
+                else:
+                    ypred = self._multiXpredict(self.regressionModels[outcomeName], list(multiX), multiScalers = self.multiScalers[outcomeName], \
+                                                multiFSelectors = self.multiFSelectors[outcomeName], sparse = sparse)
+                rows.extend((gid, outcomeName, float(v), float(v)) for (gid, v) in zip(groupIds, ypred))
+            mm.executeWriteMany(fe.corpdb, fe.dbCursor, wsql, rows, writeCursor=fe.dbConn.cursor(), charset=fe.encoding, use_unicode=fe.use_unicode)
+            totalPred += len(groupIds)
+            print(" Total Predicted: %d" % totalPred)
+        return featureTableName
+
+    def compileLinearModels(self):
+        """Folds each outcome's scalers, feature selectors and linear model into one weight vector
+
+        The result scores a group with a single sparse dot product over the original features
+        (see compiledPredict) and gives the same predictions as _multiXpredict with sparse = True
+        (outliersToMean is not applied to compiled models).
+
+        Returns
+        -------
+        compiledModels : dict
+            outcome -> (intercept, weights), where weights is a (number of features x 1) csr_matrix over
+            the features of featureNamesList, in order
+        """
+        if self.controlsOrder:
+            raise ValueError("Models trained with controls (%s) can't be compiled over the feature tables alone" % ', '.join(self.controlsOrder))
+        if self.outliersToMean:
+            warn("Outliers to mean (%s) is not applied by compiled models" % str(self.outliersToMean))
+        nameLists = list(self.featureNamesList)
+
+        compiledModels = dict()
+        for outcomeName, regressor in sorted(self.regressionModels.items()):
+            compiledModels[outcomeName] = compileLinearModel(regressor, self.multiScalers[outcomeName], self.multiFSelectors[outcomeName], nameLists)
+            print("[compiled %s: %d nonzero weights, intercept %f]" % (outcomeName, compiledModels[outcomeName][1].nnz, compiledModels[outcomeName][0]))
+        return compiledModels
+
+    def scorePredictionsInDatabase(self, fe = None, name = None):
+        """Predicts every group of the feature tables into a feat$p_ table with one query inside MySQL
+
+        The models are compiled (see compileLinearModels) and their weights uploaded, so that each
+        prediction is intercept + SUM(group_norm * weight) over the group's feature rows (see
+        insertLinearPredictions). Groups found in every feature table are predicted.
+
+        Parameters
+        ----------
+        fe : FeatureExtractor
+            used to create and write the prediction table
+        name : str
+            appended to the table's feature name (p_<model>_<name>)
+
+        Returns
+        -------
+        featureTableName : str
+        """
+        if self.controlsOrder:
+            raise ValueError("Models trained with controls (%s) can't be scored from the feature tables alone" % ', '.join(self.controlsOrder))
+        compiledModels = self.compileLinearModels()
+        featLength = max([len(s) for s in compiledModels])
+        featureName = "p_%s" % self.modelName[:4]
+        if name: featureName += '_' + name
+        featureTableName = fe.createFeatureTable(featureName, "VARCHAR(%d)"%featLength, 'DOUBLE')
+        return insertLinearPredictions(fe, featureTableName, [fg.featureTable for fg in self.featureGetters], self.featureNamesList, compiledModels)
+
     def getWeightsForFeaturesAsADict(self): 
         """Creates a lexicon from a topic file
 
@@ -2018,10 +2170,12 @@ class RegressionPredictor:
 
 
     def _multiXtrain(self, X, y, standardize = True, sparse = False, weightedSample = None, factorAdaptation=False, featureSelectionParameters=None, factorAddition=False, 
-                     outputName = '', report=False, factors=None, returnX=False):
+                     outputName = '', report=False, factors=None, returnX=False, fitCache=None, fitKeys=None):
         """does the actual regression training, first feature selection: can be used by both train and test
            create multiple scalers and feature selectors
            and just one regression model (of combining the Xes into 1)
+           fitCache: dict of (scaler, fSelector) already fit, reused for the X whose fitKeys entry
+                     (identifying its table, training groups and y) is found in it, and filled otherwise
         """
 
         if not isinstance(X, (list, tuple)):
@@ -2048,6 +2202,28 @@ class RegressionPredictor:
                 X = X.todense()
             print(" X[%d]: (N, features): %s" % (i, str(X.shape)))
 
+            fitKey = None
+            if fitCache is not None and fitKeys and fitKeys[i] is not None and not factorAdaptation:
+                fitKey = (fitKeys[i], standardize, sparse, self.outliersToMean, str(self.featureSelectionString), self.featureSelectPerc)
+            if fitKey is not None and fitKey in fitCache:
+                #same table, training groups and y as before (e.g. in another control combination):
+                (scaler, fSelector) = fitCache[fitKey]
+                print("  [Reusing StandardScaler and Feature Selection fit to the same X[%d]: %s]" % (i, str(fSelector)))
+                y = np.array(y)
+                if scaler:
+                    X = scaler.transform(X)
+                    if self.outliersToMean and not sparse:
+                        X[abs(X) > self.outliersToMean] = 0
+                if fSelector:
+                    newX = fSelector.transform(X)
+                    if newX.shape[1]:
+                        X = newX
+                    print("  >> After feature selection: (N, features): %s" % str(X.shape))
+                multiX[i] = X
+                multiScalers.append(scaler)
+                multiFSelectors.append(fSelector)
+                continue
+
             #Standardization:
             scaler = None
             if standardize == True:
@@ -2090,6 +2266,8 @@ class RegressionPredictor:
             multiX[i] = X
             multiScalers.append(scaler)
             multiFSelectors.append(fSelector)
+            if fitKey is not None:
+                fitCache[fitKey] = (scaler, fSelector)
 
         #combine all multiX into one X:                
         if factorAddition:
@@ -2240,15 +2418,18 @@ class RegressionPredictor:
     ######################
     def load(self, filename, pickle2_7=True):
         print("[Loading %s]" % filename, pickle2_7)
-        with open(filename, 'rb') as f:
-            if pickle2_7:
-                from .dlaWorker  import DLAWorker
-                from . import occurrenceSelection, pca_mod
-                sys.modules['FeatureWorker'] = DLAWorker
-                sys.modules['FeatureWorker.occurrenceSelection'] = occurrenceSelection
-                sys.modules['FeatureWorker.pca_mod'] = pca_mod
-            tmp_dict = pickle.load(f, encoding='latin1')
-            f.close()          
+        if os.path.isdir(filename):
+            tmp_dict = modelBundle.loadBundle(filename)
+        else:
+            with open(filename, 'rb') as f:
+                if pickle2_7:
+                    from .dlaWorker  import DLAWorker
+                    from . import occurrenceSelection, pca_mod
+                    sys.modules['FeatureWorker'] = DLAWorker
+                    sys.modules['FeatureWorker.occurrenceSelection'] = occurrenceSelection
+                    sys.modules['FeatureWorker.pca_mod'] = pca_mod
+                tmp_dict = pickle.load(f, encoding='latin1')
+                f.close()          
         try:
             print("Outcomes in loaded model:", list(tmp_dict['regressionModels'].keys()))
         except KeyError:
@@ -2264,7 +2445,6 @@ class RegressionPredictor:
 
     def save(self, filename):
         print("[Saving %s]" % filename)
-        f = open(filename,'wb')
         toDump = {'modelName': self.modelName, 
                   'regressionModels': self.regressionModels,
                   'multiScalers': self.multiScalers,
@@ -2276,6 +2456,10 @@ class RegressionPredictor:
                   'multiXOn' : self.multiXOn,
                   'controlsOrder' : self.controlsOrder
                   }
+        if filename.endswith(MODEL_BUNDLE_EXTENSION):
+            modelBundle.saveBundle(filename, toDump)
+            return
+        f = open(filename,'wb')
         pickle.dump(toDump,f,2)
         f.close()
 
@@ -2397,13 +2581,15 @@ class RegressionPredictor:
     #     this will return a dictionary of dictionaries
 
 
+        XMatrix = FeatureMatrix.fromDicts(groupNormValues+controlValues) #built once; rows are picked for each outcome
+
         #3. Create classifiers for each possible y:
         for outcomeName, outcomes in allOutcomes.items():
             if isinstance(restrictToGroups, dict): #outcome specific restrictions:
                 outcomes = dict([(g, o) for g, o in outcomes.items() if g in restrictToGroups[outcomeName]])
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
             print("[Aligning Dicts to get X and y]")
-            (X, y) = alignDictsAsXy(groupNormValues+controlValues, outcomes, sparse)
+            (X, y) = alignDictsAsXy(XMatrix, outcomes, sparse)
             (self.regressionModels[outcomeName], self.scalers[outcomeName], self.fSelectors[outcomeName]) = self._train(X, y, standardize)
 
         print("[Done Training All Outcomes]")
@@ -2452,13 +2638,15 @@ class RegressionPredictor:
         controlValues = list(controls.values()) #list of dictionaries of group=>group_norm (TODO: including controls for predict might mess things up)
     #     this will return a dictionary of dictionaries
 
+        XMatrix = FeatureMatrix.fromDicts(groupNormValues+controlValues) #built once; rows are picked for each outcome
+
         #3. Predict ys for each model:
         predictions = dict() #outcome=>group_id=>value
         for outcomeName, outcomes in allOutcomes.items():
             print("\n= %s =\n%s"%(outcomeName, '-'*(len(outcomeName)+4)))
             if isinstance(restrictToGroups, dict): #outcome specific restrictions:
                 outcomes = dict([(g, o) for g, o in outcomes.items() if g in restrictToGroups[outcomeName]])
-            (X, ytest, keylist) = alignDictsAsXy(groupNormValues+controlValues, outcomes, sparse, returnKeyList = True)
+            (X, ytest, keylist) = alignDictsAsXy(XMatrix, outcomes, sparse, returnKeyList = True)
             leny = len(ytest)
             print("[Groups to predict: %d]" % leny)
             (regressor, scaler, fSelector) = (self.regressionModels[outcomeName], self.scalers[outcomeName], self.fSelectors[outcomeName])
@@ -3093,6 +3281,8 @@ def hasMultValuesPerItem(listOfD):
     return False
 
 def getGroupsFromGroupNormValues(gnvs):
+    if isinstance(gnvs, FeatureMatrix):
+        return gnvs.observedGroups()
     return set([k for gns in gnvs for k in gns.keys()])
 
 
@@ -126,6 +126,8 @@ def main(fn_args = None):
     group.add_argument('-l', '--lex_table', metavar='TABLE', dest='lextable', default=getInitVar('lextable', conf_parser, ''),
                        help='Lexicon Table Name: used for extracting category features from 1grams'+
                        '(or use --word_table to extract from other than 1gram)')
+    group.add_argument('--lex_tables', metavar='TABLE', dest='lextables', type=str, nargs='+', default=[],
+                       help='Several lexicon tables to extract with --add_lex_table in one pass over the 1gram table')
     group.add_argument('--word_table', metavar='WORDTABLE', dest='wordTable', default=getInitVar('wordTable', conf_parser, None),
                        help='Table that contains the list of words to give for lex extraction/group_freq_thresh')
     group.add_argument('--colloc_table', metavar='TABLE', dest='colloc_table', default=dlac.DEF_COLLOCTABLE,
@@ -198,6 +200,10 @@ def main(fn_args = None):
                        help='layers from Bert to keep.')
     group.add_argument('--bert_no_context', action='store_true', dest='bertnocontext', default=False,
                        help='encoded without considering context.')
+    group.add_argument('--feat_cache_gigs', type=float, metavar='GIGS', dest='featcachegigs', default=dlac.FEATURE_CACHE_GIGS,
+                       help='Turns on the in-memory cache of feature tables (as sparse matrices), giving the memory (in GB) it may use; 0 turns it off. Default: %s' % str(dlac.FEATURE_CACHE_GIGS))
+    group.add_argument('--feat_snapshot_dir', metavar='DIR', dest='featsnapshotdir', default=getInitVar('featsnapshotdir', conf_parser, None),
+                       help='Directory to save feature tables to as memory-mapped sparse matrices, reused by later runs while the table is unchanged.')
 
 
     group = parser.add_argument_group('MySQL Interactoins', '')
@@ -293,6 +299,8 @@ def main(fn_args = None):
     group.add_argument('--p_correction', metavar='METHOD', type=str, dest='p_correction_method', default=getInitVar('p_correction_method', conf_parser, dlac.DEF_P_CORR),
                        help='Specify a p-value correction method: simes, holm, hochberg, hommel, bonferroni, BH, BY, fdr, none',
                        choices=dlac.DEF_P_MAPPING.keys())
+    group.add_argument('--no_matrix_correl', action='store_false', dest='matrixcorrel', default=True,
+                       help='Correlate (or regress with controls) one feature at a time rather than all features as a matrix.')
     group.add_argument('--no_bonferroni', action='store_false', dest='bonferroni', default=True,
                        help='Turn off bonferroni correction of p-values.')
     group.add_argument('--no_correction', action='store_const', const='', dest='p_correction_method',
@@ -371,6 +379,9 @@ def main(fn_args = None):
                        help='Only uses all controls when prediction doing test_combo_regression')
     group.add_argument('--no_lang', action='store_true', dest='nolang', default=False,
                        help='Runs with language features excluded')
+    group.add_argument('--reuse_combo_fits', action='store_true', dest='reusecombofits', default=False,
+                       help='Reuses the scalers and feature selectors fit to the language features of each fold across control combinations '
+                       '(with --combo_test_regression or --combo_test_classifiers); they are held in memory for every outcome, fold and feature table until the run ends')
     group.add_argument('--control_combo_sizes', '--combo_sizes', type=int, metavar="index", nargs='+', dest='controlcombosizes',
                        default=[], help='specify the sizes of control combos to use')
     group.add_argument('--residualized_controls', '--res_controls', action='store_true', dest='res_controls', default=False,
@@ -412,6 +423,18 @@ def main(fn_args = None):
                        'can be used with or without --use_collocs')
     group.add_argument('--no_lower', action='store_false', dest='lowercaseonly', default=dlac.LOWERCASE_ONLY,
                        help='')
+    group.add_argument('--stream_messages', action='store_true', dest='streammessages', default=False,
+                       help='read the message table once with a server-side cursor ordered by group when extracting n-grams '
+                       '(use with --add_ngrams, --add_char_ngrams or --add_ngrams_from_tokenized).')
+    group.add_argument('--bulk_load', action='store_true', dest='bulkload', default=False,
+                       help='write extracted feature tables with LOAD DATA LOCAL INFILE instead of batched INSERTs '
+                       '(falls back to INSERTs if local_infile is disabled on the server).')
+    group.add_argument('--cores', type=int, metavar='N', dest='cores', default=1,
+                       help='number of worker processes used to tokenize and count n-grams (use with --add_ngrams, '
+                       '--add_char_ngrams or --add_ngrams_from_tokenized) or to correlate features one at a time '
+                       '(use with --correlate, --auc or --combo_rmatrix), to cross-validate folds in parallel '
+                       '(use with --combo_test_regression or --combo_test_classifiers), or to train outcomes in parallel '
+                       '(use with --train_regression or --train_classifiers).')
     group.add_argument('--add_lex_table', action='store_true', dest='addlextable',
                        help='add a lexicon-based feature table. (uses: l, weighted_lexicon, can flag: anscombe).')
     group.add_argument('--add_corp_lex_table', action='store_true', dest='addcorplextable',
@@ -628,6 +651,15 @@ def main(fn_args = None):
                        help='predict outcomes into a feature file (provide a name)')
     group.add_argument('--predict_probabilities_to_feats', '--predict_probs_to_feats', type=str, dest='predictprobstofeats', default=None,
                        help='predict probabilities into a feature file (provide a name)')
+    group.add_argument('--stream_predictions', action='store_true', dest='streampredictions', default=False,
+                       help='score every group of the feature tables in group-ordered chunks, without an outcome table '
+                       '(use with --predict_regression_to_feats, --predict_classifiers_to_feats or --predict_probabilities_to_feats).')
+    group.add_argument('--compiled_predictions', action='store_true', dest='compiledpredictions', default=False,
+                       help='fold the scalers, feature selectors and linear model of each outcome into one weight vector '
+                       'and score with it (implies --stream_predictions; use with --predict_regression_to_feats).')
+    group.add_argument('--sql_predictions', action='store_true', dest='sqlpredictions', default=False,
+                       help='score linear models inside MySQL with one INSERT ... SELECT over the feature tables '
+                       '(use with --predict_regression_to_feats, --predict_classifiers_to_feats or --predict_probabilities_to_feats).')
     group.add_argument('--predict_classifiers_to_outcome_table', type=str, dest='predictCtoOutcomeTable', default=None,
                        help='predict outcomes into an outcome table (provide a name)')
     group.add_argument('--regression_to_lexicon', dest='regrToLex', type=str, default=None,
@@ -793,6 +825,10 @@ def main(fn_args = None):
         args.featureselectionparams = None
 
     DLAWorker.lexicon_db = args.lexicondb
+    FeatureGetter.featureCacheGigs = args.featcachegigs
+    FeatureGetter.featureSnapshotDir = args.featsnapshotdir
+    if args.featsnapshotdir and not args.featcachegigs:
+        dlac.warn("--feat_snapshot_dir has no effect unless the feature cache is turned on with --feat_cache_gigs")
 
     ##Process Arguments
     def DLAW():
@@ -805,7 +841,9 @@ def main(fn_args = None):
         return MessageTransformer(args.corpdb, args.corptable, args.correl_field, args.mysql_host, args.message_field, args.messageid_field, args.encoding, args.useunicode, args.lexicondb, wordTable = args.wordTable)
 
     def FE():
-        return FeatureExtractor(args.corpdb, args.corptable, args.correl_field, args.mysql_host, args.message_field, args.messageid_field, args.encoding, args.useunicode, args.lexicondb, wordTable = args.wordTable)
+        fe = FeatureExtractor(args.corpdb, args.corptable, args.correl_field, args.mysql_host, args.message_field, args.messageid_field, args.encoding, args.useunicode, args.lexicondb, wordTable = args.wordTable)
+        fe.bulkLoad = args.bulkload
+        return fe
 
     def SE():
         return SemanticsExtractor(args.corpdb, args.corptable, args.correl_field, args.mysql_host, args.message_field, args.messageid_field, args.encoding, args.useunicode, args.lexicondb, args.corpdir, wordTable = args.wordTable)
@@ -956,7 +994,7 @@ def main(fn_args = None):
         else:
             ftables = list()
             for n in args.n:
-                ftables.append(fe.addNGramTable(n, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, metaFeatures = args.metafeats, extension = args.extension))
+                ftables.append(fe.addNGramTable(n, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, metaFeatures = args.metafeats, extension = args.extension, streaming = args.streammessages, cores = args.cores))
             if len(ftables) > 1:
                 args.feattable = ftables;
             else:
@@ -965,7 +1003,7 @@ def main(fn_args = None):
         if not fe: fe = FE()
         ftables = list()
         for n in args.n:
-            ftables.append(fe.addNGramTableFromTok(n, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, metaFeatures = args.metafeats))
+            ftables.append(fe.addNGramTableFromTok(n, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, metaFeatures = args.metafeats, streaming = args.streammessages, cores = args.cores))
             if len(ftables) > 1:
                 args.feattable = ftables;
             else:
@@ -979,7 +1017,7 @@ def main(fn_args = None):
 
         ftables = list()
         for n in args.n:
-            ftables.append(fe.addCharNGramTable(n, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, metaFeatures = args.metafeats))
+            ftables.append(fe.addCharNGramTable(n, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, metaFeatures = args.metafeats, streaming = args.streammessages, cores = args.cores))
         if len(ftables) > 1:
             args.feattable = ftables;
         else:
@@ -987,7 +1025,10 @@ def main(fn_args = None):
 
     if args.addlextable:
         if not fe: fe = FE()
-        args.feattable = fe.addLexiconFeat(args.lextable, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, isWeighted=args.weightedlexicon, featValueFunc=args.lexvaluefunc, extension=args.extension)
+        if args.lextables:
+            args.feattable = fe.addLexiconFeats(args.lextables, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, isWeighted=args.weightedlexicon, featValueFunc=args.lexvaluefunc, extension=args.extension)
+        else:
+            args.feattable = fe.addLexiconFeat(args.lextable, lowercase_only=args.lowercaseonly, valueFunc = args.valuefunc, isWeighted=args.weightedlexicon, featValueFunc=args.lexvaluefunc, extension=args.extension)
 
     if args.addcorplextable:
         if not args.lextable:
@@ -1348,7 +1389,7 @@ def main(fn_args = None):
             correls = oa.correlateWithFeatures(fg, args.spearman,
                                                args.p_correction_method, args.outcomeinteraction, blacklist,
                                                whitelist, args.showfeatfreqs, args.outcomeWithOutcome, args.outcomeWithOutcomeOnly,
-                                               logisticReg=args.logisticReg, outputInteraction=True, groupsWhere=args.groupswhere)
+                                               logisticReg=args.logisticReg, outputInteraction=True, groupsWhere=args.groupswhere, cores=args.cores)
             inter_keys = [i for i in list(correls.keys()) if " * " in i]
             # correls = {outcome1: {feat: (R,p,N,freq)}}
 
@@ -1380,7 +1421,7 @@ def main(fn_args = None):
                 correls_1 = oa.correlateWithFeatures(fg, args.spearman,
                                                      args.p_correction_method, args.outcomeinteraction, blacklist,
                                                      whitelist, args.showfeatfreqs, args.outcomeWithOutcome, args.outcomeWithOutcomeOnly,
-                                                     logisticReg=args.logisticReg, groupsWhere = where)
+                                                     logisticReg=args.logisticReg, groupsWhere = where, asMatrix=args.matrixcorrel, cores=args.cores)
 
                 correls.update({"["+k+"]_1": v for k, v in correls_1.items()})
                 og = OG()
@@ -1392,7 +1433,7 @@ def main(fn_args = None):
                 correls_0 = oa.correlateWithFeatures(fg, args.spearman,
                                                      args.p_correction_method, args.outcomeinteraction, blacklist,
                                                      whitelist, args.showfeatfreqs, args.outcomeWithOutcome, args.outcomeWithOutcomeOnly,
-                                                     logisticReg=args.logisticReg, groupsWhere = where)
+                                                     logisticReg=args.logisticReg, groupsWhere = where, asMatrix=args.matrixcorrel, cores=args.cores)
                 correls.update({"["+k+"]_0": v for k, v in correls_0.items()})
 
         elif args.IDP:
@@ -1400,9 +1441,9 @@ def main(fn_args = None):
         elif args.zScoreGroup:
             correls = oa.zScoreGroup(fg, outcomeWithOutcome=args.outcomeWithOutcome, includeFreqs=args.showfeatfreqs, blacklist=blacklist, whitelist=whitelist)
         elif args.auc:
-            correls = oa.aucWithFeatures(fg, outcomeWithOutcome=args.outcomeWithOutcome, includeFreqs=args.showfeatfreqs, blacklist=blacklist, whitelist=whitelist, bootstrapP = args.bootstrapp, groupsWhere=args.groupswhere)
+            correls = oa.aucWithFeatures(fg, outcomeWithOutcome=args.outcomeWithOutcome, includeFreqs=args.showfeatfreqs, blacklist=blacklist, whitelist=whitelist, bootstrapP = args.bootstrapp, groupsWhere=args.groupswhere, cores=args.cores)
         else:
-            correls = oa.correlateWithFeatures(fg, args.spearman, args.p_correction_method, args.outcomeinteraction, blacklist, whitelist, args.showfeatfreqs, args.outcomeWithOutcome, args.outcomeWithOutcomeOnly, logisticReg=(args.logisticReg or args.cohensd), cohensD=args.cohensd, outputInteraction=args.outputInteractionTerms, groupsWhere=args.groupswhere)
+            correls = oa.correlateWithFeatures(fg, args.spearman, args.p_correction_method, args.outcomeinteraction, blacklist, whitelist, args.showfeatfreqs, args.outcomeWithOutcome, args.outcomeWithOutcomeOnly, logisticReg=(args.logisticReg or args.cohensd), cohensD=args.cohensd, outputInteraction=args.outputInteractionTerms, groupsWhere=args.groupswhere, asMatrix=args.matrixcorrel, cores=args.cores)
         if args.topicdupefilter:#remove duplicate topics (keeps those correlated more strongly)
             correls = oa.topicDupeFilterCorrels(correls, args.topiclexicon)
 
@@ -1520,7 +1561,7 @@ def main(fn_args = None):
     if args.combormatrix:
         if not oa: oa = OA()
         if not fg: fg = FG()
-        comboCorrels = oa.correlateControlCombosWithFeatures(fg, args.spearman, args.p_correction_method, blacklist, whitelist, args.showfeatfreqs, args.outcomeWithOutcome)
+        comboCorrels = oa.correlateControlCombosWithFeatures(fg, args.spearman, args.p_correction_method, blacklist, whitelist, args.showfeatfreqs, args.outcomeWithOutcome, cores=args.cores)
         if args.csv:
             outputStream = sys.stdout
             if args.outputname:
@@ -1685,7 +1726,7 @@ def main(fn_args = None):
         print("WARNING: using an non 16to16 feature table")
 
     if args.trainregression:
-        rp.train(sparse = args.sparse,  standardize = args.standardize, groupsWhere = args.groupswhere, weightedSample=args.weightedsample, outputName = args.outputname, saveFeatures = True if args.outputname else False)
+        rp.train(sparse = args.sparse,  standardize = args.standardize, groupsWhere = args.groupswhere, weightedSample=args.weightedsample, outputName = args.outputname, saveFeatures = True if args.outputname else False, cores = args.cores)
 
     if args.testregression:
         rp.test(sparse = args.sparse, blacklist = blacklist,  standardize = args.standardize, groupsWhere = args.groupswhere)
@@ -1702,7 +1743,7 @@ def main(fn_args = None):
                                            noLang=args.nolang, allControlsOnly = args.allcontrolsonly, comboSizes = args.controlcombosizes,
                                            nFolds = args.folds, savePredictions = (args.pred_csv | args.prob_csv), weightedEvalOutcome = args.weightedeval,
                                            standardize = args.standardize, residualizedControls = args.res_controls, groupsWhere = args.groupswhere, 
-                                           weightedSample = args.weightedsample, adaptationFactorsName = args.adaptationfactors, featureSelectionParameters=args.featureselectionparams , factorSelectionType=args.factorselectiontype, numOfFactors=args.numoffactors, pairedFactors=args.pairedfactors, outputName = args.outputname, report=args.report, integrationMethod = args.integrationmethod)
+                                           weightedSample = args.weightedsample, adaptationFactorsName = args.adaptationfactors, featureSelectionParameters=args.featureselectionparams , factorSelectionType=args.factorselectiontype, numOfFactors=args.numoffactors, pairedFactors=args.pairedfactors, outputName = args.outputname, report=args.report, integrationMethod = args.integrationmethod, cores = args.cores, reuseFits = args.reusecombofits)
         elif args.controladjustreg:
             comboScores = rp.adjustOutcomesFromControls(standardize = args.standardize, sparse = args.sparse,
                                                         allControlsOnly = args.allcontrolsonly, comboSizes = args.controlcombosizes,
@@ -1738,7 +1779,7 @@ def main(fn_args = None):
 
     if args.predictrtofeats and rp:
         if not fe: fe = FE()
-        rp.predictToFeatureTable(sparse = args.sparse, fe = fe, name = args.predictrtofeats, standardize = args.standardize, groupsWhere = args.groupswhere)
+        rp.predictToFeatureTable(sparse = args.sparse, fe = fe, name = args.predictrtofeats, standardize = args.standardize, groupsWhere = args.groupswhere, streaming = args.streampredictions, compiled = args.compiledpredictions, inDatabase = args.sqlpredictions)
 
     if args.predictRtoOutcomeTable:
         #if not fgs: fgs = FGs()
@@ -1772,7 +1813,7 @@ def main(fn_args = None):
         cp.load(args.picklefile)
 
     if args.trainclassifiers:
-        cp.train(sparse = args.sparse, standardize = args.standardize, groupsWhere = args.groupswhere)
+        cp.train(sparse = args.sparse, standardize = args.standardize, groupsWhere = args.groupswhere, cores = args.cores)
 
     if args.testclassifiers:
         cp.test(sparse = args.sparse, standardize = args.standardize, groupsWhere = args.groupswhere)
@@ -1784,7 +1825,7 @@ def main(fn_args = None):
                                            nFolds = args.folds, savePredictions = (args.pred_csv | args.prob_csv),
                                            weightedEvalOutcome = args.weightedeval, stratifyFolds=args.stratifyfolds,
                                            adaptTables = args.adapttable, adaptColumns = args.adaptcolumns,
-                                           groupsWhere = args.groupswhere, testFolds = args.test_folds)
+                                           groupsWhere = args.groupswhere, testFolds = args.test_folds, cores = args.cores, reuseFits = args.reusecombofits)
         if args.csv:
             outputStream = sys.stdout
             if args.outputname:
@@ -1837,7 +1878,7 @@ def main(fn_args = None):
 
     if (args.predictctofeats or args.predictprobstofeats) and cp:
         if not fe: fe = FE()
-        cp.predictToFeatureTable(sparse = args.sparse, fe = fe, name = args.predictctofeats or args.predictprobstofeats, groupsWhere = args.groupswhere, probs = args.predictprobstofeats)
+        cp.predictToFeatureTable(sparse = args.sparse, fe = fe, name = args.predictctofeats or args.predictprobstofeats, groupsWhere = args.groupswhere, probs = args.predictprobstofeats, streaming = args.streampredictions, inDatabase = args.sqlpredictions)
 
     if args.predictCtoOutcomeTable:
         if not fgs: fgs = FGs()
@@ -2002,6 +2043,7 @@ def main(fn_args = None):
         if (args.outputname): init_file.write("outputname = " + str(args.outputname)+"\n")
         if (args.groupfreqthresh and args.groupfreqthresh != int(dlac.DEF_GROUP_FREQ_THRESHOLD)): init_file.write("groupfreqthresh = " + str(args.groupfreqthresh)+"\n")
         if (args.lextable): init_file.write("lextable = " + str(args.lextable)+"\n")
+        if (args.featsnapshotdir): init_file.write("featsnapshotdir = " + str(args.featsnapshotdir)+"\n")
         if (args.p_correction_method and args.p_correction_method != dlac.DEF_P_CORR): init_file.write("p_correction_method = " + str(args.p_correction_method)+"\n")
         if (args.tagcloudcolorscheme and args.tagcloudcolorscheme != 'multi'): init_file.write("tagcloudcolorscheme = " + str(args.tagcloudcolorscheme)+"\n")
         if (args.maxP and args.maxP != float(dlac.DEF_P)): init_file.write("maxP = " + str(args.maxP)+"\n")